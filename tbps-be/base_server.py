@@ -1,12 +1,27 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import hmac
+import os
+
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Protocol
+from typing import AsyncIterator, Protocol
+
+class QueryOptions(BaseModel):
+    """Query-plan options; unset options take the server defaults, and the server may cap them."""
+    wl_candidates: int | None = Field(default=None, ge=1, le=100000, description="Candidates retrieved by WL score for reranking (default 1500)")
+    wl_iterations: int | None = Field(default=None, ge=1, le=80, description="WL iterations of the encodings compared (default 3)")
+    use_clustering: bool | None = Field(default=None, description="Retrieve only from the clusters nearest to the expression")
+    n_probe: int | None = Field(default=None, ge=1, description="Clusters probed by clustered retrieval")
+    cheap_candidates: int | None = Field(default=None, ge=1, description="Candidates of the cheap rerank stage (default all)")
+    zss_candidates: int | None = Field(default=None, ge=1, description="Candidates of the tree edit distance rerank stage (default all)")
 
-class SimilarTheoremsRequest(BaseModel):
+class SimilarTheoremsRequest(QueryOptions):
     expression: str = Field(..., description="Lean expression to find similar theorems for")
     k: int | None = Field(default=20, ge=1, le=100, description="Number of top similar theorems to return")
     node_ratio: float | None = Field(default=None, ge=1.0, le=2.0, description="Node ratio filter (auto-determined if not provided)")
+    time_budget_ms: int | None = Field(default=None, ge=100, le=120000, description="Compute deadline; the best results found so far are returned when it expires")
 
 class TheoremResult(BaseModel):
     name: str
@@ -19,6 +34,16 @@ class SimilarTheoremsResponse(BaseModel):
     results: list[TheoremResult]
     total_processed: int
     expression_parsed: str
+    partial: bool = Field(default=False, description="True if the time budget expired before the search completed")
+
+class SimilarTheoremsUpdate(BaseModel):
+    stage: str = Field(..., description="Ranking stage: wl, cheap or zss while refining, done for the final results, error if the search failed")
+    final: bool
+    results: list[TheoremResult] = Field(default_factory=list)
+    expression_parsed: str = ""
+    partial: bool = Field(default=False, description="True if the time budget expired before the search completed")
+    provisional: bool = Field(default=False, description="True while refining: wl scores are WL kernel values, and cheap and zss scores are upper bounds for theorems not fully scored yet")
+    detail: str | None = None
 
 class HealthResponse(BaseModel):
     status: str
@@ -26,6 +51,17 @@ class HealthResponse(BaseModel):
     database_connected: bool
     lean_available: bool
 
+class CorpusStatsResponse(BaseModel):
+    loaded: bool
+    stats: dict[str, int | float] | None = None
+
+class DatabaseStatsResponse(BaseModel):
+    pooled: bool
+    stats: dict[str, int | float] | None = None
+
+class CacheStatsResponse(BaseModel):
+    caches: dict[str, dict[str, int | float]]
+
 class TheoremHandler(Protocol):
     """Protocol defining the interface for theorem search handlers."""
 
@@ -33,11 +69,31 @@ class TheoremHandler(Protocol):
         self,
         expression: str,
         k: int,
-        node_ratio: float | None = None
-    ) -> tuple[list[TheoremResult], str]:
+        node_ratio: float | None = None,
+        time_budget_ms: int | None = None,
+        options: QueryOptions | None = None
+    ) -> tuple[list[TheoremResult], str, bool]:
+        """
+        Find similar theorems for the given expression, within time_budget_ms
+        if given. Raises ValueError for options the server does not allow.
+        Returns: (list of theorem results, parsed expression string, whether
+        the budget expired before the search completed)
+        """
+        ...
+
+    async def stream_similar_theorems(
+        self,
+        expression: str,
+        k: int,
+        node_ratio: float | None = None,
+        time_budget_ms: int | None = None,
+        options: QueryOptions | None = None
+    ) -> AsyncIterator[tuple[str, list[TheoremResult], str, bool]]:
         """
-        Find similar theorems for the given expression.
-        Returns: (list of theorem results, parsed expression string)
+        Same search as find_similar_theorems, yielding the ranking as it is
+        refined: (stage, top k results, parsed expression string, partial),
+        ending with the final results as stage "done". Raises ValueError for
+        options the server does not allow before returning the iterator.
         """
         ...
 
@@ -48,6 +104,47 @@ class TheoremHandler(Protocol):
         """
         ...
 
+    async def reload_corpus(self) -> dict:
+        """
+        Rebuild the in-memory corpus index from the database.
+        Returns: memory usage statistics of the new index
+        """
+        ...
+
+    async def corpus_stats(self) -> dict | None:
+        """
+        Report the in-memory corpus index.
+        Returns: memory usage statistics, or None if no index is loaded
+        """
+        ...
+
+    async def database_stats(self) -> dict | None:
+        """
+        Report the database connection pool.
+        Returns: pool metrics, or None if the pool has not been used yet
+        """
+        ...
+
+    async def cache_stats(self) -> dict[str, dict]:
+        """
+        Report the query-path caches.
+        Returns: hit/miss statistics by cache name
+        """
+        ...
+
+def admin_token() -> str | None:
+    """Token for admin endpoints from TBPS_ADMIN_TOKEN; None disables them."""
+    return os.environ.get("TBPS_ADMIN_TOKEN") or None
+
+def require_admin(authorization: str | None):
+    """Reject the request unless it carries "Authorization: Bearer <admin token>"."""
+    token = admin_token()
+    if token is None:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set TBPS_ADMIN_TOKEN to enable them")
+    scheme, _, given = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(given.encode(), token.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
 def create_app(handler: TheoremHandler, title: str, description: str) -> FastAPI:
     """Create FastAPI app with the given handler."""
     app = FastAPI(
@@ -72,17 +169,20 @@ def create_app(handler: TheoremHandler, title: str, description: str) -> FastAPI
             k_value = request.k if request.k is not None else 20
 
             # Call handler
-            results, parsed_expression = await handler.find_similar_theorems(
+            results, parsed_expression, partial = await handler.find_similar_theorems(
                 request.expression,
                 k_value,
-                request.node_ratio
+                request.node_ratio,
+                request.time_budget_ms,
+                request
             )
 
             return SimilarTheoremsResponse(
                 success=True,
                 results=results,
                 total_processed=len(results),
-                expression_parsed=parsed_expression
+                expression_parsed=parsed_expression,
+                partial=partial
             )
 
         except ValueError as e:
@@ -90,6 +190,49 @@ def create_app(handler: TheoremHandler, title: str, description: str) -> FastAPI
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
+    @app.post("/find-similar-theorems/stream")
+    async def stream_similar_theorems_endpoint(request: SimilarTheoremsRequest):
+        """
+        Find similar theorems, streaming newline-delimited SimilarTheoremsUpdate
+        JSON: the WL-only top k once retrieval finishes, refined rankings while
+        reranking, then the final results.
+        """
+        k_value = request.k if request.k is not None else 20
+
+        # Rejected before the response starts, so the status can still say so
+        try:
+            stream = await handler.stream_similar_theorems(
+                request.expression,
+                k_value,
+                request.node_ratio,
+                request.time_budget_ms,
+                request
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+        async def updates():
+            try:
+                async for stage, results, parsed_expression, partial in stream:
+                    update = SimilarTheoremsUpdate(
+                        stage=stage,
+                        final=stage == "done",
+                        provisional=stage != "done",
+                        results=results,
+                        expression_parsed=parsed_expression,
+                        partial=partial
+                    )
+                    yield update.model_dump_json() + "\n"
+            except ValueError as e:
+                yield SimilarTheoremsUpdate(stage="error", final=True, detail=str(e)).model_dump_json() + "\n"
+            except Exception as e:
+                detail = f"Error processing request: {str(e)}"
+                yield SimilarTheoremsUpdate(stage="error", final=True, detail=detail).model_dump_json() + "\n"
+
+        return StreamingResponse(updates(), media_type="application/x-ndjson")
+
     @app.get("/health", response_model=HealthResponse)
     async def health_check_endpoint():
         """Health check endpoint to verify server status and dependencies."""
@@ -110,13 +253,46 @@ def create_app(handler: TheoremHandler, title: str, description: str) -> FastAPI
                 lean_available=False
             )
 
+    @app.get("/corpus/stats", response_model=CorpusStatsResponse)
+    async def corpus_stats_endpoint():
+        """Memory usage of the in-memory corpus index."""
+        stats = await handler.corpus_stats()
+        return CorpusStatsResponse(loaded=stats is not None, stats=stats)
+
+    # Held while a reload runs; a second one is refused rather than queued
+    reload_lock = asyncio.Lock()
+
+    @app.post("/corpus/reload", response_model=CorpusStatsResponse)
+    async def corpus_reload_endpoint(authorization: str | None = Header(default=None)):
+        """Rebuild the in-memory corpus index from the database (admin token required)."""
+        require_admin(authorization)
+        if reload_lock.locked():
+            raise HTTPException(status_code=409, detail="A corpus reload is already running")
+        async with reload_lock:
+            try:
+                stats = await handler.reload_corpus()
+                return CorpusStatsResponse(loaded=True, stats=stats)
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Error reloading corpus: {str(e)}")
+
+    @app.get("/db/stats", response_model=DatabaseStatsResponse)
+    async def database_stats_endpoint():
+        """Metrics of the database connection pool."""
+        stats = await handler.database_stats()
+        return DatabaseStatsResponse(pooled=stats is not None, stats=stats)
+
+    @app.get("/cache/stats", response_model=CacheStatsResponse)
+    async def cache_stats_endpoint():
+        """Hit rates of the query-path caches."""
+        return CacheStatsResponse(caches=await handler.cache_stats())
+
     @app.get("/")
     async def root_endpoint():
         """Root endpoint with basic API information."""
         return {
             "message": app.title,
             "version": app.version,
-            "endpoints": ["/find-similar-theorems", "/health"],
+            "endpoints": ["/find-similar-theorems", "/find-similar-theorems/stream", "/health", "/corpus/stats", "/corpus/reload", "/db/stats", "/cache/stats"],
             "docs": "/docs"
         }
 
@@ -3,23 +3,104 @@ import json
 import os
 import random
 import asyncio
-from base_server import TheoremResult
-from search_app.process_single import process_single_prop_new
+import concurrent.futures
+import threading
+import time
+from base_server import QueryOptions, TheoremResult
+from search_app.process_single import process_single_prop_new, clear_details_cache
+from search_app.query_plan import QueryPlan, default_query_limits, query_plan
 from search_app.myexpr import deserialize_expr  # pyright: ignore[reportUnknownVariableType]
 from search_app.cse import cse
-from search_app.WL.db_utils import connect_to_db  # pyright: ignore[reportPrivateLocalImportUsage, reportUnknownVariableType]
+from search_app.canonical import canonical_key
+from search_app.WL_embedding.db_utils import db_connection, db_pool_stats
+from search_app.WL.inverted_index import default_index_path, load_inverted_index
+from search_app.WL.lsh_index import default_lsh_path, load_lsh_index
+from search_app.WL.ivf_index import load_ivf_index
+from search_app.corpus import load_corpus_index
+from search_app.migrations import clear_search_view_cache
+from search_app.result_cache import (
+    TTLCache,
+    default_result_cache_depth,
+    default_result_cache_size,
+    default_result_cache_ttl,
+    result_cache_depth,
+)
+from search_app.tree_cache import tree_cache_stats
+from search_app.workers import init_pool
+
+class SearchClosed(Exception):
+    """Raised in a streamed search whose client has disconnected."""
+
 
 class ProductionHandler:
     """Production handler that uses real Lean parsing and database queries."""
 
-    def __init__(self):
+    def __init__(self, load_corpus: bool = True):
         self.PROJECT_ROOT = r"./Lean_tool"
         self.INPUT_TXT = os.path.join(self.PROJECT_ROOT, "input_expr.txt")
         self.OUTPUT_JSON = os.path.join(self.PROJECT_ROOT, "expr_output.json")
         self.version = "1.0.0"
+        self.wl_iterations = 3
+        # The Lean tool reads and writes fixed files, one parse at a time
+        self._lean_lock = threading.Lock()
+        # Compute budget of requests that do not set time_budget_ms, unbounded
+        # unless TBPS_TIME_BUDGET_MS is set
+        self.default_time_budget_ms = (
+            int(os.environ.get("TBPS_TIME_BUDGET_MS", 0)) or None
+        )
+        # Caps on per-query options, from TBPS_MAX_WL_CANDIDATES,
+        # TBPS_MAX_ZSS_CANDIDATES, TBPS_MAX_N_PROBE and TBPS_WL_ITERATIONS
+        self.query_limits = default_query_limits()
+        # Complete rankings by canonical form of the post-CSE target and query
+        # plan, sized by TBPS_RESULT_CACHE_SIZE and TBPS_RESULT_CACHE_TTL;
+        # the corpus generation in the key keeps searches that started before
+        # a reload from caching stale results
+        self.result_cache = TTLCache(
+            default_result_cache_size(), default_result_cache_ttl()
+        )
+        # Results searched for per query while the cache is on, from
+        # TBPS_RESULT_CACHE_DEPTH (None: twice k, up to 50); entries serve
+        # any k up to their depth
+        self.result_cache_depth = default_result_cache_depth()
+        self.corpus_generation = 0
+        # Searches running now by result cache key, with their deadlines,
+        # joined by identical concurrent queries instead of being repeated
+        self._in_flight: dict[
+            tuple, tuple[concurrent.futures.Future, float | None]
+        ] = {}
+        self._in_flight_lock = threading.Lock()
+        # Lean output by expression text, which does not depend on the corpus
+        self.parse_cache = TTLCache(
+            default_result_cache_size(), default_result_cache_ttl()
+        )
+        # Memory-mapped corpus, opened from TBPS_CORPUS_DIR (built from the
+        # database on first start); falls back to database queries if it
+        # cannot be loaded
+        self.corpus = (
+            load_corpus_index(wl_iterations=self.wl_iterations) if load_corpus else None
+        )
+        # Built offline with `python -m search_app.WL.inverted_index`; the corpus
+        # index already contains one
+        self.wl_index = (
+            None
+            if self.corpus is not None
+            else load_inverted_index(default_index_path(self.wl_iterations))
+        )
+        # Optional approximate candidates, `python -m search_app.WL.lsh_index build`
+        self.lsh_index = load_lsh_index(default_lsh_path(self.wl_iterations))
+        # Cluster membership of the k-means model trained by cluster_wl.py, for
+        # large node windows; over the corpus ids when the corpus has them
+        self.ivf_index = load_ivf_index(self.corpus)
+        # One worker pool for all queries and pipeline stages, started after the
+        # corpus so workers inherit it; sized by TBPS_WORKERS or the CPU count
+        init_pool(corpus=self.corpus)
 
     def _run_lean(self, input_str: str) -> tuple[str, str, str]:
         """Parse Lean expression using the Lean tool."""
+        with self._lean_lock:
+            return self._run_lean_locked(input_str)
+
+    def _run_lean_locked(self, input_str: str) -> tuple[str, str, str]:
         try:
             with open(self.INPUT_TXT, "w", encoding="utf-8") as f:
                 f.write(input_str.strip())
@@ -52,34 +133,238 @@ class ProductionHandler:
         except Exception as e:
             raise Exception(f"Lean parsing error: {str(e)}")
 
-    async def find_similar_theorems(
+    def _format_results(
+        self, results: list[tuple[str, float, str, int]]
+    ) -> list[TheoremResult]:
+        theorem_results = []
+        for theorem_name, similarity, statement, node_count in results:
+            theorem_results.append(TheoremResult(
+                name=theorem_name,
+                similarity_score=round(similarity, 4),
+                statement=statement,
+                node_count=node_count
+            ))
+        return theorem_results
+
+    def _query_plan(
+        self, node_ratio: float | None, options: QueryOptions | None
+    ) -> QueryPlan:
+        """Validated query plan of a request; ValueError beyond query_limits."""
+        return query_plan(
+            self.query_limits,
+            node_ratio,
+            **(
+                options.model_dump(include=set(QueryOptions.model_fields))
+                if options is not None
+                else {}
+            ),
+        )
+
+    def _search(
         self,
         expression: str,
         k: int,
-        node_ratio: float | None = None
-    ) -> tuple[list[TheoremResult], str]:
-        """Find similar theorems using real computation."""
+        plan: QueryPlan,
+        time_budget_ms: int | None = None,
+        on_update=None
+    ) -> tuple[list[TheoremResult], str, bool]:
+        """
+        Blocking search behind both endpoints; on_update(stage, results,
+        statement_str) receives the provisional top k. Complete rankings are
+        cached result_cache_depth(k) deep, so repeating a query with any k
+        up to the cached depth skips the search.
+        """
+        # The budget covers the whole request, Lean parsing included
+        time_budget_ms = time_budget_ms or self.default_time_budget_ms
+        deadline = (
+            time.monotonic() + time_budget_ms / 1000 if time_budget_ms else None
+        )
+        generation = self.corpus_generation
+
         # Parse the Lean expression
-        name, expr_json, statement_str = self._run_lean(expression)
+        parsed = self.parse_cache.get(expression.strip())
+        if parsed is None:
+            parsed = self._run_lean(expression)
+            self.parse_cache.put(expression.strip(), parsed)
+        name, expr_json, statement_str = parsed
 
         # Deserialize and apply CSE transformation
         original_expr = deserialize_expr(expr_json)
         cse_expr = cse(original_expr)
 
-        # Find similar theorems
-        results = process_single_prop_new(cse_expr, k)
+        # Alpha-equivalent targets share cache entries and running searches
+        key = (canonical_key(cse_expr), plan, generation)
+        cached = self.result_cache.get(key)
+        if cached is not None and cached[0] >= k:
+            return self._format_results(cached[1][:k]), statement_str, False
+
+        # Join an identical search already running, within this request's
+        # budget. Its results are taken if they are deep enough and either
+        # complete or cut short by a deadline no later than this request's;
+        # if it fails, times out or falls short, search here
+        with self._in_flight_lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = (concurrent.futures.Future(), deadline)
+        future, leader_deadline = flight
+        if not leader:
+            timeout = max(0.0, deadline - time.monotonic()) if deadline else None
+            try:
+                depth, results, partial = future.result(timeout=timeout)
+            except Exception:
+                pass
+            else:
+                if depth >= k and (
+                    not partial
+                    or (
+                        deadline is not None
+                        and leader_deadline is not None
+                        and deadline <= leader_deadline
+                    )
+                ):
+                    return self._format_results(results[:k]), statement_str, partial
+
+        on_progress = None
+        if on_update is not None:
+            def on_progress(stage, results):
+                on_update(stage, self._format_results(results), statement_str)
+
+        # Find similar theorems, deep enough to serve larger k from the cache
+        depth = k
+        if self.result_cache.max_entries > 0:
+            depth = result_cache_depth(k, self.result_cache_depth)
+        stage_stats = []
+        try:
+            results = process_single_prop_new(
+                cse_expr,
+                depth,
+                wl_index=self.wl_index,
+                lsh_index=self.lsh_index,
+                corpus=self.corpus,
+                ivf_index=self.ivf_index,
+                stage_stats=stage_stats,
+                deadline=deadline,
+                on_progress=on_progress,
+                progress_k=k,
+                **plan.kwargs(),
+            )
+            partial = any(stage["partial"] for stage in stage_stats)
+            if not partial:
+                self.result_cache.put(key, (depth, results))
+            if leader:
+                future.set_result((depth, results, partial))
+        except Exception as e:
+            if leader:
+                future.set_exception(e)
+            raise
+        finally:
+            if leader:
+                with self._in_flight_lock:
+                    del self._in_flight[key]
+        return self._format_results(results[:k]), statement_str, partial
 
-        # Format results
-        theorem_results = []
-        for theorem_name, similarity, statement, node_count in results:
-            theorem_results.append(TheoremResult(
-                name=theorem_name,
-                similarity_score=round(similarity, 4),
-                statement=statement,
-                node_count=node_count
-            ))
+    async def find_similar_theorems(
+        self,
+        expression: str,
+        k: int,
+        node_ratio: float | None = None,
+        time_budget_ms: int | None = None,
+        options: QueryOptions | None = None
+    ) -> tuple[list[TheoremResult], str, bool]:
+        """Find similar theorems using real computation."""
+        plan = self._query_plan(node_ratio, options)
+        return await asyncio.to_thread(self._search, expression, k, plan, time_budget_ms)
 
-        return theorem_results, statement_str
+    async def stream_similar_theorems(
+        self,
+        expression: str,
+        k: int,
+        node_ratio: float | None = None,
+        time_budget_ms: int | None = None,
+        options: QueryOptions | None = None
+    ):
+        """Validate the query plan, then return the updates of _stream_search."""
+        plan = self._query_plan(node_ratio, options)
+        return self._stream_search(expression, k, plan, time_budget_ms)
+
+    async def _stream_search(
+        self,
+        expression: str,
+        k: int,
+        plan: QueryPlan,
+        time_budget_ms: int | None = None
+    ):
+        """
+        Run the search in a thread and yield its provisional rankings as they
+        are produced, then the final results as stage "done".
+        """
+        loop = asyncio.get_running_loop()
+        updates: asyncio.Queue = asyncio.Queue()
+        # Set when the client goes away, to stop the search at its next update
+        closed = threading.Event()
+
+        def on_update(stage, results, statement_str):
+            if closed.is_set():
+                raise SearchClosed()
+            loop.call_soon_threadsafe(
+                updates.put_nowait, (stage, results, statement_str, False)
+            )
+
+        def search():
+            try:
+                results, statement_str, partial = self._search(
+                    expression, k, plan, time_budget_ms, on_update
+                )
+                update = ("done", results, statement_str, partial)
+            except Exception as e:
+                update = e
+            loop.call_soon_threadsafe(updates.put_nowait, update)
+
+        task = asyncio.create_task(asyncio.to_thread(search))
+        try:
+            while True:
+                update = await updates.get()
+                if isinstance(update, Exception):
+                    raise update
+                yield update
+                if update[0] == "done":
+                    break
+        finally:
+            closed.set()
+
+    async def reload_corpus(self) -> dict:
+        """Rebuild the corpus index from the database and publish a new version."""
+        corpus = await asyncio.to_thread(
+            load_corpus_index, wl_iterations=self.wl_iterations, rebuild=True
+        )
+        if corpus is None:
+            raise Exception("Corpus reload failed, keeping the previous index")
+        self.corpus = corpus
+        self.wl_index = None
+        self.ivf_index = await asyncio.to_thread(load_ivf_index, corpus)
+        clear_details_cache()
+        clear_search_view_cache()
+        self.corpus_generation += 1
+        self.result_cache.clear()
+        await asyncio.to_thread(init_pool, corpus=corpus)
+        return corpus.memory_usage()
+
+    async def corpus_stats(self) -> dict | None:
+        """Memory usage of the in-memory corpus index, None if not loaded."""
+        return self.corpus.memory_usage() if self.corpus is not None else None
+
+    async def database_stats(self) -> dict | None:
+        """Connection pool metrics, None before the first pooled query."""
+        return db_pool_stats()
+
+    async def cache_stats(self) -> dict[str, dict]:
+        """Hit rates of the result and parse caches, and of the candidate tree caches in the worker processes."""
+        return {
+            "results": self.result_cache.stats(),
+            "parses": self.parse_cache.stats(),
+            "trees": tree_cache_stats(),
+        }
 
     async def check_health(self) -> tuple[bool, bool, str]:
         """Check database and Lean availability."""
@@ -88,11 +373,9 @@ class ProductionHandler:
 
         # Check database connection
         try:
-            conn = connect_to_db()
-            with conn.cursor() as cur:
+            with db_connection() as conn, conn.cursor() as cur:
                 cur.execute("SELECT 1")
                 cur.fetchone()
-            conn.close()
             database_connected = True
         except Exception:
             database_connected = False
@@ -182,22 +465,33 @@ class MockHandler:
         results.sort(key=lambda x: x.similarity_score, reverse=True)
         return results
 
-    async def find_similar_theorems(
-        self,
-        expression: str,
-        k: int,
-        node_ratio: float | None = None
-    ) -> tuple[list[TheoremResult], str]:
-        """Generate mock similar theorems."""
-        # Validate input
+    def _validate(self, expression: str):
         if not expression.strip():
             raise ValueError("Expression cannot be empty")
 
         if len(expression) > 1000:
             raise ValueError("Expression too long (max 1000 characters)")
 
-        # Simulate processing time (1-3 seconds)
+    def _processing_time(self, time_budget_ms: int | None) -> tuple[float, bool]:
+        """Simulated processing time (1-3 seconds), capped by the time budget."""
         processing_time = random.uniform(1.0, 3.0)
+        partial = time_budget_ms is not None and time_budget_ms / 1000 < processing_time
+        if partial:
+            processing_time = time_budget_ms / 1000
+        return processing_time, partial
+
+    async def find_similar_theorems(
+        self,
+        expression: str,
+        k: int,
+        node_ratio: float | None = None,
+        time_budget_ms: int | None = None,
+        options: QueryOptions | None = None
+    ) -> tuple[list[TheoremResult], str, bool]:
+        """Generate mock similar theorems."""
+        self._validate(expression)
+
+        processing_time, partial = self._processing_time(time_budget_ms)
         await asyncio.sleep(processing_time)
 
         # Generate mock results
@@ -206,7 +500,65 @@ class MockHandler:
         # Mock parsed expression
         mock_parsed = f"parsed: {expression[:50]}{'...' if len(expression) > 50 else ''}"
 
-        return results, mock_parsed
+        return results, mock_parsed, partial
+
+    async def stream_similar_theorems(
+        self,
+        expression: str,
+        k: int,
+        node_ratio: float | None = None,
+        time_budget_ms: int | None = None,
+        options: QueryOptions | None = None
+    ):
+        """Validate the expression, then return the updates of _stream_mock."""
+        self._validate(expression)
+        return self._stream_mock(expression, k, time_budget_ms)
+
+    async def _stream_mock(self, expression: str, k: int, time_budget_ms: int | None):
+        """Generate mock similar theorems, preceded by a noisier WL-only ranking."""
+        # The WL-only ranking arrives after a third of the processing time
+        processing_time, partial = self._processing_time(time_budget_ms)
+        await asyncio.sleep(processing_time / 3)
+
+        results = self._generate_mock_results(expression, k)
+        mock_parsed = f"parsed: {expression[:50]}{'...' if len(expression) > 50 else ''}"
+        wl_results = [
+            result.model_copy(update={
+                "similarity_score": round(
+                    max(0.0, min(1.0, result.similarity_score + random.uniform(-0.1, 0.1))), 4
+                )
+            })
+            for result in results
+        ]
+        wl_results.sort(key=lambda x: x.similarity_score, reverse=True)
+        yield "wl", wl_results, mock_parsed, False
+        await asyncio.sleep(processing_time * 2 / 3)
+        yield "done", results, mock_parsed, partial
+
+    async def reload_corpus(self) -> dict:
+        """Pretend to reload the corpus index."""
+        await asyncio.sleep(0.1)
+        return await self.corpus_stats()
+
+    async def corpus_stats(self) -> dict | None:
+        """Return mock corpus index statistics."""
+        return {
+            "theorems": len(self.mock_theorem_names),
+            "wl_iterations": 3,
+            "rss_delta_bytes": 0,
+            "load_seconds": 0.0,
+        }
+
+    async def database_stats(self) -> dict | None:
+        """Return mock connection pool metrics."""
+        return {"max_size": 8, "in_use": 0, "idle": 1, "checkouts": 0}
+
+    async def cache_stats(self) -> dict[str, dict]:
+        """Return mock cache statistics."""
+        return {
+            "results": {"entries": 0, "hits": 0, "misses": 0, "hit_rate": 0.0, "evictions": 0},
+            "trees": {"hits": 0, "misses": 0, "hit_rate": 0.0, "evictions": 0},
+        }
 
     async def check_health(self) -> tuple[bool, bool, str]:
         """Return mock health status with occasional issues for testing."""
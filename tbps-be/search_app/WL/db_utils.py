@@ -1,20 +1,43 @@
+import heapq
 import json
+import random
+import time
+from array import array
 import numpy as np
 import psycopg2
-import pickle
-import concurrent.futures
-from tqdm import tqdm
-import os
 import logging
 
-from search_app.myexpr import deserialize_expr, simplify_forall_expr_iter
+from search_app.myexpr import simplify_forall_expr_iter
 from search_app.compute.zss_compute import (
     your_expr_to_treenode,
     count_nodes,
     can_t1_collapse_match_t2_soft,
 )
-from search_app.WL_embedding.wl_kernel import compute_wl_encoding, compute_wl_kernel
-from search_app.WL_embedding.db_utils import connect_to_db, DB_CONFIG
+from search_app.WL_embedding.wl_kernel import compute_wl_encoding
+from search_app.compute.wl_codec import stored_wl_kernel
+from search_app.WL_embedding.db_utils import (
+    db_connection,
+    get_db_pool,
+    iter_batches,
+)
+from search_app.WL.ivf_index import get_cluster_model
+from search_app.migrations import SEARCH_VIEW, search_view_columns
+from search_app.WL.packed_wl import has_packed_wl, packed_wl_column, wl_select_column
+from search_app.WL.sample_order import SAMPLE_ORDER_COLUMN, has_sample_order
+from search_app.simp_trees import candidate_tree, simp_tree_columns, simp_tree_source
+from search_app.tree_cache import cached_tree
+from search_app.workers import map_chunked
+
+
+# Rows per batch when streaming the node window; a full window of one large
+# batch would leave nothing to fetch while scoring
+STREAM_BATCH_SIZE = 10000
+
+# Theorems scored by the global sampling fallback of clustered retrieval
+GLOBAL_SAMPLE_SIZE = 5000
+# Rows of the sample_order index read per sampled row, on each side of the
+# random start, before sample_window sorts the node window instead
+SAMPLE_OVERSCAN = 16
 
 
 def check_name_in_batch(batch: list, target_name: str) -> bool:
@@ -31,48 +54,12 @@ def check_name_in_batch(batch: list, target_name: str) -> bool:
     return any(record[0] == target_name for record in batch)
 
 
-def wl_to_vector(
-    wl_encoding: dict,
-    feature_map: dict,
-    feature_weights: dict = None,
-    max_features: int = 5000,
-) -> np.ndarray:
-    vector = np.zeros(min(len(feature_map), max_features))
-    for key, count in wl_encoding.items():
-        if key in feature_map:
-            idx = feature_map[key]
-            if idx < max_features:
-                weight = feature_weights.get(key, 1.0) if feature_weights else 1.0
-                vector[idx] = count * weight
-    return vector
-
-
-def load_kmeans_model(n_clusters: int = 2000):
-    model_path = "kmeans_model.pkl"
-    feature_map_path = "feature_map.pkl"
-    feature_weights_path = "feature_weights.pkl"
-    pca_path = "pca_model.pkl"
-
-    for path in [model_path, feature_map_path, feature_weights_path]:
-        assert os.path.exists(path)
-    with open(model_path, "rb") as f:
-        kmeans = pickle.load(f)
-    with open(feature_map_path, "rb") as f:
-        feature_map = pickle.load(f)
-    with open(feature_weights_path, "rb") as f:
-        feature_weights = pickle.load(f)
-    pca = pickle.load(open(pca_path, "rb")) if os.path.exists(pca_path) else None
-
-    _key_labels = ["forallE", "Not", "Nat", "app", "fvar"]
-    return kmeans, feature_map, feature_weights, pca
-
-
 def compute_wl_score(item: tuple[str, str], target_encoding: dict) -> tuple[str, float]:
     name, wl_encoding_json = item
     try:
         wl_encoding = wl_encoding_json
         # print(wl_encoding)
-        wl_score = compute_wl_kernel(target_encoding, wl_encoding)
+        wl_score = stored_wl_kernel(target_encoding, wl_encoding)
         # print(wl_score)
         return (name, wl_score)
     except Exception as e:
@@ -80,19 +67,24 @@ def compute_wl_score(item: tuple[str, str], target_encoding: dict) -> tuple[str,
 
 
 def compute_wl_score_new(
-    item: tuple[str, str, str], simptree, target_encoding: dict
+    item: tuple, simptree, target_encoding: dict, alpha: float = 1.0
 ) -> tuple[str, float]:
-    name, wl_encoding_json, thmtree = item
-    thmtree = your_expr_to_treenode(
-        simplify_forall_expr_iter(deserialize_expr(thmtree))
-    )
+    """
+    Blend the WL kernel with the collapse-match score: alpha * wl + (1 - alpha) * s.
+    item is (name, wl_encoding) or (name, wl_encoding, simp_tree, expr_cse_json);
+    the candidate tree is only built when alpha < 1.
+    """
+    name, wl_encoding_json = item[0], item[1]
     try:
         wl_encoding = wl_encoding_json
         # print(wl_encoding)
-        wl_score = compute_wl_kernel(target_encoding, wl_encoding)
-        s = can_t1_collapse_match_t2_soft(simptree, thmtree)
-        alpha = 1
-        wl_score = alpha * wl_score + (1 - alpha) * s
+        wl_score = stored_wl_kernel(target_encoding, wl_encoding)
+        if alpha < 1:
+            entry = cached_tree(
+                name, lambda: candidate_tree(simp_tree_source(item[2], item[3]))
+            )
+            s = can_t1_collapse_match_t2_soft(simptree, entry.tree)
+            wl_score = alpha * wl_score + (1 - alpha) * s
         # print(wl_score)
         return (name, wl_score)
     except Exception as e:
@@ -100,6 +92,198 @@ def compute_wl_score_new(
         return (name, 0.0)
 
 
+def _wl_score_task(item: tuple, shared: tuple) -> tuple[str, float]:
+    simptree, target_encoding, alpha = shared
+    return compute_wl_score_new(item, simptree, target_encoding, alpha)
+
+
+class TopKCandidates:
+    """
+    The best k (name, score) pairs of a stream of scored candidates, kept in a
+    bounded min-heap: O(k) memory and O(n log k) time. Ties are broken by
+    arrival order, as a stable sort of the whole stream would. When a target
+    name is given, all scores are also kept (as floats) to report its rank.
+    """
+
+    def __init__(self, k: int, target_name: str = ""):
+        self.k = k
+        self.target_name = target_name
+        # (score, -arrival, name): the root is the worst kept candidate
+        self.heap: list[tuple[float, int, str]] = []
+        self.total = 0
+        self.scores = array("d") if target_name else None
+        self.target = None
+
+    def add(self, results):
+        for name, score in results:
+            arrival = self.total
+            self.total += 1
+            if self.scores is not None:
+                self.scores.append(score)
+                if name == self.target_name and self.target is None:
+                    self.target = (score, arrival)
+            item = (score, -arrival, name)
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, item)
+            elif item > self.heap[0]:
+                heapq.heapreplace(self.heap, item)
+
+    def __len__(self) -> int:
+        return self.total
+
+    def names(self) -> set[str]:
+        return {name for _, _, name in self.heap}
+
+    def ranked(self) -> list[tuple[str, float]]:
+        return [(name, score) for score, _, name in sorted(self.heap, reverse=True)]
+
+    def target_index(self) -> int:
+        """0-based position of the target in the full ranking, -1 if not seen."""
+        if self.target is None:
+            return -1
+        target_score, target_arrival = self.target
+        scores = np.frombuffer(self.scores, dtype=np.float64)
+        return int(
+            np.count_nonzero(scores > target_score)
+            + np.count_nonzero(scores[:target_arrival] == target_score)
+        )
+
+
+def finalize_candidates(
+    candidates,
+    target_name: str,
+    top_k: int,
+    debug: bool = False,
+):
+    """
+    Select the top_k scored candidates and summarize their WL scores.
+    candidates is a TopKCandidates or a list of (name, score).
+    """
+    if not isinstance(candidates, TopKCandidates):
+        streamed = TopKCandidates(top_k, target_name)
+        streamed.add(candidates)
+        candidates = streamed
+    index = candidates.target_index()
+
+    if index != -1:
+        print(f"'{target_name}' ranked at position {index + 1} (index {index})")
+        if index + 1 > top_k:
+            return 0, False
+    else:
+        print(f"'{target_name}' not in candidate list")
+    filtered_results = candidates.ranked()[:top_k]
+
+    # Compute WL statistics
+    wl_scores = [x[1] for x in filtered_results] if filtered_results else [0.0]
+    wl_stats = {
+        "wl_min": min(wl_scores),
+        "wl_max": max(wl_scores),
+        "wl_avg": sum(wl_scores) / len(wl_scores) if wl_scores else 0.0,
+        "total_candidates": len(candidates),
+        "filtered_candidates": len(filtered_results),
+    }
+
+    if debug:
+        print(
+            f"WL scores - Min: {wl_stats['wl_min']:.2f}, Max: {wl_stats['wl_max']:.2f}, Avg: {wl_stats['wl_avg']:.2f}"
+        )
+        print(f"Pre-filter candidates: {len(candidates)}")
+        print(f"Post-filter candidates: {len(filtered_results)}")
+    print(f"Returning top-{top_k}: {len(filtered_results)} candidate theorems")
+    logging.info(f"Returning top-{top_k}: {len(filtered_results)} candidate theorems")
+
+    return filtered_results, wl_stats
+
+
+def sample_window(
+    cur,
+    database_name: str,
+    wl_column: str,
+    min_nodes: float,
+    max_nodes: float,
+    excluded_clusters: list[int],
+    limit: int,
+) -> list[tuple]:
+    """
+    Random sample of up to limit (name, WL encoding) rows in the node window
+    outside excluded_clusters.
+
+    With the precomputed sample_order column, it reads at most
+    SAMPLE_OVERSCAN * limit rows of the sample_order index after a random
+    start, and as many again from the beginning to wrap around, and keeps
+    the first limit of them in the window. Rows of the window come in
+    uniformly random order there, but each sample is a run of the same
+    permutation, so calls whose starts fall close together overlap until
+    store_sample_order is rerun. When the window and clusters hold too small
+    a share of the table for that read to find limit rows, or without the
+    column, it sorts the window by RANDOM() instead, at a cost proportional
+    to the window.
+    """
+    window = f"""
+        WHERE d.expr_cse_json != 'null'
+        AND d.simp_node_count BETWEEN %s AND %s
+        AND (w.cluster_id IS NULL OR w.cluster_id != ALL(%s))
+    """
+    params = (min_nodes, max_nodes, excluded_clusters)
+    if has_sample_order(cur.connection):
+        runs = [
+            f"""
+            (SELECT d.name, {wl_column}
+            FROM (
+                SELECT * FROM wl_encodings_new
+                WHERE {SAMPLE_ORDER_COLUMN} {side} %s
+                ORDER BY {SAMPLE_ORDER_COLUMN}
+                LIMIT %s
+            ) AS w
+            JOIN {database_name} AS d ON d.name = w.theorem_name
+            {window})
+        """
+            for side in (">=", "<")
+        ]
+        start = random.random()
+        run_params = (start, SAMPLE_OVERSCAN * limit) + params
+        cur.execute(
+            " UNION ALL ".join(runs) + "LIMIT %s", run_params * 2 + (limit,)
+        )
+        rows = cur.fetchall()
+        if len(rows) == limit:
+            return rows
+
+    cur.execute(
+        f"""
+        SELECT d.name, {wl_column}
+        FROM {database_name} AS d
+        JOIN wl_encodings_new AS w ON d.name = w.theorem_name
+        {window}
+        ORDER BY RANDOM() LIMIT %s
+    """,
+        params + (limit,),
+    )
+    return cur.fetchall()
+
+
+def score_named_candidates(
+    candidate_names: list[str], target_encoding: dict, wl_iterations: int
+) -> list[tuple[str, float]] | None:
+    """WL scores of the named theorems, fetched in one query; None on a database error."""
+    try:
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT w.theorem_name, {wl_select_column(conn, wl_iterations)}
+                FROM wl_encodings_new AS w
+                WHERE w.theorem_name = ANY(%s)
+            """,
+                (candidate_names,),
+            )
+            batch = cur.fetchall()
+    except psycopg2.Error as e:
+        print(f"Database error: {e}")
+        logging.error(f"Database error: {e}")
+        return None
+    return [compute_wl_score(item, target_encoding) for item in batch]
+
+
 def load_filtered_theorems(
     target_name: str,
     database_name: str = "mathlib",
@@ -112,6 +296,14 @@ def load_filtered_theorems(
     use_clustering: bool = True,
     wl_iterations: int = 5,  # New parameter: Number of WL iterations
     debug: bool = False,
+    wl_index=None,
+    lsh_index=None,
+    wl_blend_alpha: float = 1.0,
+    corpus=None,
+    candidate_exprs: dict | None = None,
+    ivf_index=None,
+    n_probe: int | None = None,
+    deadline: float | None = None,
 ):
     """
     Load the top-k theorems filtered by node count and (optionally) clustering, ranked by WL score.
@@ -128,6 +320,25 @@ def load_filtered_theorems(
         use_clustering: Whether to use clustering model for filtering
         wl_iterations: Number of WL iterations to determine the WL encoding column
         debug: Whether to print debug information
+        wl_index: Optional WLInvertedIndex; when it matches wl_iterations and clustering
+            is off, top-k is taken from the index instead of scanning the node window
+        lsh_index: Optional WLLSHIndex; for node windows of at least lsh_index.min_window
+            theorems, only its candidates are scored exactly (approximate top-k)
+        wl_blend_alpha: Weight of the WL kernel against the collapse-match score; at 1.0
+            (pure WL) candidate expressions are neither fetched nor rebuilt as trees
+        corpus: Optional CorpusIndex; when loaded, retrieval runs entirely in memory
+        candidate_exprs: Optional dict, filled with name -> stored simp_tree (or
+            expr_cse_json) for the returned candidates already fetched during the
+            scan, so reranking does not query them again. Only the blended scan
+            (wl_blend_alpha < 1) fetches them; on every other path it stays empty
+            and reranking fetches the top_k by name in one query
+        ivf_index: Optional IVFIndex; with clustering on, or for node windows of at
+            least ivf_index.min_window theorems, only the members of the clusters
+            nearest to the target are scored (approximate top-k)
+        n_probe: Number of clusters probed in the IVF index, ivf_index.n_probe if None;
+            also replaces n_closest_clusters when clustering without the index
+        deadline: Optional time.monotonic() deadline; the node window scan stops
+            after the batch during which it passes and wl_stats["partial"] is set
 
     Returns:
         tuple: (filtered_results, wl_stats)
@@ -157,103 +368,154 @@ def load_filtered_theorems(
     print(f"Node count filter range: [{min_nodes}, {max_nodes}]")
     logging.info(f"Node count filter range: [{min_nodes}, {max_nodes}]")
 
-    all_candidates = []
-
+    if (
+        ivf_index is not None
+        and wl_blend_alpha >= 1
+        and ivf_index.wl_iterations == wl_iterations
+        and (
+            use_clustering
+            or ivf_index.window_size(min_nodes, max_nodes) >= ivf_index.min_window
+        )
+    ):
+        ids = ivf_index.query_ids(target_encoding, min_nodes, max_nodes, n_probe)
+        print(
+            f"IVF index: {len(ids)} candidate theorems in {n_probe or ivf_index.n_probe} clusters"
+        )
+        if ivf_index.corpus is not None and ivf_index.corpus is corpus:
+            all_candidates = corpus.wl_index.top_k(
+                target_encoding, top_k, min_nodes, max_nodes, allowed=ids
+            )
+        else:
+            all_candidates = score_named_candidates(
+                [ivf_index.names[i] for i in ids], target_encoding, wl_iterations
+            )
+            if all_candidates is None:
+                return [], {"wl_min": 0.0, "wl_max": 0.0, "wl_avg": 0.0}
+        return finalize_candidates(all_candidates, target_name, top_k, debug)
+
+    if (
+        corpus is not None
+        and not use_clustering
+        and corpus.wl_iterations == wl_iterations
+        and (wl_blend_alpha >= 1 or corpus.has_trees)
+    ):
+        all_candidates = corpus.wl_top_k(
+            target_encoding, top_k, min_nodes, max_nodes, target_tree, wl_blend_alpha
+        )
+        print(f"Corpus index: {len(all_candidates)} candidate theorems")
+        return finalize_candidates(all_candidates, target_name, top_k, debug)
+
+    if (
+        lsh_index is not None
+        and wl_blend_alpha >= 1
+        and not use_clustering
+        and lsh_index.wl_iterations == wl_iterations
+        and lsh_index.window_size(min_nodes, max_nodes) >= lsh_index.min_window
+    ):
+        candidate_names = lsh_index.query(target_encoding, min_nodes, max_nodes)
+        print(f"WL LSH index: {len(candidate_names)} candidate theorems")
+        all_candidates = score_named_candidates(
+            candidate_names, target_encoding, wl_iterations
+        )
+        if all_candidates is None:
+            return [], {"wl_min": 0.0, "wl_max": 0.0, "wl_avg": 0.0}
+        return finalize_candidates(all_candidates, target_name, top_k, debug)
+
+    if (
+        wl_index is not None
+        and wl_blend_alpha >= 1
+        and not use_clustering
+        and wl_index.wl_iterations == wl_iterations
+    ):
+        all_candidates = wl_index.top_k(target_encoding, top_k, min_nodes, max_nodes)
+        print(f"WL inverted index: {len(all_candidates)} candidate theorems")
+        return finalize_candidates(all_candidates, target_name, top_k, debug)
+
+    candidates = TopKCandidates(top_k, target_name)
+
+    conn = None
     try:
-        conn = connect_to_db()
+        conn = get_db_pool().getconn()
         cur = conn.cursor()
 
         # Dynamically generate WL encoding column name based on wl_iterations
         wl_column = f"w.simp_wl_encode_{wl_iterations}"
 
+        # Scan the denormalized search view (python -m search_app.migrations)
+        # instead of joining both tables when it is fresh and has the WL columns
+        wl_columns = {f"simp_wl_encode_{wl_iterations}"}
+        if has_packed_wl(conn, wl_iterations):
+            wl_columns.add(packed_wl_column(wl_iterations))
+        if (
+            database_name == "mathlib_filtered"
+            and wl_blend_alpha >= 1
+            and wl_columns <= search_view_columns(conn)
+        ):
+            window_source = f"{SEARCH_VIEW} AS d"
+            # The view only holds theorems with an expression
+            window_filter = "TRUE"
+            encodings = "d"
+        else:
+            window_source = f"""{database_name} AS d
+            JOIN wl_encodings_new AS w ON d.name = w.theorem_name"""
+            window_filter = "d.expr_cse_json != 'null'"
+            encodings = "w"
+
         if use_clustering:
-            # Load clustering model
-            try:
-                kmeans, feature_map, feature_weights, pca = load_kmeans_model()
-            except FileNotFoundError as e:
-                print(e)
-                logging.error(str(e))
+            # Clustering model, loaded once per process
+            model = get_cluster_model()
+            if model is None:
+                print("Clustering model files not found")
+                logging.error("Clustering model files not found")
                 return [], {"wl_min": 0.0, "wl_max": 0.0, "wl_avg": 0.0}
 
             # Predict target cluster
-            target_vector = wl_to_vector(
-                target_encoding, feature_map, feature_weights, max_features=5000
+            n_closest_clusters = n_probe or n_closest_clusters
+            closest_clusters = model.closest_clusters(
+                target_encoding, n_closest_clusters
             )
-            target_vector = pca.transform([target_vector])[0] if pca else target_vector
-            distances = kmeans.transform([target_vector])[0]
-            closest_clusters = np.argsort(distances)[:n_closest_clusters]
             logging.info(
                 f"Closest {n_closest_clusters} clusters: {closest_clusters.tolist()}"
             )
 
-            # Query total theorems matching node count and clusters
-            cur.execute(
-                f"""
-                SELECT COUNT(*)
-                FROM {database_name} AS d
-                JOIN wl_encodings_new AS w ON d.name = w.theorem_name
-                WHERE d.expr_cse_json != 'null'
-                AND d.simp_node_count BETWEEN %s AND %s
-                AND w.cluster_id = ANY(%s)
-            """,
-                (min_nodes, max_nodes, closest_clusters.tolist()),
-            )
+            cluster_filter = f"AND {encodings}.cluster_id = ANY(%s)"
+            params = (min_nodes, max_nodes, closest_clusters.tolist())
         else:
-            # Query total theorems matching node count only
-            cur.execute(
-                f"""
-                SELECT COUNT(*)
-                FROM {database_name} AS d
-                WHERE d.expr_cse_json != 'null'
-                AND d.simp_node_count BETWEEN %s AND %s
-            """,
-                (min_nodes, max_nodes),
-            )
-
-        total_filtered = cur.fetchone()[0]
-        print(
-            f"Filtered by node count{' and clustering' if use_clustering else ''}: {total_filtered} candidate theorems"
+            cluster_filter = ""
+            params = (min_nodes, max_nodes)
+
+        # Stream the node window through a server-side cursor instead of
+        # counting it first and paging with LIMIT/OFFSET
+        stream = conn.cursor(name="load_filtered_theorems")
+        # Smaller batches let fetching and scoring overlap
+        batch_size = min(batch_size, STREAM_BATCH_SIZE)
+        stream.itersize = batch_size
+        # The candidate tree is only needed to blend in the collapse-match score
+        expr_column = (
+            f", {simp_tree_columns(conn, database_name)}" if wl_blend_alpha < 1 else ""
         )
-        logging.info(
-            f"Filtered by node count{' and clustering' if use_clustering else ''}: {total_filtered} candidate theorems"
+        stream.execute(
+            f"""
+            SELECT d.name, {wl_select_column(conn, wl_iterations, encodings)}{expr_column}
+            FROM {window_source}
+            WHERE {window_filter}
+            AND d.simp_node_count BETWEEN %s AND %s
+            {cluster_filter}
+        """,
+            params,
         )
 
-        # Load in batches
-        for offset in range(0, total_filtered, batch_size):
-            if use_clustering:
-                cur.execute(
-                    f"""
-                    SELECT d.name, {wl_column}, d.expr_cse_json
-                    FROM {database_name} AS d
-                    JOIN wl_encodings_new AS w ON d.name = w.theorem_name
-                    WHERE d.expr_cse_json != 'null'
-                    AND d.simp_node_count BETWEEN %s AND %s
-                    AND w.cluster_id = ANY(%s)
-                    LIMIT %s OFFSET %s
-                """,
-                    (
-                        min_nodes,
-                        max_nodes,
-                        closest_clusters.tolist(),
-                        batch_size,
-                        offset,
-                    ),
-                )
-            else:
-                cur.execute(
-                    f"""
-                    SELECT d.name, {wl_column}, d.expr_cse_json
-                    FROM {database_name} AS d
-                    JOIN wl_encodings_new AS w ON d.name = w.theorem_name
-                    WHERE d.expr_cse_json != 'null'
-                    AND d.simp_node_count BETWEEN %s AND %s
-                    ORDER BY d.name
-                    LIMIT %s OFFSET %s
-                """,
-                    (min_nodes, max_nodes, batch_size, offset),
-                )
-
-            batch = cur.fetchall()
+        # Expressions of the best top_k candidates seen so far, when the scan
+        # fetches them anyway; fetching them only for reranking would send the
+        # whole window's trees instead of the top_k's
+        kept_exprs = {}
+        keep_exprs = wl_blend_alpha < 1 and candidate_exprs is not None
+        total_filtered = 0
+        partial = False
+        # The next batch streams in while the current one is being scored
+        for batch in iter_batches(stream, batch_size):
+            offset = total_filtered
+            total_filtered += len(batch)
             print(f"Batch {offset}: Loaded {len(batch)} records")
             logging.info(f"Batch {offset}: Loaded {len(batch)} records")
 
@@ -264,58 +526,69 @@ def load_filtered_theorems(
                 print(f"Did not find {target_name} in current batch")
                 logging.info(f"Did not find {target_name} in current batch")
 
-            # Compute WL scores in parallel
-            with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-                results = list(
-                    tqdm(
-                        executor.map(
-                            compute_wl_score_new,
-                            batch,
-                            [target_tree] * len(batch),
-                            [target_encoding] * len(batch),
-                        ),
-                        total=len(batch),
-                        desc=f"WL score computation Batch {offset}",
-                    )
-                )
-            all_candidates.extend(
+            # Compute WL scores in parallel; the target tree is only shipped
+            # to the workers when the blend uses it
+            results = map_chunked(
+                _wl_score_task,
+                batch,
+                shared=(
+                    target_tree if wl_blend_alpha < 1 else None,
+                    target_encoding,
+                    wl_blend_alpha,
+                ),
+                kind="wl_score",
+                desc=f"WL score computation Batch {offset}",
+            )
+            candidates.add(
                 [r for r in results if r[1] >= 0]
             )  # Keep only non-zero scores
+            if keep_exprs:
+                kept_exprs.update(
+                    (row[0], simp_tree_source(row[2], row[3])) for row in batch
+                )
+                if len(kept_exprs) > top_k:
+                    kept_exprs = {
+                        name: kept_exprs[name]
+                        for name in candidates.names()
+                        if name in kept_exprs
+                    }
+            if deadline is not None and time.monotonic() >= deadline:
+                print(f"Time budget expired after {total_filtered} records")
+                logging.info(f"Time budget expired after {total_filtered} records")
+                partial = True
+                break
+        stream.close()
+
+        print(
+            f"Filtered by node count{' and clustering' if use_clustering else ''}: {total_filtered} candidate theorems"
+        )
+        logging.info(
+            f"Filtered by node count{' and clustering' if use_clustering else ''}: {total_filtered} candidate theorems"
+        )
 
         # Global sampling if clustering is used and candidates are insufficient
-        if use_clustering and total_filtered < top_k:
+        if use_clustering and total_filtered < top_k and not partial:
             print("Insufficient candidates, initiating global sampling")
             logging.info("Insufficient candidates, initiating global sampling")
-            cur.execute(
-                f"""
-                SELECT d.name, {wl_column}
-                FROM {database_name} AS d
-                JOIN wl_encodings_new AS w ON d.name = w.theorem_name
-                WHERE d.expr_cse_json != 'null'
-                AND d.simp_node_count BETWEEN %s AND %s
-                AND (w.cluster_id IS NULL OR w.cluster_id != ALL(%s))
-                ORDER BY RANDOM()
-                LIMIT %s
-            """,
-                (min_nodes, max_nodes, closest_clusters.tolist(), 5000),
+            random_batch = sample_window(
+                cur,
+                database_name,
+                wl_select_column(conn, wl_iterations),
+                min_nodes,
+                max_nodes,
+                closest_clusters.tolist(),
+                GLOBAL_SAMPLE_SIZE,
             )
-            random_batch = cur.fetchall()
             print(f"Global sampling: Loaded {len(random_batch)} records")
             logging.info(f"Global sampling: Loaded {len(random_batch)} records")
 
-            with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-                results = list(
-                    tqdm(
-                        executor.map(
-                            compute_wl_score,
-                            random_batch,
-                            [target_encoding] * len(random_batch),
-                        ),
-                        total=len(random_batch),
-                        desc="Global sampling WL score computation",
-                    )
-                )
-            all_candidates.extend([r for r in results if r[1] > 0])
+            results = map_chunked(
+                compute_wl_score,
+                random_batch,
+                shared=target_encoding,
+                desc="Global sampling WL score computation",
+            )
+            candidates.add([r for r in results if r[1] > 0])
 
         # Debug samples when clustering is used
         if debug and use_clustering:
@@ -342,54 +615,27 @@ def load_filtered_theorems(
                     )
 
         cur.close()
-        conn.close()
-
-        # Sort and take top_k
-        all_candidates.sort(key=lambda x: x[1], reverse=True)
-        index = next(
-            (
-                i
-                for i, (name, score) in enumerate(all_candidates)
-                if name == target_name
-            ),
-            -1,
-        )
 
-        if index != -1:
-            print(f"'{target_name}' ranked at position {index + 1} (index {index})")
-            if index + 1 > top_k:
-                return 0, False
-        else:
-            print(f"'{target_name}' not in candidate list")
-        filtered_results = all_candidates[: min(top_k, len(all_candidates))]
-
-        # Compute WL statistics
-        wl_scores = [x[1] for x in filtered_results] if filtered_results else [0.0]
-        wl_stats = {
-            "wl_min": min(wl_scores),
-            "wl_max": max(wl_scores),
-            "wl_avg": sum(wl_scores) / len(wl_scores) if wl_scores else 0.0,
-            "total_candidates": len(all_candidates),
-            "filtered_candidates": len(filtered_results),
-        }
-
-        if debug:
-            print(
-                f"WL scores - Min: {wl_stats['wl_min']:.2f}, Max: {wl_stats['wl_max']:.2f}, Avg: {wl_stats['wl_avg']:.2f}"
-            )
-            print(f"Pre-filter candidates: {len(all_candidates)}")
-            print(f"Post-filter candidates: {len(filtered_results)}")
-        print(f"Returning top-{top_k}: {len(filtered_results)} candidate theorems")
-        logging.info(
-            f"Returning top-{top_k}: {len(filtered_results)} candidate theorems"
+        filtered_results, wl_stats = finalize_candidates(
+            candidates, target_name, top_k, debug
         )
-
+        if keep_exprs and wl_stats:
+            candidate_exprs.update(
+                (name, kept_exprs[name])
+                for name, _ in filtered_results
+                if name in kept_exprs
+            )
+        if partial and wl_stats:
+            wl_stats["partial"] = True
         return filtered_results, wl_stats
 
     except psycopg2.Error as e:
         print(f"Database error: {e}")
         logging.error(f"Database error: {e}")
         return [], {"wl_min": 0.0, "wl_max": 0.0, "wl_avg": 0.0}
+    finally:
+        if conn is not None:
+            get_db_pool().putconn(conn)
 
 
 def check_target_existence(
@@ -398,8 +644,9 @@ def check_target_existence(
     target_node_count: int = None,
     node_ratio: float = 1.2,
 ):
+    conn = None
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = get_db_pool().getconn()
         cur = conn.cursor()
 
         cur.execute(
@@ -427,7 +674,6 @@ def check_target_existence(
         if target_node_count is None:
             print("No target_node_count provided, skipping post-filtering check.")
             cur.close()
-            conn.close()
             return
 
         min_nodes = target_node_count / node_ratio
@@ -457,8 +703,10 @@ def check_target_existence(
             print(f"Filter range: [{min_nodes:.1f}, {max_nodes:.1f}]")
 
         cur.close()
-        conn.close()
 
     except psycopg2.Error as e:
         print(f"Database error: {e}")
         raise
+    finally:
+        if conn is not None:
+            get_db_pool().putconn(conn)
@@ -0,0 +1,336 @@
+import argparse
+import logging
+import math
+import os
+import pickle
+from array import array
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+from search_app.WL_embedding.db_utils import connect_to_db
+
+
+def default_index_path(wl_iterations: int = 3) -> str:
+    return f"wl_inverted_index_{wl_iterations}.pkl"
+
+
+class WLInvertedIndex:
+    """
+    Inverted index from WL features to the theorems containing them.
+
+    Each posting list stores theorem ids together with the feature count divided
+    by the theorem's WL norm, so the cosine score computed by compute_wl_kernel
+    is the sum over shared features of query weight times posting weight.
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        node_counts: np.ndarray,
+        norms: np.ndarray,
+        postings: dict[str, tuple[np.ndarray, np.ndarray]],
+        wl_iterations: int,
+        max_weights: dict[str, float] | None = None,
+    ):
+        self.names = names
+        self.node_counts = node_counts
+        self.norms = norms
+        self.postings = postings
+        self.wl_iterations = wl_iterations
+        # Largest posting weight per feature, the per-term score upper bound
+        self.max_weights = max_weights or {
+            feature: float(weights.max()) for feature, (_, weights) in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def from_encodings(
+        cls, records, wl_iterations: int, skip_empty: bool = True
+    ) -> "WLInvertedIndex":
+        """
+        Build the index from an iterable of (name, wl_encoding, simp_node_count).
+        Theorems with an empty encoding always score 0; they are skipped unless
+        skip_empty is False, which keeps theorem ids aligned with the records.
+        """
+        names = []
+        node_counts = array("i")
+        norms = array("d")
+        posting_ids = defaultdict(lambda: array("i"))
+        posting_weights = defaultdict(lambda: array("f"))
+
+        for name, wl_encoding, node_count in records:
+            norm = math.sqrt(sum(v * v for v in (wl_encoding or {}).values()))
+            if norm == 0 and skip_empty:
+                continue
+            theorem_id = len(names)
+            names.append(name)
+            node_counts.append(int(node_count))
+            norms.append(norm)
+            if norm == 0:
+                continue
+            for feature, count in wl_encoding.items():
+                posting_ids[feature].append(theorem_id)
+                posting_weights[feature].append(count / norm)
+
+        postings = {
+            feature: (
+                np.frombuffer(ids, dtype=np.int32).copy(),
+                np.frombuffer(posting_weights[feature], dtype=np.float32).copy(),
+            )
+            for feature, ids in posting_ids.items()
+        }
+        return cls(
+            names,
+            np.frombuffer(node_counts, dtype=np.int32).copy(),
+            np.frombuffer(norms, dtype=np.float64).copy(),
+            postings,
+            wl_iterations,
+        )
+
+    def to_arrays(self) -> tuple[list[str], dict[str, np.ndarray]]:
+        """
+        Feature list and flat arrays (all posting lists concatenated, with
+        offsets per feature) for storing the index in memory-mapped files.
+        """
+        features = list(self.postings)
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum([len(self.postings[f][0]) for f in features], out=offsets[1:])
+        empty_ids, empty_weights = np.empty(0, np.int32), np.empty(0, np.float32)
+        arrays = {
+            "wl_offsets": offsets,
+            "wl_ids": np.concatenate([empty_ids] + [self.postings[f][0] for f in features]),
+            "wl_weights": np.concatenate(
+                [empty_weights] + [self.postings[f][1] for f in features]
+            ),
+            "wl_max_weights": np.asarray(
+                [self.max_weights[f] for f in features], dtype=np.float32
+            ),
+            "wl_node_counts": self.node_counts,
+            "wl_norms": self.norms,
+        }
+        return features, arrays
+
+    @classmethod
+    def from_arrays(
+        cls,
+        names: list[str],
+        features: list[str],
+        arrays: dict[str, np.ndarray],
+        wl_iterations: int,
+    ) -> "WLInvertedIndex":
+        """Inverse of to_arrays; posting lists are views, so memory maps stay shared."""
+        offsets = arrays["wl_offsets"].tolist()
+        ids, weights = arrays["wl_ids"], arrays["wl_weights"]
+        postings = {
+            feature: (ids[offsets[i] : offsets[i + 1]], weights[offsets[i] : offsets[i + 1]])
+            for i, feature in enumerate(features)
+        }
+        max_weights = dict(zip(features, arrays["wl_max_weights"].tolist()))
+        return cls(
+            names,
+            arrays["wl_node_counts"],
+            arrays["wl_norms"],
+            postings,
+            wl_iterations,
+            max_weights,
+        )
+
+    def _query_terms(self, target_encoding: dict) -> list[tuple[str, float, float]]:
+        """(feature, query weight, score upper bound) by decreasing upper bound."""
+        if not target_encoding:
+            return []
+        query_norm = math.sqrt(sum(v * v for v in target_encoding.values()))
+        if query_norm == 0:
+            return []
+        terms = []
+        for feature, count in target_encoding.items():
+            if feature in self.postings:
+                query_weight = count / query_norm
+                terms.append(
+                    (feature, query_weight, query_weight * self.max_weights[feature])
+                )
+        terms.sort(key=lambda term: term[2], reverse=True)
+        return terms
+
+    def _window(
+        self,
+        min_nodes: float | None,
+        max_nodes: float | None,
+        allowed: np.ndarray | None = None,
+    ) -> np.ndarray | None:
+        """Mask of theorems in the node count window and, if given, in allowed (ids)."""
+        window = None
+        if min_nodes is not None or max_nodes is not None:
+            lower = min_nodes if min_nodes is not None else -np.inf
+            upper = max_nodes if max_nodes is not None else np.inf
+            window = (self.node_counts >= lower) & (self.node_counts <= upper)
+        if allowed is not None:
+            mask = np.zeros(len(self.names), dtype=bool)
+            mask[allowed] = True
+            window = mask if window is None else window & mask
+        return window
+
+    def scores(
+        self,
+        target_encoding: dict,
+        min_nodes: float | None = None,
+        max_nodes: float | None = None,
+        allowed: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Exact WL cosine score of every theorem, 0 outside the node count window."""
+        scores = np.zeros(len(self.names), dtype=np.float64)
+        window = self._window(min_nodes, max_nodes, allowed)
+        for feature, query_weight, _ in self._query_terms(target_encoding):
+            ids, weights = self.postings[feature]
+            if window is not None:
+                keep = window[ids]
+                ids, weights = ids[keep], weights[keep]
+            scores[ids] += query_weight * weights
+        return np.minimum(scores, 1.0)
+
+    def top_k(
+        self,
+        target_encoding: dict,
+        k: int,
+        min_nodes: float | None = None,
+        max_nodes: float | None = None,
+        allowed: np.ndarray | None = None,
+    ) -> list[tuple[str, float]]:
+        """
+        Return the k theorems with the highest WL cosine score to the target,
+        restricted to the node count window (and to the ids in allowed, if
+        given), best first.
+
+        Query terms are processed in decreasing order of their score upper bound
+        (MaxScore). Once the k-th best partial score exceeds the summed upper
+        bounds of the remaining terms, no unseen theorem can enter the top k, so
+        the remaining posting lists only update theorems already in the running.
+        Theorems sharing no feature with the target are never touched; when
+        fewer than k others are in the window, the result is filled up with
+        them at score 0 in id order, as the full scan also keeps zero scores.
+        """
+        if k <= 0:
+            return []
+        terms = self._query_terms(target_encoding)
+        window = self._window(min_nodes, max_nodes, allowed)
+
+        scores = np.zeros(len(self.names), dtype=np.float64)
+        in_running = np.zeros(len(self.names), dtype=bool)
+        remaining = sum(term[2] for term in terms)
+        pruning = False
+        touched = 0
+
+        for feature, query_weight, upper_bound in terms:
+            ids, weights = self.postings[feature]
+            if window is not None:
+                keep = window[ids]
+                ids, weights = ids[keep], weights[keep]
+            if pruning:
+                keep = in_running[ids]
+                ids, weights = ids[keep], weights[keep]
+            else:
+                in_running[ids] = True
+            touched += len(ids)
+            scores[ids] += query_weight * weights
+            remaining = max(0.0, remaining - upper_bound)
+
+            running = np.flatnonzero(in_running)
+            if len(running) < k:
+                continue
+            threshold = np.partition(scores[running], len(running) - k)[
+                len(running) - k
+            ]
+            if remaining < threshold:
+                pruning = True
+                in_running[running[scores[running] + remaining < threshold]] = False
+
+        running = np.flatnonzero(in_running)
+        if len(running) > k:
+            running = running[np.argpartition(-scores[running], k - 1)[:k]]
+        running = running[np.argsort(-scores[running], kind="stable")]
+        if len(running) < k:
+            # Nothing was pruned, so every theorem left out scores 0
+            unseen = ~in_running if window is None else window & ~in_running
+            running = np.concatenate(
+                [running, np.flatnonzero(unseen)[: k - len(running)]]
+            )
+        logging.info(
+            f"WL inverted index: {len(terms)} query terms, {touched} postings touched, "
+            f"{len(running)} results"
+        )
+        return [(self.names[i], min(1.0, float(scores[i]))) for i in running]
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_inverted_index(path: str) -> WLInvertedIndex | None:
+    """Load a previously built index, or None when it has not been built."""
+    if not os.path.exists(path):
+        logging.info(f"No WL inverted index at {path}, falling back to full scan")
+        return None
+    with open(path, "rb") as f:
+        index = pickle.load(f)
+    print(f"Loaded WL inverted index from {path}: {len(index)} theorems")
+    return index
+
+
+def iter_wl_encodings(
+    database_name: str = "mathlib_filtered",
+    wl_iterations: int = 3,
+    batch_size: int = 10000,
+):
+    conn = connect_to_db()
+    cur = conn.cursor(name="iter_wl_encodings")
+    cur.itersize = batch_size
+    cur.execute(
+        f"""
+        SELECT w.theorem_name, w.simp_wl_encode_{wl_iterations}, d.simp_node_count
+        FROM {database_name} AS d
+        JOIN wl_encodings_new AS w ON d.name = w.theorem_name
+        WHERE d.expr_cse_json != 'null'
+    """
+    )
+    try:
+        while True:
+            batch = cur.fetchmany(batch_size)
+            if not batch:
+                break
+            yield from batch
+    finally:
+        cur.close()
+        conn.close()
+
+
+def build_inverted_index(
+    database_name: str = "mathlib_filtered",
+    wl_iterations: int = 3,
+    output_path: str | None = None,
+) -> WLInvertedIndex:
+    output_path = output_path or default_index_path(wl_iterations)
+    records = tqdm(
+        iter_wl_encodings(database_name, wl_iterations), desc="Indexing WL encodings"
+    )
+    index = WLInvertedIndex.from_encodings(records, wl_iterations)
+    index.save(output_path)
+    print(
+        f"Saved WL inverted index to {output_path}: {len(index)} theorems, "
+        f"{len(index.postings)} features"
+    )
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the WL feature inverted index used for top-k retrieval"
+    )
+    parser.add_argument("--database-name", default="mathlib_filtered")
+    parser.add_argument("--wl-iterations", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    build_inverted_index(args.database_name, args.wl_iterations, args.output)
@@ -0,0 +1,216 @@
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from search_app.WL_embedding.db_utils import connect_to_db, iter_batches
+
+KMEANS_MODEL_PATH = "kmeans_model.pkl"
+FEATURE_MAP_PATH = "feature_map.pkl"
+FEATURE_WEIGHTS_PATH = "feature_weights.pkl"
+PCA_MODEL_PATH = "pca_model.pkl"
+
+
+class ClusterModel:
+    """
+    The k-means model trained by cluster_wl.py with its feature map, feature
+    weights and optional PCA, turning a WL encoding into its nearest clusters.
+    """
+
+    def __init__(
+        self, kmeans, feature_map: dict, feature_weights: dict, pca, max_features: int = 5000
+    ):
+        self.kmeans = kmeans
+        self.pca = pca
+        self.n_clusters = int(kmeans.cluster_centers_.shape[0])
+        self.dim = min(len(feature_map), max_features)
+        # feature -> (column, weight), same vector as wl_to_vector
+        self.columns = {
+            feature: (
+                column,
+                feature_weights.get(feature, 1.0) if feature_weights else 1.0,
+            )
+            for feature, column in feature_map.items()
+            if column < max_features
+        }
+
+    def vector(self, wl_encoding: dict) -> np.ndarray:
+        vector = np.zeros(self.dim)
+        for feature, count in wl_encoding.items():
+            column = self.columns.get(feature)
+            if column is not None:
+                vector[column[0]] = count * column[1]
+        return vector
+
+    def closest_clusters(self, wl_encoding: dict, n_probe: int) -> np.ndarray:
+        """The n_probe cluster ids nearest to the encoding, nearest first."""
+        vector = self.vector(wl_encoding)
+        if self.pca is not None:
+            vector = self.pca.transform([vector])[0]
+        distances = self.kmeans.transform([vector])[0]
+        n_probe = max(1, min(n_probe, len(distances)))
+        closest = np.argpartition(distances, n_probe - 1)[:n_probe]
+        return closest[np.argsort(distances[closest], kind="stable")]
+
+
+_cluster_model: ClusterModel | None = None
+
+
+def get_cluster_model() -> ClusterModel | None:
+    """The clustering model, loaded from disk on first use; None if not trained."""
+    global _cluster_model
+    if _cluster_model is None:
+        paths = [KMEANS_MODEL_PATH, FEATURE_MAP_PATH, FEATURE_WEIGHTS_PATH]
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing:
+            logging.info(f"No clustering model ({', '.join(missing)} missing)")
+            return None
+        models = []
+        for path in paths:
+            with open(path, "rb") as f:
+                models.append(pickle.load(f))
+        pca = None
+        if os.path.exists(PCA_MODEL_PATH):
+            with open(PCA_MODEL_PATH, "rb") as f:
+                pca = pickle.load(f)
+        _cluster_model = ClusterModel(*models, pca)
+    return _cluster_model
+
+
+class IVFIndex:
+    """
+    Inverted file over the k-means clusters: the member theorem ids of every
+    cluster, held in memory. A query probes the n_probe clusters nearest to
+    the target and only scores their members within the node count window.
+    Built over the corpus index its ids are corpus ids; otherwise it carries
+    its own name list.
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        node_counts: np.ndarray,
+        cluster_ids: np.ndarray,
+        model: ClusterModel,
+        n_probe: int = 64,
+        min_window: int = 20000,
+        corpus=None,
+    ):
+        self.names = names
+        self.node_counts = node_counts
+        self.model = model
+        self.n_probe = n_probe
+        self.min_window = min_window
+        self.corpus = corpus
+        # Features of the model come from simp_wl_encode_3
+        self.wl_iterations = 3
+        clustered = np.flatnonzero(cluster_ids >= 0)
+        order = clustered[np.argsort(cluster_ids[clustered], kind="stable")]
+        self.members = order.astype(np.int32)
+        counts = np.bincount(cluster_ids[clustered], minlength=model.n_clusters)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    @classmethod
+    def from_corpus(cls, corpus, model: ClusterModel, **kwargs) -> "IVFIndex | None":
+        if "cluster_ids" not in corpus.arrays:
+            return None
+        return cls(
+            corpus.names,
+            corpus.simp_node_counts,
+            np.asarray(corpus.arrays["cluster_ids"]),
+            model,
+            corpus=corpus,
+            **kwargs,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        model: ClusterModel,
+        database_name: str = "mathlib_filtered",
+        batch_size: int = 50000,
+        **kwargs,
+    ) -> "IVFIndex":
+        conn = connect_to_db()
+        stream = conn.cursor(name="ivf_index_load")
+        stream.itersize = batch_size
+        stream.execute(
+            f"""
+            SELECT w.theorem_name, d.simp_node_count, w.cluster_id
+            FROM {database_name} AS d
+            JOIN wl_encodings_new AS w ON d.name = w.theorem_name
+            WHERE d.expr_cse_json != 'null' AND w.cluster_id IS NOT NULL
+        """
+        )
+        names, node_counts, cluster_ids = [], [], []
+        for batch in iter_batches(stream, batch_size):
+            for name, node_count, cluster_id in batch:
+                names.append(name)
+                node_counts.append(node_count)
+                cluster_ids.append(cluster_id)
+        stream.close()
+        conn.close()
+        return cls(
+            names,
+            np.asarray(node_counts, dtype=np.int32),
+            np.asarray(cluster_ids, dtype=np.int32),
+            model,
+            **kwargs,
+        )
+
+    def window_size(self, min_nodes: float, max_nodes: float) -> int:
+        return int(
+            np.count_nonzero(
+                (self.node_counts >= min_nodes) & (self.node_counts <= max_nodes)
+            )
+        )
+
+    def query_ids(
+        self,
+        target_encoding: dict,
+        min_nodes: float,
+        max_nodes: float,
+        n_probe: int | None = None,
+    ) -> np.ndarray:
+        clusters = self.model.closest_clusters(target_encoding, n_probe or self.n_probe)
+        ids = np.concatenate(
+            [np.empty(0, dtype=np.int32)]
+            + [self.members[self.offsets[c] : self.offsets[c + 1]] for c in clusters]
+        )
+        node_counts = self.node_counts[ids]
+        return ids[(node_counts >= min_nodes) & (node_counts <= max_nodes)]
+
+    def query(
+        self,
+        target_encoding: dict,
+        min_nodes: float,
+        max_nodes: float,
+        n_probe: int | None = None,
+    ) -> list[str]:
+        ids = self.query_ids(target_encoding, min_nodes, max_nodes, n_probe)
+        return [self.names[i] for i in ids]
+
+
+def load_ivf_index(corpus=None, **kwargs) -> IVFIndex | None:
+    """IVF index over the corpus index if given, else from the database; None without a model."""
+    model = get_cluster_model()
+    if model is None:
+        return None
+    try:
+        index = (
+            IVFIndex.from_corpus(corpus, model, **kwargs)
+            if corpus is not None
+            else IVFIndex.load(model, **kwargs)
+        )
+    except Exception as e:
+        print(f"Failed to load IVF index: {e}")
+        logging.error(f"Failed to load IVF index: {e}")
+        return None
+    if index is not None:
+        print(f"Loaded IVF index: {len(index)} theorems in {model.n_clusters} clusters")
+    return index
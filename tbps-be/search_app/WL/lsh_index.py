@@ -0,0 +1,299 @@
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import random
+import time
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+from search_app.WL.inverted_index import iter_wl_encodings
+from search_app.WL_embedding.wl_kernel import compute_wl_kernel
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def default_lsh_path(wl_iterations: int = 3) -> str:
+    return f"wl_lsh_index_{wl_iterations}.pkl"
+
+
+def _element_hash(element: str) -> int:
+    return int(hashlib.md5(element.encode()).hexdigest()[:8], 16) % MERSENNE_PRIME
+
+
+class WeightedMinHash:
+    """
+    MinHash over a WL feature multiset. A feature with count c is expanded into
+    the elements (feature, 0) ... (feature, c - 1), so the probability that two
+    signatures agree at a position equals their weighted Jaccard similarity.
+    """
+
+    def __init__(self, num_perm: int = 64, seed: int = 42):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+
+    def signature(self, wl_encoding: dict) -> np.ndarray:
+        elements = np.fromiter(
+            (
+                _element_hash(f"{feature}#{i}")
+                for feature, count in wl_encoding.items()
+                for i in range(int(count))
+            ),
+            dtype=np.uint64,
+        )
+        if len(elements) == 0:
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint32)
+        hashed = (np.outer(self.a, elements) + self.b[:, None]) % MERSENNE_PRIME
+        return hashed.min(axis=1).astype(np.uint32)
+
+
+class WLLSHIndex:
+    """
+    Banded LSH tables over weighted MinHash signatures of the WL encodings.
+
+    More bands (fewer rows per band) return more candidates: higher recall at a
+    higher exact-scoring cost. Queries are only routed through LSH when the node
+    count window holds at least min_window theorems; smaller windows are cheap
+    enough to score exactly.
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        node_counts: np.ndarray,
+        signatures: np.ndarray,
+        minhash: WeightedMinHash,
+        wl_iterations: int,
+        bands: int = 16,
+        min_window: int = 20000,
+    ):
+        self.names = names
+        self.node_counts = node_counts
+        self.signatures = signatures
+        self.minhash = minhash
+        self.wl_iterations = wl_iterations
+        self.min_window = min_window
+        self.set_bands(bands)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def set_bands(self, bands: int, exclude: np.ndarray | None = None):
+        """(Re)build the band tables, optionally leaving out some theorem ids."""
+        if bands <= 0 or self.minhash.num_perm % bands != 0:
+            raise ValueError(
+                f"bands must divide num_perm ({self.minhash.num_perm}), got {bands}"
+            )
+        self.bands = bands
+        self.rows = self.minhash.num_perm // bands
+        skip = set(exclude.tolist()) if exclude is not None else set()
+        tables = []
+        for band in range(bands):
+            buckets = defaultdict(list)
+            keys = self.signatures[:, band * self.rows : (band + 1) * self.rows]
+            for theorem_id in range(len(self.names)):
+                if theorem_id not in skip:
+                    buckets[keys[theorem_id].tobytes()].append(theorem_id)
+            tables.append(
+                {key: np.asarray(ids, dtype=np.int32) for key, ids in buckets.items()}
+            )
+        self.tables = tables
+
+    def window_size(self, min_nodes: float, max_nodes: float) -> int:
+        return int(
+            np.count_nonzero(
+                (self.node_counts >= min_nodes) & (self.node_counts <= max_nodes)
+            )
+        )
+
+    def query_ids(
+        self,
+        target_encoding: dict,
+        min_nodes: float | None = None,
+        max_nodes: float | None = None,
+    ) -> np.ndarray:
+        signature = self.minhash.signature(target_encoding)
+        hits = []
+        for band, table in enumerate(self.tables):
+            key = signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            if key in table:
+                hits.append(table[key])
+        if not hits:
+            return np.empty(0, dtype=np.int32)
+        ids = np.unique(np.concatenate(hits))
+        if min_nodes is not None:
+            ids = ids[self.node_counts[ids] >= min_nodes]
+        if max_nodes is not None:
+            ids = ids[self.node_counts[ids] <= max_nodes]
+        return ids
+
+    def query(
+        self,
+        target_encoding: dict,
+        min_nodes: float | None = None,
+        max_nodes: float | None = None,
+    ) -> list[str]:
+        """Candidate theorem names likely to share many WL features with the target."""
+        ids = self.query_ids(target_encoding, min_nodes, max_nodes)
+        return [self.names[i] for i in ids]
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_lsh_index(path: str) -> WLLSHIndex | None:
+    """Load a previously built LSH index, or None when it has not been built."""
+    if not os.path.exists(path):
+        logging.info(f"No WL LSH index at {path}, LSH candidate generation disabled")
+        return None
+    with open(path, "rb") as f:
+        index = pickle.load(f)
+    print(
+        f"Loaded WL LSH index from {path}: {len(index)} theorems, "
+        f"{index.bands} bands x {index.rows} rows"
+    )
+    return index
+
+
+def load_wl_corpus(database_name: str = "mathlib_filtered", wl_iterations: int = 3):
+    names, encodings, node_counts = [], [], []
+    for name, wl_encoding, node_count in tqdm(
+        iter_wl_encodings(database_name, wl_iterations), desc="Loading WL encodings"
+    ):
+        if not wl_encoding:
+            continue
+        names.append(name)
+        encodings.append(wl_encoding)
+        node_counts.append(node_count)
+    return names, encodings, np.asarray(node_counts, dtype=np.int32)
+
+
+def build_lsh_index(
+    names: list[str],
+    encodings: list[dict],
+    node_counts: np.ndarray,
+    wl_iterations: int = 3,
+    num_perm: int = 64,
+    bands: int = 16,
+    min_window: int = 20000,
+) -> WLLSHIndex:
+    minhash = WeightedMinHash(num_perm)
+    signatures = np.empty((len(names), num_perm), dtype=np.uint32)
+    for i, wl_encoding in enumerate(tqdm(encodings, desc="MinHash signatures")):
+        signatures[i] = minhash.signature(wl_encoding)
+    return WLLSHIndex(
+        names, node_counts, signatures, minhash, wl_iterations, bands, min_window
+    )
+
+
+def recall_report(
+    index: WLLSHIndex,
+    encodings: list[dict],
+    n_queries: int = 200,
+    k: int = 20,
+    band_options: tuple[int, ...] = (4, 8, 16, 32),
+    node_ratio: float = 1.2,
+    node_diff: int = 25,
+    seed: int = 0,
+):
+    """
+    Compare LSH candidates followed by exact WL scoring against exact WL scoring
+    of the whole node window, on a held-out query set. Held-out theorems are
+    removed from the band tables and from the exact baseline.
+    """
+    rng = random.Random(seed)
+    held_out = np.asarray(
+        sorted(rng.sample(range(len(index)), min(n_queries, len(index)))),
+        dtype=np.int32,
+    )
+    is_held_out = np.zeros(len(index), dtype=bool)
+    is_held_out[held_out] = True
+
+    exact = {}
+    exact_seconds = 0.0
+    for query_id in tqdm(held_out, desc="Exact WL scoring"):
+        node_count = index.node_counts[query_id]
+        min_nodes = max(0, min(node_count / node_ratio, node_count - node_diff))
+        max_nodes = max(node_count * node_ratio, node_count + node_diff)
+        start = time.perf_counter()
+        window = np.flatnonzero(
+            (index.node_counts >= min_nodes)
+            & (index.node_counts <= max_nodes)
+            & ~is_held_out
+        )
+        scores = [
+            compute_wl_kernel(encodings[query_id], encodings[i]) for i in window
+        ]
+        order = np.argsort(scores)[::-1][:k]
+        exact_seconds += time.perf_counter() - start
+        exact[int(query_id)] = (min_nodes, max_nodes, set(window[order].tolist()))
+
+    print(
+        f"Exact: {len(held_out)} queries, "
+        f"{1000 * exact_seconds / len(held_out):.1f} ms/query"
+    )
+    print(f"{'bands':>6} {'rows':>5} {'recall@' + str(k):>10} {'candidates':>11} {'ms/query':>9}")
+    for bands in band_options:
+        index.set_bands(bands, exclude=held_out)
+        hits = 0
+        total = 0
+        candidates = 0
+        lsh_seconds = 0.0
+        for query_id, (min_nodes, max_nodes, truth) in exact.items():
+            start = time.perf_counter()
+            ids = index.query_ids(encodings[query_id], min_nodes, max_nodes)
+            scores = [compute_wl_kernel(encodings[query_id], encodings[i]) for i in ids]
+            found = set(ids[np.argsort(scores)[::-1][:k]].tolist()) if len(ids) else set()
+            lsh_seconds += time.perf_counter() - start
+            hits += len(found & truth)
+            total += len(truth)
+            candidates += len(ids)
+        recall = hits / total if total else 0.0
+        print(
+            f"{bands:>6} {index.rows:>5} {recall:>10.4f} "
+            f"{candidates / len(exact):>11.1f} {1000 * lsh_seconds / len(exact):>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build or evaluate the weighted MinHash LSH index over WL encodings"
+    )
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--database-name", default="mathlib_filtered")
+    parser.add_argument("--wl-iterations", type=int, default=3)
+    parser.add_argument("--num-perm", type=int, default=64)
+    parser.add_argument("--bands", type=int, default=16)
+    parser.add_argument("--min-window", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    names, encodings, node_counts = load_wl_corpus(
+        args.database_name, args.wl_iterations
+    )
+    index = build_lsh_index(
+        names,
+        encodings,
+        node_counts,
+        args.wl_iterations,
+        args.num_perm,
+        args.bands,
+        args.min_window,
+    )
+    if args.command == "build":
+        output_path = args.output or default_lsh_path(args.wl_iterations)
+        index.save(output_path)
+        print(f"Saved WL LSH index to {output_path}")
+    else:
+        band_options = tuple(
+            b for b in (4, 8, 16, 32, 64) if args.num_perm % b == 0
+        )
+        recall_report(index, encodings, args.queries, args.k, band_options)
@@ -0,0 +1,157 @@
+import argparse
+import json
+from typing import Optional
+
+from psycopg2.extras import execute_values
+from tqdm import tqdm
+
+from search_app.compute.wl_codec import encode_wl_bytes
+from search_app.WL_embedding.db_utils import connect_to_db
+
+
+def packed_wl_column(wl_iterations: int) -> str:
+    """bytea column holding the packed form of simp_wl_encode_{wl_iterations}."""
+    return f"simp_wl_packed_{wl_iterations}"
+
+
+_has_packed_wl: dict[int, bool] = {}
+
+
+def has_packed_wl(conn, wl_iterations: int) -> bool:
+    """Whether store_packed_wl has added the packed column (checked once)."""
+    if wl_iterations not in _has_packed_wl:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'wl_encodings_new' AND column_name = %s
+            """,
+                (packed_wl_column(wl_iterations),),
+            )
+            _has_packed_wl[wl_iterations] = cur.fetchone() is not None
+    return _has_packed_wl[wl_iterations]
+
+
+def wl_select_column(conn, wl_iterations: int, alias: str = "w") -> str:
+    """
+    SELECT expression for the WL encoding of wl_encodings_new: the packed
+    buffer when store_packed_wl has been run, with the JSONB sent as text
+    bytes for rows not packed yet; the JSONB column alone otherwise. Score the
+    value with stored_wl_kernel.
+    """
+    json_column = f"{alias}.simp_wl_encode_{wl_iterations}"
+    if has_packed_wl(conn, wl_iterations):
+        return (
+            f"COALESCE({alias}.{packed_wl_column(wl_iterations)}, "
+            f"convert_to({json_column}::text, 'UTF8'))"
+        )
+    return json_column
+
+
+def store_wl_encoding(
+    cur, wl_iterations: int, theorem_name: str, serialized_encoding: str
+):
+    """
+    Write a recomputed simp_wl_encode_{wl_iterations} of one theorem. When the
+    packed column exists its buffer is rewritten in the same UPDATE, since
+    wl_select_column prefers it over the JSONB.
+    """
+    json_column = f"simp_wl_encode_{wl_iterations}"
+    if has_packed_wl(cur.connection, wl_iterations):
+        cur.execute(
+            f"""
+            UPDATE wl_encodings_new
+            SET {json_column} = %s, {packed_wl_column(wl_iterations)} = %s
+            WHERE theorem_name = %s
+        """,
+            (
+                serialized_encoding,
+                encode_wl_bytes(json.loads(serialized_encoding)),
+                theorem_name,
+            ),
+        )
+    else:
+        cur.execute(
+            f"""
+            UPDATE wl_encodings_new
+            SET {json_column} = %s
+            WHERE theorem_name = %s
+        """,
+            (serialized_encoding, theorem_name),
+        )
+
+
+def packed_wl_row(row: tuple) -> Optional[tuple]:
+    name, wl_encoding = row
+    if wl_encoding is None:
+        return None
+    return name, encode_wl_bytes(wl_encoding)
+
+
+def store_packed_wl(wl_iterations: int = 3, batch_size: int = 20000):
+    """
+    One-time ingest: store every simp_wl_encode_{wl_iterations} as a packed
+    buffer of feature hashes and counts, so queries neither transfer nor
+    decode the JSONB. encode.py keeps the buffers in step afterwards.
+    """
+    conn = connect_to_db()
+    if conn is None:
+        return
+    column = packed_wl_column(wl_iterations)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"ALTER TABLE wl_encodings_new ADD COLUMN IF NOT EXISTS {column} bytea"
+        )
+    conn.commit()
+    _has_packed_wl[wl_iterations] = True
+
+    last_name = None
+    stored = 0
+    with tqdm(desc=f"Packing simp_wl_encode_{wl_iterations}") as pbar:
+        while True:
+            after_last = "WHERE theorem_name > %s" if last_name is not None else ""
+            params = (last_name, batch_size) if last_name is not None else (batch_size,)
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT theorem_name, simp_wl_encode_{wl_iterations}
+                    FROM wl_encodings_new
+                    {after_last}
+                    ORDER BY theorem_name
+                    LIMIT %s
+                """,
+                    params,
+                )
+                batch = cur.fetchall()
+            if not batch:
+                break
+            last_name = batch[-1][0]
+            rows = [row for row in map(packed_wl_row, batch) if row is not None]
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    f"""
+                    UPDATE wl_encodings_new AS w
+                    SET {column} = v.packed
+                    FROM (VALUES %s) AS v (name, packed)
+                    WHERE w.theorem_name = v.name
+                """,
+                    rows,
+                    template="(%s, %s::bytea)",
+                )
+            conn.commit()
+            stored += len(rows)
+            pbar.update(len(batch))
+
+    conn.close()
+    print(f"Stored {stored} packed WL encodings in {column}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Store WL encodings as packed binary columns"
+    )
+    parser.add_argument("--wl-iterations", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=20000)
+    args = parser.parse_args()
+    store_packed_wl(args.wl_iterations, args.batch_size)
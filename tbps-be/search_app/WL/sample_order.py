@@ -0,0 +1,70 @@
+import argparse
+
+from search_app.WL_embedding.db_utils import connect_to_db
+
+# Uniform random key in [0, 1) per theorem; new rows get one by default
+SAMPLE_ORDER_COLUMN = "sample_order"
+
+_has_sample_order: dict[str, bool] = {}
+
+
+def has_sample_order(conn, table_name: str = "wl_encodings_new") -> bool:
+    """Whether store_sample_order has been run for table_name (checked once)."""
+    if table_name not in _has_sample_order:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = %s AND column_name = %s
+            """,
+                (table_name, SAMPLE_ORDER_COLUMN),
+            )
+            _has_sample_order[table_name] = cur.fetchone() is not None
+    return _has_sample_order[table_name]
+
+
+def store_sample_order(table_name: str = "wl_encodings_new"):
+    """
+    One-time setup for global sampling: give every row a random sample_order
+    and index it. A sample is then the rows following a random start in
+    sample_order, read through the index, instead of sorting the whole node
+    window by RANDOM(). Rerunning draws a new permutation.
+    """
+    conn = connect_to_db()
+    if conn is None:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            ALTER TABLE {table_name}
+            ADD COLUMN IF NOT EXISTS {SAMPLE_ORDER_COLUMN} double precision
+        """
+        )
+        cur.execute(f"UPDATE {table_name} SET {SAMPLE_ORDER_COLUMN} = random()")
+        cur.execute(
+            f"""
+            ALTER TABLE {table_name}
+            ALTER COLUMN {SAMPLE_ORDER_COLUMN} SET DEFAULT random()
+        """
+        )
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {table_name}_{SAMPLE_ORDER_COLUMN}_idx
+            ON {table_name} ({SAMPLE_ORDER_COLUMN})
+        """
+        )
+        cur.execute(f"ANALYZE {table_name}")
+        cur.execute(f"SELECT count(*) FROM {table_name}")
+        count = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    print(f"Stored {SAMPLE_ORDER_COLUMN} for {count} rows of {table_name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the random sample order used by global sampling"
+    )
+    parser.add_argument("--table-name", default="wl_encodings_new")
+    args = parser.parse_args()
+    store_sample_order(args.table_name)
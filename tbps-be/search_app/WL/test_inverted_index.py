@@ -0,0 +1,60 @@
+import random
+
+import pytest
+
+from search_app.WL.inverted_index import WLInvertedIndex
+from search_app.WL_embedding.wl_kernel import compute_wl_kernel
+
+FEATURES = [f"f{i}" for i in range(40)]
+
+
+def random_encoding(rng):
+    return {f: rng.randint(1, 6) for f in rng.sample(FEATURES, rng.randint(1, 10))}
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    rng = random.Random(0)
+    records = [(f"thm{i}", random_encoding(rng), rng.randint(5, 40)) for i in range(300)]
+    return records, WLInvertedIndex.from_encodings(records, 3), random_encoding(rng)
+
+
+def exact_top_k(records, target, k, min_nodes=None, max_nodes=None):
+    scored = [
+        (name, compute_wl_kernel(target, encoding))
+        for name, encoding, node_count in records
+        if (min_nodes is None or node_count >= min_nodes)
+        and (max_nodes is None or node_count <= max_nodes)
+    ]
+    return sorted(scored, key=lambda x: x[1], reverse=True)[:k]
+
+
+@pytest.mark.parametrize("k", [1, 10, 50])
+@pytest.mark.parametrize("window", [(None, None), (10, 25)])
+def test_top_k_matches_exact_ranking(corpus, k, window):
+    records, index, target = corpus
+    expected = exact_top_k(records, target, k, *window)
+    got = index.top_k(target, k, *window)
+    # Same scores; names may only differ between tied scores
+    assert [score for _, score in got] == pytest.approx(
+        [score for _, score in expected], abs=1e-6
+    )
+    tied_at_k = expected[-1][1]
+    assert {name for name, score in got if score > tied_at_k + 1e-6} == {
+        name for name, score in expected if score > tied_at_k + 1e-6
+    }
+
+
+def test_top_k_fills_up_with_zero_scores():
+    records = [
+        ("a", {"x": 1}, 5),
+        ("b", {"y": 2}, 5),
+        ("c", {"x": 1, "y": 1}, 5),
+        ("d", {"z": 1}, 50),
+        ("e", {"y": 1}, 5),
+    ]
+    index = WLInvertedIndex.from_encodings(records, 3)
+    got = index.top_k({"x": 1}, 4, max_nodes=10)
+    assert [name for name, _ in got] == ["a", "c", "b", "e"]
+    assert [score for _, score in got[2:]] == [0.0, 0.0]
+    assert len(index.top_k({"w": 1}, 3)) == 3
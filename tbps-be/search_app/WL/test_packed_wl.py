@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from search_app.WL import packed_wl
+from search_app.WL.packed_wl import store_wl_encoding, wl_select_column
+from search_app.WL_embedding.db_utils import connect_to_db, database_dsn
+from search_app.WL_embedding.wl_kernel import compute_wl_kernel
+from search_app.compute.wl_codec import encode_wl_bytes, stored_wl_kernel
+
+OLD = {"a": 2, "b": 1}
+NEW = {"b": 3, "c": 1}
+
+
+@pytest.fixture
+def conn():
+    if database_dsn() is None:
+        pytest.skip("TBPS_DATABASE_URL is not set")
+    conn = connect_to_db()
+    if conn is None:
+        pytest.skip("database unavailable")
+    with conn.cursor() as cur:
+        # Shadows any real wl_encodings_new for this session only
+        cur.execute(
+            """
+            CREATE TEMP TABLE wl_encodings_new (
+                theorem_name text PRIMARY KEY,
+                simp_wl_encode_3 jsonb,
+                simp_wl_packed_3 bytea
+            )
+        """
+        )
+        cur.execute(
+            "INSERT INTO wl_encodings_new VALUES (%s, %s, %s)",
+            ("thm", json.dumps(OLD), encode_wl_bytes(OLD)),
+        )
+    packed_wl._has_packed_wl.clear()
+    yield conn
+    packed_wl._has_packed_wl.clear()
+    conn.rollback()
+    conn.close()
+
+
+def test_reencode_rewrites_packed_buffer(conn):
+    with conn.cursor() as cur:
+        store_wl_encoding(cur, 3, "thm", json.dumps(NEW))
+        cur.execute(
+            f"SELECT {wl_select_column(conn, 3)} FROM wl_encodings_new AS w"
+        )
+        (stored,) = cur.fetchone()
+    target = {"b": 1, "c": 2}
+    assert stored_wl_kernel(target, stored) == pytest.approx(
+        compute_wl_kernel(target, NEW)
+    )
+    assert stored_wl_kernel(target, stored) != pytest.approx(
+        compute_wl_kernel(target, OLD)
+    )
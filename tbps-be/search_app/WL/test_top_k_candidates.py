@@ -0,0 +1,25 @@
+from search_app.WL.db_utils import TopKCandidates
+
+
+def test_ties_keep_arrival_order():
+    candidates = TopKCandidates(3)
+    candidates.add([("a", 0.5), ("b", 0.9), ("c", 0.5)])
+    candidates.add([("d", 0.5), ("e", 0.7)])
+    # As a stable sort of the whole stream: b, e, then a before c and d
+    assert candidates.ranked() == [("b", 0.9), ("e", 0.7), ("a", 0.5)]
+    assert len(candidates) == 5
+
+
+def test_matches_a_stable_sort():
+    stream = [(f"t{i}", (i * 7) % 5 / 4) for i in range(40)]
+    candidates = TopKCandidates(10)
+    for start in range(0, len(stream), 6):
+        candidates.add(stream[start : start + 6])
+    assert candidates.ranked() == sorted(stream, key=lambda x: x[1], reverse=True)[:10]
+
+
+def test_target_index_counts_earlier_ties():
+    candidates = TopKCandidates(2, target_name="c")
+    candidates.add([("a", 0.5), ("b", 0.9), ("c", 0.5), ("d", 0.5)])
+    assert candidates.target_index() == 2
+    assert TopKCandidates(2, target_name="z").target_index() == -1
@@ -1,42 +1,250 @@
 # db_utils.py
-import psycopg2
 import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 
+# libpq-style settings from the environment, defaulting to the local
+# development database
 DB_CONFIG = {
-    "host": "127.0.0.1",
-    "port": 8923,
-    "database": "mathlib_db",
-    "user": "postgres",
-    "password": "password"
+    "host": os.environ.get("PGHOST", "127.0.0.1"),
+    "port": int(os.environ.get("PGPORT", 8923)),
+    "database": os.environ.get("PGDATABASE", "mathlib_db"),
+    "user": os.environ.get("PGUSER", "postgres"),
+    "password": os.environ.get("PGPASSWORD", "password"),
 }
 
 
-def connect_to_db(config=DB_CONFIG):
+def _bytea_as_bytes(value, cur):
+    # psycopg2 returns memoryview, which cannot be sent to worker processes
+    buffer = psycopg2.BINARY(value, cur)
+    return bytes(buffer) if buffer is not None else None
+
+
+psycopg2.extensions.register_type(
+    psycopg2.extensions.new_type(psycopg2.BINARY.values, "BYTEA_BYTES", _bytea_as_bytes)
+)
+
+
+def database_dsn() -> str | None:
+    """Connection string from TBPS_DATABASE_URL, None to use DB_CONFIG."""
+    return os.environ.get("TBPS_DATABASE_URL") or None
+
+
+def connect_to_db(config=None):
+    """
+    Open a dedicated connection, for offline jobs that hold it for a long time.
+    The server's query path uses db_connection() instead.
+    """
     try:
-        conn = psycopg2.connect(**config)
-        print("Successfully connected to the database")
+        dsn = database_dsn() if config is None else None
+        conn = psycopg2.connect(dsn) if dsn else psycopg2.connect(**(config or DB_CONFIG))
+        logging.info("Successfully connected to the database")
         return conn
     except Exception as e:
-        print(f"Failed to connect to database: {e}")
+        logging.error(f"Failed to connect to database: {e}")
         return None
 
 
-def fetch_theorems_batch(conn, table_name, offset, batch_size):
+class ConnectionPool:
+    """
+    Blocking wrapper around psycopg2's ThreadedConnectionPool: callers wait
+    for a free connection instead of failing when all are checked out.
+    """
+
+    def __init__(self, min_size: int, max_size: int):
+        dsn = database_dsn()
+        self.pool = (
+            psycopg2.pool.ThreadedConnectionPool(min_size, max_size, dsn)
+            if dsn
+            else psycopg2.pool.ThreadedConnectionPool(min_size, max_size, **DB_CONFIG)
+        )
+        self.pid = os.getpid()
+        self.max_size = max_size
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.discarded = 0
+        self.errors = 0
+
+    def getconn(self):
+        start = time.perf_counter()
+        self.slots.acquire()
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            with self.lock:
+                self.errors += 1
+            raise
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return conn
+
+    def putconn(self, conn, broken: bool = False):
+        close = broken or conn.closed != 0
+        try:
+            if not close:
+                # End the read transaction so the connection is reusable
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        self.pool.putconn(conn, close=close)
+        with self.lock:
+            self.in_use -= 1
+            self.discarded += int(close)
+        self.slots.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "idle": len(self.pool._pool),
+                "checkouts": self.checkouts,
+                "avg_wait_ms": round(
+                    1000 * self.wait_seconds / self.checkouts if self.checkouts else 0.0, 3
+                ),
+                "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+                "discarded": self.discarded,
+                "errors": self.errors,
+            }
+
+    def close(self):
+        self.pool.closeall()
+
+
+_db_pool: ConnectionPool | None = None
+_db_pool_lock = threading.Lock()
+# Pools inherited from the parent by a forked process. Closing their
+# connections would send Terminate on the parent's sockets and end its
+# sessions, so they stay referenced, never closed, for the life of the process
+_inherited_db_pools: list[ConnectionPool] = []
+
+
+def default_db_pool_size() -> int:
+    return max(1, int(os.environ.get("TBPS_DB_POOL_SIZE", 8)))
+
+
+def get_db_pool() -> ConnectionPool:
+    """The process-wide pool, created on first use (and again after a fork)."""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.pid != os.getpid():
+            if _db_pool is not None:
+                _inherited_db_pools.append(_db_pool)
+            max_size = default_db_pool_size()
+            min_size = min(int(os.environ.get("TBPS_DB_POOL_MIN", 1)), max_size)
+            _db_pool = ConnectionPool(min_size, max_size)
+            logging.info(f"Database pool started with up to {_db_pool.max_size} connections")
+        return _db_pool
+
+
+def db_pool_stats() -> dict | None:
+    """Pool metrics, None if no pooled connection has been used yet."""
+    return _db_pool.stats() if _db_pool is not None else None
+
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; it is rolled back and returned on exit."""
+    pool = get_db_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, broken)
+
+
+def iter_batches(cursor, batch_size: int, prefetch: int = 2):
+    """
+    Yield cursor.fetchmany(batch_size) batches while a background thread
+    already fetches the following ones, so Postgres streams the next batch
+    while the caller processes the current one. At most prefetch batches
+    wait in the queue.
+    """
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            while not stop.is_set():
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                if not put(batch):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, name="iter_batches", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def fetch_theorems_batch(conn, table_name, last_name, batch_size):
+    """
+    Fetch the next batch ordered by name, starting after last_name (keyset
+    pagination, so each batch is an index range scan instead of re-reading all
+    preceding rows as OFFSET does). Pass last_name=None for the first batch.
+    """
     try:
         cur = conn.cursor()
+        after_last = "AND name > %s" if last_name is not None else ""
         query = f"""
             SELECT name, expr_cse_json
             FROM {table_name}
             WHERE expr_cse_json != 'null'
+            {after_last}
             ORDER BY name
-            LIMIT %s OFFSET %s
+            LIMIT %s
         """
-        cur.execute(query, (batch_size, offset))
+        params = (last_name, batch_size) if last_name is not None else (batch_size,)
+        cur.execute(query, params)
         theorems = cur.fetchall()
         cur.close()
         return theorems
     except Exception as e:
-        print(f"Batch extraction theorem failed (offset {offset}): {e}")
+        print(f"Batch extraction theorem failed (after {last_name}): {e}")
         return []
 
 
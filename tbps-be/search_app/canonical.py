@@ -0,0 +1,115 @@
+import hashlib
+import json
+import re
+from typing import Any
+
+from search_app.myexpr import (
+    YourExpr,
+    BVar,
+    FVar,
+    MVar,
+    Sort,
+    Const,
+    App,
+    Lam,
+    ForallE,
+    LetE,
+    MData,
+    Proj,
+    serialize_expr,
+)
+
+# Unique ids Lean gives metavariables and universe level metavariables, as in
+# "Lean.Name.mkNum `_uniq 71" or "?_uniq.71"
+_UNIQ_ID = re.compile(r"_uniq[ .](\d+)")
+
+
+class _Canonicalizer:
+    """Renaming state of one canonicalize call."""
+
+    def __init__(self):
+        self.fvars: dict[str, str] = {}
+        self.uniqs: dict[str, int] = {}
+
+    def rename_uniqs(self, value: Any) -> Any:
+        """value with its _uniq ids numbered by first occurrence."""
+        if isinstance(value, str):
+            return _UNIQ_ID.sub(self._uniq, value)
+        if isinstance(value, dict):
+            return {key: self.rename_uniqs(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.rename_uniqs(item) for item in value]
+        return value
+
+    def _uniq(self, match: re.Match) -> str:
+        number = self.uniqs.setdefault(match.group(1), len(self.uniqs))
+        return f"_uniq {number}"
+
+    def expr(self, expr: YourExpr, binders: list[str]) -> YourExpr:
+        # binders: names of the enclosing binders, innermost first
+        if isinstance(expr, BVar):
+            index = expr.deBruijnIndex
+            if isinstance(index, str):
+                # Named by deBruijn_to_bindername (as in cse output): the
+                # innermost binder of that name
+                index = binders.index(index) if index in binders else -1
+            return BVar(index)
+        elif isinstance(expr, FVar):
+            # Numbered by first occurrence, which also covers cse variables
+            if expr.fvarId not in self.fvars:
+                self.fvars[expr.fvarId] = f"v{len(self.fvars)}"
+            return FVar(self.fvars[expr.fvarId])
+        elif isinstance(expr, MVar):
+            return MVar(self.rename_uniqs(expr.mvarId))
+        elif isinstance(expr, Sort):
+            return Sort(self.rename_uniqs(expr.u))
+        elif isinstance(expr, Const):
+            return Const(expr.declName, self.rename_uniqs(expr.us))
+        elif isinstance(expr, App):
+            return App(self.expr(expr.fn, binders), self.expr(expr.arg, binders))
+        elif isinstance(expr, (Lam, ForallE)):
+            name = f"x{len(binders)}"
+            return type(expr)(
+                name,
+                self.expr(expr.binderType, binders),
+                self.expr(expr.body, [expr.binderName] + binders),
+                expr.binderInfo,
+            )
+        elif isinstance(expr, LetE):
+            name = f"x{len(binders)}"
+            inner = [expr.declName] + binders
+            # deBruijn_to_bindername resolves the value inside the binder too
+            return LetE(
+                name,
+                self.expr(expr.type, binders),
+                self.expr(expr.value, inner),
+                self.expr(expr.body, inner),
+                expr.nonDep,
+            )
+        elif isinstance(expr, MData):
+            return MData(expr.data, self.expr(expr.expr, binders))
+        elif isinstance(expr, Proj):
+            return Proj(expr.typeName, expr.idx, self.expr(expr.struct, binders))
+        else:
+            return expr
+
+
+def canonicalize(expr: YourExpr) -> YourExpr:
+    """
+    Representative of expr up to renaming: binders are named by depth and
+    bound variables referred to by de Bruijn index (whether expr uses indices
+    or, like cse output, binder names); free and cse variables are numbered
+    v0, v1, ... and metavariable and universe _uniq ids 0, 1, ... in order of
+    first occurrence. Alpha-equivalent expressions, and cse outputs of
+    alpha-equivalent expressions, have the same canonical form.
+
+    For cache keys and deduplication only: the names it drops are part of
+    the trees queries are scored with.
+    """
+    return _Canonicalizer().expr(expr, [])
+
+
+def canonical_key(expr: YourExpr) -> str:
+    """Hash of the canonical form of expr."""
+    data = json.dumps(serialize_expr(canonicalize(expr)), sort_keys=True)
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
@@ -38,22 +38,21 @@ def get_feature_map(
     total_count: int = 330000,
 ) -> tuple:
     conn = connect_to_db()
-    cur = conn.cursor()
+    cur = conn.cursor(name="get_feature_map")
+    cur.itersize = batch_size
 
     feature_counts = Counter()
     invalid_count = 0
     offset = 0
+    cur.execute(
+        f"""
+        SELECT simp_wl_encode_3 
+        FROM {table_name}
+        WHERE simp_wl_encode_3  IS NOT NULL
+    """
+    )
     while True:
-        cur.execute(
-            f"""
-            SELECT simp_wl_encode_3 
-            FROM {table_name}
-            WHERE simp_wl_encode_3  IS NOT NULL
-            LIMIT %s OFFSET %s
-        """,
-            (batch_size, offset),
-        )
-        batch = cur.fetchall()
+        batch = cur.fetchmany(batch_size)
         if not batch:
             break
         for (wl_json,) in batch:
@@ -67,7 +66,7 @@ def get_feature_map(
             except:
                 invalid_count += 1
                 continue
-        offset += batch_size
+        offset += len(batch)
         logging.info(
             f"Feature statistics: Processing {offset} entries, invalid {invalid_count} entries"
         )
@@ -139,19 +138,18 @@ def cluster_wl_encodings(
     pca = PCA(n_components=pca_components) if use_pca else None
 
     conn = connect_to_db()
-    cur = conn.cursor()
+    stream = conn.cursor(name="cluster_wl_train")
+    stream.itersize = batch_size
+    stream.execute(
+        f"""
+        SELECT theorem_name, simp_wl_encode_3 
+        FROM {table_name}
+    """
+    )
     offset = 0
     total_processed = 0
     while True:
-        cur.execute(
-            f"""
-            SELECT theorem_name, simp_wl_encode_3 
-            FROM {table_name}
-            LIMIT %s OFFSET %s
-        """,
-            (batch_size, offset),
-        )
-        batch = cur.fetchall()
+        batch = stream.fetchmany(batch_size)
         if not batch:
             break
 
@@ -175,27 +173,36 @@ def cluster_wl_encodings(
             kmeans.partial_fit(X)
             total_processed += valid_count
 
-        offset += batch_size
+        offset += len(batch)
+    stream.close()
 
     with open("kmeans_model.pkl", "wb") as f:
         pickle.dump(kmeans, f)
     with open("pca_model.pkl", "wb") as f:
         pickle.dump(pca, f) if pca else None
 
+    cur = conn.cursor()
     cur.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS cluster_id INTEGER")
+    # Keyset pagination: each batch commits its cluster ids, so a server-side
+    # cursor would not survive, and OFFSET would re-read all earlier rows
     offset = 0
+    last_name = None
     while True:
+        after_last = "WHERE theorem_name > %s" if last_name is not None else ""
         cur.execute(
             f"""
             SELECT theorem_name, simp_wl_encode_3 
             FROM {table_name}
-            LIMIT %s OFFSET %s
+            {after_last}
+            ORDER BY theorem_name
+            LIMIT %s
         """,
-            (batch_size, offset),
+            (last_name, batch_size) if last_name is not None else (batch_size,),
         )
         batch = cur.fetchall()
         if not batch:
             break
+        last_name = batch[-1][0]
 
         X = np.zeros((len(batch), min(max_features, len(feature_map))))
         names = []
@@ -230,7 +237,7 @@ def cluster_wl_encodings(
                 )
             conn.commit()
 
-        offset += batch_size
+        offset += len(batch)
 
     cur.execute(
         f"""
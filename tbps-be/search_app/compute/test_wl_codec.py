@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from search_app.compute.wl_codec import PackedWL, encode_wl_bytes, stored_wl_kernel
+from search_app.WL_embedding.wl_kernel import compute_wl_kernel
+
+TARGET = {"forallE": 2, "app": 5, "Nat": 3, "app|Nat,fvar": 1}
+ENCODINGS = [
+    {"forallE": 1, "app": 2, "Nat": 1},
+    {"app": 300, "HAdd.hAdd": 70000, "app|Nat,fvar": 4},
+    {"Real": 1, "Set.union": 2},
+    {},
+]
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_stored_wl_kernel_matches_compute_wl_kernel(encoding):
+    expected = compute_wl_kernel(TARGET, encoding)
+    assert stored_wl_kernel(TARGET, encoding) == pytest.approx(expected)
+    assert stored_wl_kernel(TARGET, encode_wl_bytes(encoding)) == pytest.approx(expected)
+    assert stored_wl_kernel(TARGET, json.dumps(encoding).encode()) == pytest.approx(expected)
+
+
+def test_packed_round_trip():
+    packed = PackedWL.from_encoding(ENCODINGS[1])
+    unpacked = PackedWL.from_bytes(packed.to_bytes())
+    assert unpacked.hashes.tolist() == packed.hashes.tolist()
+    assert unpacked.counts.tolist() == packed.counts.tolist()
+    assert unpacked.norm == packed.norm
+
+
+def test_kernel_of_identical_encodings_is_one():
+    packed = PackedWL.from_encoding(TARGET)
+    assert packed.kernel(PackedWL.from_bytes(packed.to_bytes())) == pytest.approx(1.0)
@@ -0,0 +1,142 @@
+import struct
+from typing import Iterable, Optional
+
+import numpy as np
+
+from search_app.compute.zss_compute import TreeNode
+
+
+def flatten_tree(tree: TreeNode) -> tuple[list[str], list[int]]:
+    """Preorder node labels and child counts, enough to rebuild the tree."""
+    labels, child_counts = [], []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        children = node.get_children()
+        labels.append(node.label)
+        child_counts.append(len(children))
+        stack.extend(reversed(children))
+    return labels, child_counts
+
+
+def decode_tree(
+    label_ids: np.ndarray, child_counts: np.ndarray, vocabulary: list[str]
+) -> Optional[TreeNode]:
+    """Inverse of flatten_tree, with labels given as ids into vocabulary."""
+    if len(label_ids) == 0:
+        return None
+    root = None
+    # (node, children still to attach)
+    stack: list[tuple[TreeNode, int]] = []
+    for label_id, n_children in zip(label_ids.tolist(), child_counts.tolist()):
+        node = TreeNode(vocabulary[label_id])
+        if stack:
+            parent, missing = stack[-1]
+            parent.children.append(node)
+            if missing == 1:
+                stack.pop()
+            else:
+                stack[-1] = (parent, missing - 1)
+        else:
+            root = node
+        if n_children:
+            stack.append((node, n_children))
+    return root
+
+
+# Binary layout of one stored tree: header (magic, node count, byte length of
+# the label table, label id width, child count width), the "\0"-joined UTF-8
+# label table, then the preorder label ids and child counts as little-endian
+# unsigned integers of the given widths
+TREE_MAGIC = b"ST1"
+_HEADER = struct.Struct("<3sIIBB")
+_WIDTHS = {1: "<u1", 2: "<u2", 4: "<u4"}
+
+
+def _narrowest(values: np.ndarray) -> int:
+    top = int(values.max()) if len(values) else 0
+    for width in (1, 2, 4):
+        if top < 1 << (8 * width):
+            return width
+    raise ValueError(f"Value {top} too large for a stored tree")
+
+
+def encode_tree_bytes(tree: TreeNode) -> bytes:
+    """Self-contained binary form of a tree, for storage in a bytea column."""
+    labels, child_counts = flatten_tree(tree)
+    local = Vocabulary()
+    label_ids = np.asarray([local.add(label) for label in labels], dtype=np.int64)
+    child_counts = np.asarray(child_counts, dtype=np.int64)
+    label_table = "\0".join(local.items).encode()
+    id_width, count_width = _narrowest(label_ids), _narrowest(child_counts)
+    return b"".join(
+        [
+            _HEADER.pack(
+                TREE_MAGIC, len(labels), len(label_table), id_width, count_width
+            ),
+            label_table,
+            label_ids.astype(_WIDTHS[id_width]).tobytes(),
+            child_counts.astype(_WIDTHS[count_width]).tobytes(),
+        ]
+    )
+
+
+def tree_arrays(data: bytes) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Label table, preorder label ids and child counts of a stored tree, the
+    arrays being read-only views of data, without building TreeNodes.
+    """
+    magic, n_nodes, table_bytes, id_width, count_width = _HEADER.unpack_from(data)
+    if magic != TREE_MAGIC:
+        raise ValueError("Not a stored tree")
+    offset = _HEADER.size
+    vocabulary = data[offset : offset + table_bytes].decode().split("\0")
+    offset += table_bytes
+    label_ids = np.frombuffer(data, _WIDTHS[id_width], n_nodes, offset)
+    offset += n_nodes * id_width
+    child_counts = np.frombuffer(data, _WIDTHS[count_width], n_nodes, offset)
+    return vocabulary, label_ids, child_counts
+
+
+def decode_tree_bytes(data: bytes) -> Optional[TreeNode]:
+    """Inverse of encode_tree_bytes."""
+    vocabulary, label_ids, child_counts = tree_arrays(data)
+    return decode_tree(label_ids, child_counts, vocabulary)
+
+
+class Vocabulary:
+    """Dense integer ids for strings (node labels, constant names)."""
+
+    def __init__(self, items: Optional[list[str]] = None):
+        self.items = list(items or [])
+        self.ids = {item: i for i, item in enumerate(self.items)}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, item: str) -> int:
+        item_id = self.ids.get(item)
+        if item_id is None:
+            item_id = self.ids[item] = len(self.items)
+            self.items.append(item)
+        return item_id
+
+    def lookup(self, items: Iterable[str]) -> frozenset[int]:
+        """Ids of known items; unknown items get distinct negative ids."""
+        ids = set()
+        unknown = 0
+        for item in items:
+            item_id = self.ids.get(item)
+            if item_id is None:
+                unknown += 1
+                item_id = -unknown
+            ids.add(item_id)
+        return frozenset(ids)
+
+
+def jaccard(ids1: frozenset[int], ids2: frozenset[int]) -> float:
+    """Same convention as const_decl_name_similarity: two empty sets give 1."""
+    if not ids1 and not ids2:
+        return 1.0
+    union = len(ids1 | ids2)
+    return len(ids1 & ids2) / union if union else 0.0
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import struct
+from typing import Optional
+
+import numpy as np
+
+from search_app.WL_embedding.wl_kernel import compute_wl_kernel
+
+# Binary layout of one stored WL encoding: header (magic, feature count,
+# count width, L2 norm of the counts), then the features as sorted
+# little-endian int64 hashes and their counts as unsigned integers of the
+# given width
+WL_MAGIC = b"WL1"
+_HEADER = struct.Struct("<3sIBd")
+_WIDTHS = {1: "<u1", 2: "<u2", 4: "<u4"}
+
+
+def feature_hash(feature: str) -> int:
+    """Stable 63-bit id of a WL feature label."""
+    digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") >> 1
+
+
+class PackedWL:
+    """A WL encoding as sorted feature hashes and counts."""
+
+    __slots__ = ("hashes", "counts", "norm")
+
+    def __init__(self, hashes: np.ndarray, counts: np.ndarray, norm: float):
+        self.hashes = hashes
+        self.counts = counts
+        self.norm = norm
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    @classmethod
+    def from_encoding(cls, wl_encoding: dict) -> "PackedWL":
+        n_features = len(wl_encoding)
+        hashes = np.fromiter(
+            (feature_hash(f) for f in wl_encoding), dtype=np.int64, count=n_features
+        )
+        counts = np.fromiter(wl_encoding.values(), dtype=np.int64, count=n_features)
+        order = np.argsort(hashes)
+        counts = counts[order]
+        return cls(hashes[order], counts, float(np.sqrt(np.dot(counts, counts))))
+
+    @classmethod
+    def from_bytes(cls, data) -> "PackedWL":
+        """Inverse of to_bytes; the arrays are read-only views of data."""
+        magic, n_features, count_width, norm = _HEADER.unpack_from(data)
+        if magic != WL_MAGIC:
+            raise ValueError("Not a stored WL encoding")
+        hashes = np.frombuffer(data, "<i8", n_features, _HEADER.size)
+        counts = np.frombuffer(
+            data, _WIDTHS[count_width], n_features, _HEADER.size + 8 * n_features
+        )
+        return cls(hashes, counts, norm)
+
+    def to_bytes(self) -> bytes:
+        top = int(self.counts.max()) if len(self.counts) else 0
+        count_width = next(w for w in (1, 2, 4) if top < 1 << (8 * w))
+        return b"".join(
+            [
+                _HEADER.pack(WL_MAGIC, len(self.hashes), count_width, self.norm),
+                self.hashes.astype("<i8").tobytes(),
+                self.counts.astype(_WIDTHS[count_width]).tobytes(),
+            ]
+        )
+
+    def kernel(self, other: "PackedWL") -> float:
+        """Same value as compute_wl_kernel on the two encodings."""
+        if not len(self) or not len(other) or self.norm == 0 or other.norm == 0:
+            return 0.0
+        _, mine, theirs = np.intersect1d(
+            self.hashes, other.hashes, assume_unique=True, return_indices=True
+        )
+        dot = np.dot(
+            self.counts[mine].astype(np.int64), other.counts[theirs].astype(np.int64)
+        )
+        return max(0.0, min(1.0, float(dot) / (self.norm * other.norm)))
+
+
+def encode_wl_bytes(wl_encoding: dict) -> bytes:
+    """Compact binary form of a WL encoding, for storage in a bytea column."""
+    return PackedWL.from_encoding(wl_encoding).to_bytes()
+
+
+# Packed form of the last target seen by this process, since the same target
+# is scored against every candidate of a query
+_last_target: tuple[Optional[dict], Optional[PackedWL]] = (None, None)
+
+
+def _packed_target(target_encoding: dict) -> PackedWL:
+    global _last_target
+    # One read of the pair, as concurrent searches may replace it
+    last_target = _last_target
+    if last_target[0] is not target_encoding:
+        last_target = (target_encoding, PackedWL.from_encoding(target_encoding))
+        _last_target = last_target
+    return last_target[1]
+
+
+def stored_wl_kernel(target_encoding: dict, stored) -> float:
+    """
+    compute_wl_kernel of the target against a stored encoding, which is a
+    decoded JSONB dict, a packed buffer (bytes), or JSON text as bytes.
+    """
+    if isinstance(stored, (bytes, bytearray, memoryview)):
+        if bytes(stored[: len(WL_MAGIC)]) == WL_MAGIC:
+            return _packed_target(target_encoding).kernel(PackedWL.from_bytes(stored))
+        stored = json.loads(bytes(stored))
+    return compute_wl_kernel(target_encoding, stored)
@@ -0,0 +1,464 @@
+import argparse
+import logging
+import os
+import pickle
+import resource
+import shutil
+import time
+from typing import Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from search_app.compute.zss_compute import (
+    TreeNode,
+    get_const_decl_names_set,
+    can_t1_collapse_match_t2_soft,
+)
+from search_app.compute.tree_codec import Vocabulary, decode_tree, flatten_tree
+from search_app.WL.inverted_index import WLInvertedIndex
+from search_app.simp_trees import candidate_tree, simp_tree_columns, simp_tree_source
+from search_app.tree_cache import cached_tree
+from search_app.WL_embedding.db_utils import connect_to_db, iter_batches
+from search_app.workers import get_pool, map_chunked, worker_corpus
+
+CURRENT_FILE = "CURRENT"
+META_FILE = "meta.pkl"
+# Versions kept on disk: the current one and the one before it, which
+# processes that have not reloaded yet may still have mapped
+KEEP_VERSIONS = 2
+
+
+def default_corpus_dir() -> str:
+    return os.environ.get("TBPS_CORPUS_DIR", "corpus_arrays")
+
+
+def build_candidate_tree(source) -> Optional[TreeNode]:
+    """
+    Forall-simplified TreeNode from a stored simp_tree or expr_cse_json,
+    None if it fails.
+    """
+    try:
+        return candidate_tree(source)
+    except Exception as e:
+        print(f"Error building candidate tree: {str(e)[:100]}")
+        return None
+
+
+def flatten_candidate_tree(source) -> Optional[tuple[list[str], list[int], set[str]]]:
+    """Preorder labels, child counts and constant names of a candidate tree."""
+    tree = build_candidate_tree(source)
+    if tree is None:
+        return None
+    labels, child_counts = flatten_tree(tree)
+    return labels, child_counts, get_const_decl_names_set(tree)
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is the peak, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _offsets(lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+class CorpusIndex:
+    """
+    In-process copy of the searchable corpus, so a query needs no database
+    round trip. Theorems are ordered by simp_node_count: a node count window is
+    a contiguous id range found by binary search, and theorem ids are shared
+    with the WL inverted index (the WL matrix, stored by feature).
+
+    Numeric data lives in flat arrays: candidate trees as preorder label ids
+    and child counts, constant names as id sets, WL posting lists. A saved
+    index is opened as read-only memory maps, so worker processes and other
+    server processes share one copy through the page cache and a task only
+    needs a theorem id. Postgres stays the source of truth; a reload builds and
+    saves a fresh version from it.
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        statements: list[str],
+        arrays: dict[str, np.ndarray],
+        labels: Optional[Vocabulary],
+        consts: Optional[Vocabulary],
+        wl_features: list[str],
+        wl_iterations: int,
+        directory: Optional[str] = None,
+    ):
+        self.names = names
+        self.statements = statements
+        self.arrays = arrays
+        self.labels = labels
+        self.consts = consts
+        self.wl_features = wl_features
+        self.wl_iterations = wl_iterations
+        self.directory = directory
+        self.simp_node_counts = arrays["simp_node_counts"]
+        self.node_counts = arrays["node_counts"]
+        self.has_trees = "tree_offsets" in arrays
+        self.wl_index = WLInvertedIndex.from_arrays(
+            names, wl_features, arrays, wl_iterations
+        )
+        self.ids = {name: i for i, name in enumerate(names)}
+        self.load_seconds = 0.0
+        self.rss_delta_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __reduce__(self):
+        # Sent to spawned workers by location; they map the same files
+        if self.directory is None:
+            raise pickle.PicklingError("Save the corpus index before sharing it")
+        return (CorpusIndex.open, (self.directory,))
+
+    @property
+    def tree_nodes(self) -> int:
+        return len(self.arrays["tree_labels"]) if self.has_trees else 0
+
+    @classmethod
+    def build(
+        cls,
+        database_name: str = "mathlib_filtered",
+        wl_iterations: int = 3,
+        with_trees: bool = True,
+        batch_size: int = 10000,
+    ) -> "CorpusIndex":
+        conn = connect_to_db()
+        expr_column = (
+            f", {simp_tree_columns(conn, database_name)}" if with_trees else ""
+        )
+        cur = conn.cursor(name="corpus_index_load")
+        cur.itersize = batch_size
+        # Theorems without node counts fall outside every node count window
+        # and are never shown with results; int arrays cannot hold them
+        cur.execute(
+            f"""
+            SELECT d.name, d.simp_node_count, d.node_count, d.statement_str,
+                   w.simp_wl_encode_{wl_iterations},
+                   COALESCE(w.cluster_id, -1){expr_column}
+            FROM {database_name} AS d
+            JOIN wl_encodings_new AS w ON d.name = w.theorem_name
+            WHERE d.expr_cse_json != 'null'
+              AND d.simp_node_count IS NOT NULL
+              AND d.node_count IS NOT NULL
+            ORDER BY d.simp_node_count, d.name
+        """
+        )
+
+        names, statements, wl_records = [], [], []
+        simp_node_counts, node_counts, cluster_ids = [], [], []
+        labels, consts = Vocabulary(), Vocabulary()
+        tree_labels, tree_children, tree_sizes = [], [], []
+        const_ids, const_sizes = [], []
+        executor = get_pool()
+        with tqdm(desc="Loading corpus") as pbar:
+            for batch in iter_batches(cur, batch_size):
+                for row in batch:
+                    name, simp_node_count, node_count, statement, wl_encoding = row[:5]
+                    # -1 for theorems without a k-means cluster
+                    cluster_ids.append(row[5])
+                    names.append(name)
+                    simp_node_counts.append(simp_node_count)
+                    node_counts.append(node_count)
+                    statements.append(statement)
+                    wl_records.append((name, wl_encoding, simp_node_count))
+                if with_trees:
+                    flattened = executor.map(
+                        flatten_candidate_tree,
+                        [simp_tree_source(row[6], row[7]) for row in batch],
+                        chunksize=256,
+                    )
+                    for result in flattened:
+                        # A failed tree is stored empty and decodes to None
+                        node_labels, child_counts, const_names = result or ([], [], ())
+                        tree_labels.extend(labels.add(label) for label in node_labels)
+                        tree_children.extend(child_counts)
+                        tree_sizes.append(len(node_labels))
+                        ids = sorted(consts.add(const) for const in const_names)
+                        const_ids.extend(ids)
+                        const_sizes.append(len(ids))
+                pbar.update(len(batch))
+        cur.close()
+        conn.close()
+
+        wl_index = WLInvertedIndex.from_encodings(
+            wl_records, wl_iterations, skip_empty=False
+        )
+        del wl_records
+        wl_features, arrays = wl_index.to_arrays()
+        del wl_index
+        arrays["simp_node_counts"] = np.asarray(simp_node_counts, dtype=np.int32)
+        arrays["node_counts"] = np.asarray(node_counts, dtype=np.int32)
+        arrays["cluster_ids"] = np.asarray(cluster_ids, dtype=np.int32)
+        if with_trees:
+            arrays["tree_offsets"] = _offsets(tree_sizes)
+            arrays["tree_labels"] = np.asarray(tree_labels, dtype=np.int32)
+            arrays["tree_children"] = np.asarray(tree_children, dtype=np.int32)
+            arrays["const_offsets"] = _offsets(const_sizes)
+            arrays["const_ids"] = np.asarray(const_ids, dtype=np.int32)
+        return cls(
+            names,
+            statements,
+            arrays,
+            labels if with_trees else None,
+            consts if with_trees else None,
+            wl_features,
+            wl_iterations,
+        )
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for key, array in self.arrays.items():
+            np.save(os.path.join(directory, f"{key}.npy"), array)
+        meta = {
+            "names": self.names,
+            "statements": self.statements,
+            "labels": self.labels.items if self.labels is not None else None,
+            "consts": self.consts.items if self.consts is not None else None,
+            "wl_features": self.wl_features,
+            "wl_iterations": self.wl_iterations,
+        }
+        with open(os.path.join(directory, META_FILE), "wb") as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+
+    @classmethod
+    def open(cls, directory: str) -> "CorpusIndex":
+        """Open a saved index with its arrays memory-mapped read-only."""
+        with open(os.path.join(directory, META_FILE), "rb") as f:
+            meta = pickle.load(f)
+        arrays = {
+            file_name[: -len(".npy")]: np.load(
+                os.path.join(directory, file_name), mmap_mode="r"
+            )
+            for file_name in os.listdir(directory)
+            if file_name.endswith(".npy")
+        }
+        return cls(
+            meta["names"],
+            meta["statements"],
+            arrays,
+            Vocabulary(meta["labels"]) if meta["labels"] is not None else None,
+            Vocabulary(meta["consts"]) if meta["consts"] is not None else None,
+            meta["wl_features"],
+            meta["wl_iterations"],
+            directory,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        database_name: str = "mathlib_filtered",
+        wl_iterations: int = 3,
+        with_trees: bool = True,
+        batch_size: int = 10000,
+        root: Optional[str] = None,
+        rebuild: bool = False,
+    ) -> "CorpusIndex":
+        """
+        Open the current saved version under root, or build one from the
+        database and publish it when there is none (or rebuild is set).
+        """
+        start = time.perf_counter()
+        rss_before = _rss_bytes()
+        root = root or default_corpus_dir()
+        directory = None if rebuild else current_version(root)
+        if directory is not None:
+            corpus = cls.open(directory)
+            if corpus.wl_iterations != wl_iterations or (
+                with_trees and not corpus.has_trees
+            ):
+                directory = None
+        if directory is None:
+            directory = publish_version(
+                cls.build(database_name, wl_iterations, with_trees, batch_size), root
+            )
+            corpus = cls.open(directory)
+        corpus.load_seconds = time.perf_counter() - start
+        corpus.rss_delta_bytes = _rss_bytes() - rss_before
+        print(
+            f"Loaded corpus index from {directory}: {len(corpus)} theorems in "
+            f"{corpus.load_seconds:.1f}s, ~{corpus.rss_delta_bytes / 2**20:.0f} MiB"
+        )
+        return corpus
+
+    def window(self, min_nodes: float, max_nodes: float) -> tuple[int, int]:
+        """Half-open id range [lo, hi) with min_nodes <= simp_node_count <= max_nodes."""
+        lo = int(np.searchsorted(self.simp_node_counts, min_nodes, side="left"))
+        hi = int(np.searchsorted(self.simp_node_counts, max_nodes, side="right"))
+        return lo, hi
+
+    def wl_top_k(
+        self,
+        target_encoding: dict,
+        k: int,
+        min_nodes: float,
+        max_nodes: float,
+        simptree: Optional[TreeNode] = None,
+        alpha: float = 1.0,
+    ) -> list[tuple[str, float]]:
+        """
+        WL retrieval over the node window, blended with the collapse-match score
+        against the stored candidate trees when alpha < 1.
+        """
+        if alpha >= 1:
+            return self.wl_index.top_k(target_encoding, k, min_nodes, max_nodes)
+        if not self.has_trees:
+            raise ValueError("Corpus index was loaded without candidate trees")
+        lo, hi = self.window(min_nodes, max_nodes)
+        wl_scores = self.wl_index.scores(target_encoding, min_nodes, max_nodes)
+        collapse_scores = map_chunked(
+            _collapse_match_task,
+            range(lo, hi),
+            shared=(self.directory, simptree),
+            kind="collapse_match",
+        )
+        blended = alpha * wl_scores[lo:hi] + (1 - alpha) * np.asarray(
+            collapse_scores, dtype=np.float64
+        )
+        order = np.arange(hi - lo)
+        if len(order) > k:
+            order = np.argpartition(-blended, k - 1)[:k]
+            order.sort()
+        order = order[np.argsort(-blended[order], kind="stable")]
+        return [(self.names[lo + i], float(blended[i])) for i in order]
+
+    def tree_at(self, theorem_id: int) -> Optional[TreeNode]:
+        start, end = self.arrays["tree_offsets"][theorem_id : theorem_id + 2]
+        return decode_tree(
+            self.arrays["tree_labels"][start:end],
+            self.arrays["tree_children"][start:end],
+            self.labels.items,
+        )
+
+    def tree_size(self, theorem_id: int) -> int:
+        start, end = self.arrays["tree_offsets"][theorem_id : theorem_id + 2]
+        return int(end - start)
+
+    def const_ids_at(self, theorem_id: int) -> frozenset[int]:
+        start, end = self.arrays["const_offsets"][theorem_id : theorem_id + 2]
+        return frozenset(self.arrays["const_ids"][start:end].tolist())
+
+    def tree(self, name: str) -> Optional[TreeNode]:
+        theorem_id = self.ids.get(name)
+        if theorem_id is None or not self.has_trees:
+            return None
+        return self.tree_at(theorem_id)
+
+    def details(self, name: str) -> tuple[Optional[str], Optional[int]]:
+        """statement_str and node_count, like fetch_theorem_details."""
+        theorem_id = self.ids.get(name)
+        if theorem_id is None:
+            return None, None
+        return self.statements[theorem_id], int(self.node_counts[theorem_id])
+
+    def memory_usage(self) -> dict:
+        array_bytes = {key: int(array.nbytes) for key, array in self.arrays.items()}
+        return {
+            "theorems": len(self),
+            "wl_iterations": self.wl_iterations,
+            "wl_features": len(self.wl_features),
+            "wl_postings_bytes": array_bytes["wl_ids"] + array_bytes["wl_weights"],
+            "tree_bytes": sum(
+                v for k, v in array_bytes.items() if k.startswith(("tree_", "const_"))
+            ),
+            "mapped_bytes": sum(array_bytes.values()),
+            "statement_bytes": sum(len(s.encode()) for s in self.statements if s),
+            "tree_nodes": self.tree_nodes,
+            "rss_delta_bytes": self.rss_delta_bytes,
+            "load_seconds": round(self.load_seconds, 2),
+        }
+
+
+def current_version(root: str) -> Optional[str]:
+    """Directory of the published corpus version under root, None if none."""
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            directory = os.path.join(root, f.read().strip())
+    except OSError:
+        return None
+    return directory if os.path.exists(os.path.join(directory, META_FILE)) else None
+
+
+def publish_version(corpus: CorpusIndex, root: str) -> str:
+    """Save corpus as a new version under root and point CURRENT at it."""
+    version = f"v{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+    directory = os.path.join(root, version)
+    corpus.save(directory)
+    pointer = os.path.join(root, f"{CURRENT_FILE}.{os.getpid()}")
+    with open(pointer, "w") as f:
+        f.write(version)
+    os.replace(pointer, os.path.join(root, CURRENT_FILE))
+
+    versions = sorted(
+        (entry for entry in os.listdir(root) if entry.startswith("v")),
+        key=lambda entry: os.path.getmtime(os.path.join(root, entry)),
+    )
+    # Mapped files stay readable after removal until their users unmap them
+    for stale in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(root, stale), ignore_errors=True)
+    return directory
+
+
+_opened: dict[str, CorpusIndex] = {}
+
+
+def corpus_at(directory: str) -> CorpusIndex:
+    """
+    The corpus version saved at directory, as seen from the current process:
+    the one the worker pool was started with, or opened on first use.
+    """
+    corpus = worker_corpus()
+    if corpus is not None and corpus.directory == directory:
+        return corpus
+    if directory not in _opened:
+        _opened.clear()
+        _opened[directory] = CorpusIndex.open(directory)
+    return _opened[directory]
+
+
+def _collapse_match_task(theorem_id: int, shared: tuple) -> float:
+    directory, simptree = shared
+    corpus = corpus_at(directory)
+    entry = cached_tree(corpus.names[theorem_id], lambda: corpus.tree_at(theorem_id))
+    return can_t1_collapse_match_t2_soft(simptree, entry.tree) if entry else 0.0
+
+
+def load_corpus_index(**kwargs) -> Optional[CorpusIndex]:
+    """Load the corpus index, or None (database fallback) if loading fails."""
+    try:
+        return CorpusIndex.load(**kwargs)
+    except Exception as e:
+        print(f"Failed to load corpus index, falling back to database queries: {e}")
+        logging.error(f"Failed to load corpus index: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build and publish the memory-mapped corpus index"
+    )
+    parser.add_argument("--database-name", default="mathlib_filtered")
+    parser.add_argument("--wl-iterations", type=int, default=3)
+    parser.add_argument("--root", default=None)
+    parser.add_argument("--without-trees", action="store_true")
+    args = parser.parse_args()
+    corpus = CorpusIndex.load(
+        args.database_name,
+        args.wl_iterations,
+        with_trees=not args.without_trees,
+        root=args.root,
+        rebuild=True,
+    )
+    print(corpus.memory_usage())
@@ -6,6 +6,7 @@ from myexpr import deserialize_expr, simplify_forall_expr_iter
 from compute.zss_compute import your_expr_to_treenode
 from WL_embedding.db_utils import connect_to_db, fetch_theorems_batch
 from WL_embedding.wl_kernel import compute_wl_encoding
+from WL.packed_wl import store_wl_encoding
 
 
 def process_theorem(args):
@@ -68,35 +69,29 @@ def preprocess_theorems(table_name, k, batch_size=10000, num_processes=None):
     wl_encode_column = f"simp_wl_encode_{k}"
     ensure_column_exists(conn, "wl_encodings_new", wl_encode_column)
 
-    total_theorems = 217555
-    offset = 0
+    last_name = None
+    processed = 0
 
-    with tqdm(total=total_theorems, desc=f"Overall progress (k={k})") as pbar:
-        while offset < total_theorems:
-            theorems = fetch_theorems_batch(conn, table_name, offset, batch_size)
+    with tqdm(desc=f"Overall progress (k={k})") as pbar:
+        while True:
+            theorems = fetch_theorems_batch(conn, table_name, last_name, batch_size)
             if not theorems:
-                print(f"No data at offset {offset}, ending processing")
+                print(f"No data after {last_name}, ending processing")
                 break
+            last_name = theorems[-1][0]
 
             theorem_results = process_theorems_batch(theorems, k, num_processes)
             cursor = conn.cursor()
             for theorem_name, serialized_encoding, depth in theorem_results:
                 try:
-                    cursor.execute(
-                        f"""
-                        UPDATE wl_encodings_new
-                        SET {wl_encode_column} = %s
-                        WHERE theorem_name = %s
-                    """,
-                        (serialized_encoding, theorem_name),
-                    )
+                    store_wl_encoding(cursor, k, theorem_name, serialized_encoding)
                     conn.commit()
                 except Exception as e:
                     print(f"Failed to store theorem {theorem_name} (k={depth}): {e}")
 
-            offset += batch_size
-            print(f"Batch processing completed, current offset: {offset}")
-            pbar.update(batch_size)
+            processed += len(theorems)
+            print(f"Batch processing completed, processed: {processed}")
+            pbar.update(len(theorems))
 
     conn.close()
     print(f"Preprocessing completed (k={k})")
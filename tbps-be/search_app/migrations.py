@@ -0,0 +1,401 @@
+import argparse
+import json
+import sys
+import time
+
+from search_app.WL_embedding.db_utils import connect_to_db
+
+# Denormalized copy of the columns the node window scan reads from both tables
+SEARCH_VIEW = "theorem_search"
+
+
+# Freshness state of the search view: base_version counts writes to the
+# tables it copies (bumped by triggers), view_version is the base_version it
+# was last refreshed at
+SEARCH_VIEW_STATE = "search_view_state"
+
+# WL columns the search view copies: the encodings of the default
+# wl_iterations, and their packed form once store_packed_wl has added it.
+# Queries on other iterations join the tables
+SEARCH_VIEW_WL_COLUMNS = ("simp_wl_encode_3", "simp_wl_packed_3")
+
+# Seconds a process reuses its last reading of the search view state, so
+# that scan queries do not each pay its round trips; writes to the tables
+# are noticed within this delay
+SEARCH_VIEW_CHECK_SECONDS = 5.0
+
+# (checked_at, fresh, refreshed_at, columns) of the search view as last read
+# by this process
+_search_view: tuple = (None, False, None, set())
+
+
+def _view_columns(cur) -> set[str]:
+    """Columns of the search view, empty if it has not been created."""
+    # Materialized views are not in information_schema.columns
+    cur.execute(
+        """
+        SELECT a.attname FROM pg_attribute AS a
+        JOIN pg_class AS c ON a.attrelid = c.oid
+        WHERE c.relname = %s AND c.relkind = 'm'
+        AND a.attnum > 0 AND NOT a.attisdropped
+    """,
+        (SEARCH_VIEW,),
+    )
+    return {row[0] for row in cur.fetchall()}
+
+
+def search_view_columns(conn) -> set[str]:
+    """
+    Columns of the search view if it is as fresh as the tables it copies,
+    else empty so that queries join the tables instead. The freshness state
+    is read again once SEARCH_VIEW_CHECK_SECONDS have passed, or after
+    clear_search_view_cache; the columns after each refresh.
+    """
+    global _search_view
+    checked_at, fresh, refreshed_at, columns = _search_view
+    now = time.monotonic()
+    if checked_at is not None and now - checked_at < SEARCH_VIEW_CHECK_SECONDS:
+        return columns if fresh else set()
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (SEARCH_VIEW_STATE,))
+        state = None
+        if cur.fetchone()[0]:
+            cur.execute(
+                f"SELECT base_version, view_version, refreshed_at FROM {SEARCH_VIEW_STATE}"
+            )
+            state = cur.fetchone()
+        fresh = state is not None and state[0] == state[1]
+        if fresh and state[2] != refreshed_at:
+            refreshed_at, columns = state[2], _view_columns(cur)
+    _search_view = (now, fresh, refreshed_at, columns)
+    return columns if fresh else set()
+
+
+def clear_search_view_cache():
+    """Read the search view state again on next use, e.g. after a corpus reload."""
+    global _search_view
+    _search_view = (None, False, None, set())
+
+
+def _wl_columns(cur) -> list[str]:
+    """The SEARCH_VIEW_WL_COLUMNS that wl_encodings_new has."""
+    cur.execute(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'wl_encodings_new' AND column_name = ANY(%s)
+    """,
+        (list(SEARCH_VIEW_WL_COLUMNS),),
+    )
+    present = {row[0] for row in cur.fetchall()}
+    return [column for column in SEARCH_VIEW_WL_COLUMNS if column in present]
+
+
+def _create_search_view(cur, columns: list[str]):
+    wl_columns = "".join(f", w.{column}" for column in columns)
+    cur.execute(
+        f"""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS {SEARCH_VIEW} AS
+        SELECT d.name, d.simp_node_count, d.node_count, w.cluster_id{wl_columns}
+        FROM mathlib_filtered AS d
+        JOIN wl_encodings_new AS w ON d.name = w.theorem_name
+        WHERE d.expr_cse_json != 'null'
+    """
+    )
+    # Unique for REFRESH ... CONCURRENTLY
+    cur.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {SEARCH_VIEW}_name_idx ON {SEARCH_VIEW} (name)"
+    )
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {SEARCH_VIEW}_simp_node_count_idx
+        ON {SEARCH_VIEW} (simp_node_count)
+    """
+    )
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {SEARCH_VIEW}_cluster_id_idx
+        ON {SEARCH_VIEW} (cluster_id, simp_node_count)
+    """
+    )
+
+
+# (version, description, SQL statements or a function of a cursor), applied in
+# order; append new migrations, never edit applied ones
+MIGRATIONS = [
+    (
+        1,
+        "join keys of mathlib_filtered and wl_encodings_new",
+        [
+            "CREATE INDEX IF NOT EXISTS mathlib_filtered_name_idx ON mathlib_filtered (name)",
+            """
+            CREATE INDEX IF NOT EXISTS wl_encodings_new_theorem_name_idx
+            ON wl_encodings_new (theorem_name)
+            """,
+        ],
+    ),
+    (
+        2,
+        "node count B-tree over theorems with an expression",
+        [
+            # Partial on the filter every search query applies, so the node
+            # window is one index range scan
+            """
+            CREATE INDEX IF NOT EXISTS mathlib_filtered_simp_node_count_idx
+            ON mathlib_filtered (simp_node_count, name)
+            WHERE expr_cse_json != 'null'
+            """,
+        ],
+    ),
+    (
+        3,
+        "cluster_id index",
+        [
+            "ALTER TABLE wl_encodings_new ADD COLUMN IF NOT EXISTS cluster_id INTEGER",
+            """
+            CREATE INDEX IF NOT EXISTS wl_encodings_new_cluster_id_idx
+            ON wl_encodings_new (cluster_id)
+            """,
+        ],
+    ),
+    (
+        4,
+        f"{SEARCH_VIEW} materialized view",
+        # A fixed column list; refresh adds the packed column once it exists
+        lambda cur: _create_search_view(cur, ["simp_wl_encode_3"]),
+    ),
+    (
+        5,
+        f"{SEARCH_VIEW} freshness triggers",
+        [
+            # Single row; view_version stays NULL (stale) until the next refresh
+            f"""
+            CREATE TABLE IF NOT EXISTS {SEARCH_VIEW_STATE} (
+                id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                base_version BIGINT NOT NULL DEFAULT 0,
+                view_version BIGINT,
+                refreshed_at TIMESTAMPTZ
+            )
+            """,
+            f"INSERT INTO {SEARCH_VIEW_STATE} DEFAULT VALUES ON CONFLICT DO NOTHING",
+            f"""
+            CREATE OR REPLACE FUNCTION {SEARCH_VIEW_STATE}_bump() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                UPDATE {SEARCH_VIEW_STATE} SET base_version = base_version + 1;
+                RETURN NULL;
+            END
+            $$
+            """,
+            # Only the columns the view copies: storing simplified trees
+            # does not make it stale
+            f"""
+            CREATE OR REPLACE TRIGGER {SEARCH_VIEW_STATE}_mathlib_filtered
+            AFTER INSERT OR DELETE OR TRUNCATE
+            OR UPDATE OF name, simp_node_count, node_count, expr_cse_json
+            ON mathlib_filtered
+            FOR EACH STATEMENT EXECUTE FUNCTION {SEARCH_VIEW_STATE}_bump()
+            """,
+            f"""
+            CREATE OR REPLACE TRIGGER {SEARCH_VIEW_STATE}_wl_encodings_new
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON wl_encodings_new
+            FOR EACH STATEMENT EXECUTE FUNCTION {SEARCH_VIEW_STATE}_bump()
+            """,
+        ],
+    ),
+]
+
+
+def ensure_migrations_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """
+    )
+
+
+def applied_versions(cur) -> set[int]:
+    ensure_migrations_table(cur)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(conn, target: int | None = None) -> list[int]:
+    """Apply pending migrations up to target (all if None), each in its own transaction."""
+    with conn.cursor() as cur:
+        done = applied_versions(cur)
+    conn.commit()
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version in done or (target is not None and version > target):
+            continue
+        print(f"Applying migration {version}: {description}")
+        try:
+            with conn.cursor() as cur:
+                if callable(steps):
+                    steps(cur)
+                else:
+                    for statement in steps:
+                        cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description),
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    if applied:
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE mathlib_filtered")
+            cur.execute("ANALYZE wl_encodings_new")
+        conn.commit()
+    return applied
+
+
+def refresh_search_view(conn):
+    """
+    Bring the search view up to date; run after ingesting theorems,
+    clustering or store_packed_wl. The view is recreated when
+    wl_encodings_new has SEARCH_VIEW_WL_COLUMNS it does not hold yet.
+    Queries only use the view while no write to its tables has happened
+    since.
+    """
+    with conn.cursor() as cur:
+        # Read first: a write committed while refreshing leaves it stale
+        cur.execute(f"SELECT base_version FROM {SEARCH_VIEW_STATE}")
+        base_version = cur.fetchone()[0]
+        wl_columns = _wl_columns(cur)
+        missing = set(wl_columns) - _view_columns(cur)
+        if missing:
+            print(f"Recreating {SEARCH_VIEW} for {', '.join(sorted(missing))}")
+            cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {SEARCH_VIEW}")
+            _create_search_view(cur, wl_columns)
+        else:
+            cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {SEARCH_VIEW}")
+        cur.execute(f"ANALYZE {SEARCH_VIEW}")
+        cur.execute(
+            f"UPDATE {SEARCH_VIEW_STATE} SET view_version = %s, refreshed_at = clock_timestamp()",
+            (base_version,),
+        )
+    conn.commit()
+    clear_search_view_cache()
+
+
+# The candidate window queries of load_filtered_theorems
+CHECK_QUERIES = {
+    "node window": (
+        """
+        SELECT d.name, w.simp_wl_encode_3
+        FROM mathlib_filtered AS d
+        JOIN wl_encodings_new AS w ON d.name = w.theorem_name
+        WHERE d.expr_cse_json != 'null'
+        AND d.simp_node_count BETWEEN %s AND %s
+        """,
+        (40, 60),
+    ),
+    "clustered node window": (
+        """
+        SELECT d.name, w.simp_wl_encode_3
+        FROM mathlib_filtered AS d
+        JOIN wl_encodings_new AS w ON d.name = w.theorem_name
+        WHERE d.expr_cse_json != 'null'
+        AND d.simp_node_count BETWEEN %s AND %s
+        AND w.cluster_id = ANY(%s)
+        """,
+        (40, 60, [0, 1, 2, 3, 4]),
+    ),
+    f"{SEARCH_VIEW} node window": (
+        f"""
+        SELECT s.name, s.simp_wl_encode_3
+        FROM {SEARCH_VIEW} AS s
+        WHERE s.simp_node_count BETWEEN %s AND %s
+        """,
+        (40, 60),
+    ),
+}
+
+
+def _plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def explain_check(conn) -> bool:
+    """
+    EXPLAIN the candidate window queries and report how each relation is
+    read; False if any of them is read by a sequential scan.
+    """
+    ok = True
+    with conn.cursor() as cur:
+        for label, (query, params) in CHECK_QUERIES.items():
+            try:
+                cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            except Exception as e:
+                conn.rollback()
+                print(f"{label}: skipped ({str(e).strip()})")
+                continue
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            scans = [
+                (node["Node Type"], node["Relation Name"], node.get("Index Name"))
+                for node in _plan_nodes(plan[0]["Plan"])
+                if "Relation Name" in node
+            ]
+            seq_scans = [scan for scan in scans if scan[0] == "Seq Scan"]
+            ok = ok and not seq_scans
+            print(f"{label}: {'FAIL' if seq_scans else 'ok'}")
+            for node_type, relation, index in scans:
+                print(f"  {node_type} on {relation}" + (f" using {index}" if index else ""))
+    conn.rollback()
+    return ok
+
+
+def migration_status(conn):
+    with conn.cursor() as cur:
+        done = applied_versions(cur)
+    conn.commit()
+    for version, description, _ in MIGRATIONS:
+        print(f"{version:>3} {'applied' if version in done else 'pending':<8} {description}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Versioned indexes and search view of the theorem database"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Apply pending migrations")
+    migrate_parser.add_argument("--target", type=int, help="Stop at this version")
+    subparsers.add_parser("status", help="List applied and pending migrations")
+    subparsers.add_parser(
+        "refresh", help=f"Refresh {SEARCH_VIEW} after ingesting or clustering"
+    )
+    subparsers.add_parser(
+        "check", help="EXPLAIN the candidate window queries, fail on sequential scans"
+    )
+    args = parser.parse_args()
+
+    conn = connect_to_db()
+    if conn is None:
+        sys.exit(1)
+    if args.command == "migrate":
+        applied = migrate(conn, args.target)
+        print(f"Applied {len(applied)} migrations")
+        if 5 in applied:
+            print(f"Queries use {SEARCH_VIEW} once `refresh` has run")
+    elif args.command == "status":
+        migration_status(conn)
+    elif args.command == "refresh":
+        refresh_search_view(conn)
+        print(f"Refreshed {SEARCH_VIEW}")
+    elif args.command == "check":
+        ok = explain_check(conn)
+        conn.close()
+        sys.exit(0 if ok else 1)
+    conn.close()
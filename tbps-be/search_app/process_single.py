@@ -1,13 +1,14 @@
 import time
+import logging
+import threading
 import psycopg2
-from tqdm import tqdm
-import concurrent.futures
-from typing import Tuple, List, Optional
-from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Tuple, List, Optional
 import os
 import csv
 import math
-from search_app.myexpr import YourExpr, deserialize_expr, simplify_forall_expr_iter
+import heapq
+from collections import OrderedDict
+from search_app.myexpr import YourExpr, simplify_forall_expr_iter
 from search_app.compute.zss_compute import (
     TreeNode,
     zss_edit_distance_TreeNode,
@@ -15,24 +16,29 @@ from search_app.compute.zss_compute import (
     count_nodes,
     const_decl_name_similarity,
     can_t1_collapse_match_t2_soft,
+    get_const_decl_names_set,
 )
-from search_app.WL.db_utils import load_filtered_theorems, connect_to_db, DB_CONFIG
+from search_app.compute.tree_codec import jaccard
+from search_app.corpus import corpus_at
+from search_app.WL.db_utils import load_filtered_theorems
+from search_app.WL_embedding.db_utils import db_connection
+from search_app.simp_trees import candidate_tree, simp_tree_columns, simp_tree_source
+from search_app.tree_cache import cached_tree
+from search_app.workers import map_chunked
 
 
 def process_candidate(
-    candidate: Tuple[str, str, float, TreeNode],
+    candidate: Tuple[str, str, float], target_tree: TreeNode
 ) -> Tuple[str, Optional[TreeNode], int, float, float]:
-    name, expr_json, wl_score, target_tree = candidate
+    name, expr_json, wl_score = candidate
     try:
-        theorem_expr = deserialize_expr(expr_json)
-
-        theorem_expr = simplify_forall_expr_iter(theorem_expr)
-
-        theorem_tree = your_expr_to_treenode(theorem_expr)
+        # Built once per worker and reused by later queries
+        entry = cached_tree(name, lambda: candidate_tree(expr_json))
+        theorem_tree = entry.tree
 
         syntactic_similarity = can_t1_collapse_match_t2_soft(target_tree, theorem_tree)
 
-        theorem_size = count_nodes(theorem_tree)
+        theorem_size = entry.size
 
         return (name, theorem_tree, theorem_size, wl_score, syntactic_similarity)
     except Exception as e:
@@ -40,73 +46,108 @@ def process_candidate(
         return (name, None, 0, wl_score)
 
 
-def precompute_candidates(
+def candidate_sources(
     filtered_results: List[Tuple[str, float]],
-    target_tree: TreeNode,
-    max_workers: int = 4,
-) -> List[Tuple[str, Optional[TreeNode], int, float, float]]:
-    names = [cand[0] for cand in filtered_results]
+    candidate_exprs: Optional[dict] = None,
+    const_names: Optional[dict] = None,
+) -> List[Tuple[str, object, float]]:
+    """
+    (name, stored simp_tree or expr_cse_json, wl_score) of the candidates.
+    Expressions already fetched by retrieval are taken from candidate_exprs;
+    only the remaining ones are queried, and the constant names stored with
+    their trees are added to const_names if given.
+    """
+    candidate_exprs = candidate_exprs or {}
     name_to_score = dict(filtered_results)
+    candidates_data = [
+        (name, candidate_exprs[name], wl_score)
+        for name, wl_score in filtered_results
+        if name in candidate_exprs
+    ]
+    names = [cand[0] for cand in filtered_results if cand[0] not in candidate_exprs]
+
+    if names:
+        try:
+            with db_connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT d.name, {simp_tree_columns(conn, "mathlib_filtered", with_const_names=True)}
+                    FROM mathlib_filtered AS d
+                    WHERE d.name IN %s
+                """,
+                    (tuple(names),),
+                )
+
+                results = cur.fetchall()
+                if len(results) != len(names):
+                    print(
+                        f"Warning: Expected to load {len(names)} data entries, actually loaded {len(results)}"
+                    )
+
+                for name, simp_tree, expr_json, stored_consts in results:
+                    wl_score = name_to_score.get(name, 0.0)
+                    candidates_data.append(
+                        (name, simp_tree_source(simp_tree, expr_json), wl_score)
+                    )
+                    if const_names is not None and stored_consts is not None:
+                        const_names[name] = set(stored_consts)
+
+        except psycopg2.Error as e:
+            print(f"Database error: {e}")
+            return []
+    return candidates_data
 
-    candidates_data = []
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT name, expr_cse_json
-            FROM mathlib_filtered
-            WHERE name IN %s
-        """,
-            (tuple(names),),
-        )
-
-        results = cur.fetchall()
-        if len(results) != len(names):
-            print(
-                f"Warning: Expected to load {len(names)} data entries, actually loaded {len(results)}"
-            )
-
-        for name, expr_json in results:
-            wl_score = name_to_score.get(name, 0.0)
-            candidates_data.append((name, expr_json, wl_score, target_tree))
-
-    except psycopg2.Error as e:
-        print(f"Database error: {e}")
-        return []
 
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+def precompute_candidates(
+    filtered_results: List[Tuple[str, float]],
+    target_tree: TreeNode,
+    candidate_exprs: Optional[dict] = None,
+) -> List[Tuple[str, Optional[TreeNode], int, float, float]]:
+    """
+    Build the candidate trees, decoding the stored simp_tree where the ingest
+    has run.
+    """
+    candidates_data = candidate_sources(filtered_results, candidate_exprs)
 
     precomputed_candidates = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-
-        results = tqdm(
-            executor.map(process_candidate, candidates_data),
-            total=len(candidates_data),
-            desc="process_candidate",
-        )
+    results = map_chunked(
+        process_candidate,
+        candidates_data,
+        shared=target_tree,
+        desc="process_candidate",
+    )
 
-        for result in results:
-            if result[1] is not None:
-                precomputed_candidates.append(result)
+    for result in results:
+        if result[1] is not None:
+            precomputed_candidates.append(result)
 
     return precomputed_candidates
 
 
+# Weights of process_theorem's score; ZSS_WEIGHT only applies to targets of
+# at most ZSS_MAX_TARGET_SIZE nodes
+WL_WEIGHT, ZSS_WEIGHT, SYNTACTIC_WEIGHT, CONST_WEIGHT = 0.15, 0.40, 0.30, 0.15
+ZSS_MAX_TARGET_SIZE = 50
+
+
 def process_theorem(
-    data: tuple[str, TreeNode, int, float, float], target_tree, target_size: int
+    data: tuple[str, TreeNode, int, float, float],
+    target_tree,
+    target_size: int,
+    const_similarity: Optional[float] = None,
 ):
     """Compute edit similarity using precomputed theorem_expr and theorem_size."""
     theorem_name, theorem_tree, theorem_size, wl_score, syntactic_similarity = data
 
     try:
-        if target_size > 50 :
-            alpha, gamma, delta = 0.15, 0.30, 0.15
-            similarity = alpha * wl_score + gamma * syntactic_similarity + delta * const_decl_name_similarity(target_tree, theorem_tree)
+        if const_similarity is None:
+            const_similarity = const_decl_name_similarity(target_tree, theorem_tree)
+        if target_size > ZSS_MAX_TARGET_SIZE:
+            similarity = (
+                WL_WEIGHT * wl_score
+                + SYNTACTIC_WEIGHT * syntactic_similarity
+                + CONST_WEIGHT * const_similarity
+            )
             return (theorem_name, similarity, wl_score)
         distance = zss_edit_distance_TreeNode(target_tree, theorem_tree)
         if distance == float('inf'):
@@ -114,9 +155,12 @@ def process_theorem(
 
         max_size = max(target_size, theorem_size)
         similarity = 1 - (distance / max_size) if max_size > 0 else 0.0
-        alpha, beta, gamma, delta = 0.15, 0.40, 0.30, 0.15
-
-        similarity = alpha * wl_score + beta * similarity + gamma * syntactic_similarity + delta * const_decl_name_similarity(target_tree, theorem_tree)
+        similarity = (
+            WL_WEIGHT * wl_score
+            + ZSS_WEIGHT * similarity
+            + SYNTACTIC_WEIGHT * syntactic_similarity
+            + CONST_WEIGHT * const_similarity
+        )
 
         return (theorem_name, similarity, wl_score)
     except Exception as e:
@@ -124,6 +168,295 @@ def process_theorem(
         return None
 
 
+def _process_theorem_task(data: tuple, shared: tuple):
+    target_tree, target_size = shared
+    return process_theorem(data, target_tree, target_size)
+
+
+# Candidates per round of the stages of rerank_cascade; the cheap stage only
+# runs in rounds under a deadline
+CHEAP_ROUND_SIZE = 1024
+ZSS_ROUND_SIZE = 256
+
+
+def _cheap_scores(
+    key, theorem_tree: TreeNode, size: int, wl_score: float, target_tree, const_similarity
+) -> tuple:
+    syntactic_similarity = can_t1_collapse_match_t2_soft(target_tree, theorem_tree)
+    partial = (
+        WL_WEIGHT * wl_score
+        + SYNTACTIC_WEIGHT * syntactic_similarity
+        + CONST_WEIGHT * const_similarity
+    )
+    return (key, size, wl_score, syntactic_similarity, const_similarity, partial)
+
+
+def _cheap_task(item: tuple, shared: tuple):
+    name, source, wl_score, const_names = item
+    target_tree, target_consts = shared
+    try:
+        entry = cached_tree(name, lambda: candidate_tree(source))
+        # Stored by the simp_tree ingest, else collected from the tree
+        if const_names is None:
+            const_names = get_const_decl_names_set(entry.tree)
+        return _cheap_scores(
+            name,
+            entry.tree,
+            entry.size,
+            wl_score,
+            target_tree,
+            jaccard(target_consts, const_names),
+        )
+    except Exception as e:
+        print(f"Error processing {name}: {str(e)[:100]}")
+        return None
+
+
+def _cheap_corpus_task(item: tuple[int, float], shared: tuple):
+    theorem_id, wl_score = item
+    directory, target_tree, target_const_ids = shared
+    corpus = corpus_at(directory)
+    entry = cached_tree(corpus.names[theorem_id], lambda: corpus.tree_at(theorem_id))
+    if entry is None:
+        return None
+    return _cheap_scores(
+        theorem_id,
+        entry.tree,
+        entry.size,
+        wl_score,
+        target_tree,
+        jaccard(target_const_ids, corpus.const_ids_at(theorem_id)),
+    )
+
+
+def _zss_bounds(scored: list) -> list:
+    """(key, upper bound of the full score, wl_score) of cheap stage results."""
+    return [
+        (key, partial + ZSS_WEIGHT, wl_score)
+        for key, _, wl_score, _, _, partial in scored
+    ]
+
+
+def _zss_score(scored: tuple, theorem_tree: TreeNode, target_tree, target_size: int):
+    """process_theorem's full score from the cheap stage's components."""
+    key, size, wl_score, syntactic_similarity, const_similarity, _ = scored
+    distance = zss_edit_distance_TreeNode(target_tree, theorem_tree)
+    if distance == float("inf"):
+        return None
+    max_size = max(target_size, size)
+    similarity = 1 - (distance / max_size) if max_size > 0 else 0.0
+    similarity = (
+        WL_WEIGHT * wl_score
+        + ZSS_WEIGHT * similarity
+        + SYNTACTIC_WEIGHT * syntactic_similarity
+        + CONST_WEIGHT * const_similarity
+    )
+    return (key, similarity, wl_score)
+
+
+def _zss_task(item: tuple, shared: tuple):
+    scored, source = item
+    target_tree, target_size = shared
+    try:
+        entry = cached_tree(scored[0], lambda: candidate_tree(source))
+        return _zss_score(scored, entry.tree, target_tree, target_size)
+    except Exception as e:
+        print(f"Error)) processing {scored[0]}: {e}")
+        return None
+
+
+def _zss_corpus_task(scored: tuple, shared: tuple):
+    directory, target_tree, target_size = shared
+    corpus = corpus_at(directory)
+    theorem_id = scored[0]
+    entry = cached_tree(corpus.names[theorem_id], lambda: corpus.tree_at(theorem_id))
+    return _zss_score(scored, entry.tree, target_tree, target_size)
+
+
+def _record_stage(
+    stage_stats,
+    stage: str,
+    candidates: int,
+    survivors: int,
+    start: float,
+    partial: bool = False,
+):
+    seconds = time.perf_counter() - start
+    stage_stats.append(
+        {
+            "stage": stage,
+            "candidates": candidates,
+            "survivors": survivors,
+            "seconds": round(seconds, 4),
+            "partial": partial,
+        }
+    )
+    cut = " (time budget expired)" if partial else ""
+    print(f"Stage {stage}: {candidates} -> {survivors} candidates in {seconds:.3f}s{cut}")
+    logging.info(
+        f"Stage {stage}: {candidates} -> {survivors} candidates in {seconds:.3f}s{cut}"
+    )
+
+
+def expired(deadline: Optional[float]) -> bool:
+    """Whether a time.monotonic() deadline has passed; None never expires."""
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _named(results: list, corpus, use_corpus: bool) -> List[Tuple[str, float, float]]:
+    if use_corpus:
+        return [(corpus.names[key], similarity, wl) for key, similarity, wl in results]
+    return results
+
+
+def rerank_cascade(
+    filtered_results: List[Tuple[str, float]],
+    target_tree: TreeNode,
+    target_size: int,
+    k: int,
+    corpus=None,
+    candidate_exprs: Optional[dict] = None,
+    cheap_candidates: Optional[int] = None,
+    zss_candidates: Optional[int] = None,
+    stage_stats: Optional[list] = None,
+    deadline: Optional[float] = None,
+    progress: Optional[Callable[[str, list], None]] = None,
+) -> List[Tuple[str, float, float]]:
+    """
+    Rerank the WL candidates (best first) with process_theorem's score, in
+    stages of increasing cost:
+
+    1. cheap: collapse-match and constant similarity for the best
+       cheap_candidates by WL score (all if None)
+    2. zss: tree edit distance, only for targets of at most
+       ZSS_MAX_TARGET_SIZE nodes, for the best zss_candidates by the cheap
+       stage's partial score (all if None). Candidates are taken in rounds
+       of ZSS_ROUND_SIZE; once the partial score of the next one plus
+       ZSS_WEIGHT cannot reach the current k-th best, none of the rest can
+       enter the top k and the stage stops.
+
+    Without size limits the top k is the same as scoring every candidate.
+    With a deadline (time.monotonic()), each stage stops between rounds once
+    it has passed: the cheap stage after at least one round of
+    CHEAP_ROUND_SIZE, dropping the remaining (lower WL) candidates, and the
+    zss stage leaving the remaining candidates with their cheap score.
+
+    Returns (name, similarity, wl_score) for at least the top k candidates;
+    a {"stage", "candidates", "survivors", "seconds", "partial"} dict per
+    stage is appended to stage_stats. Before the zss stage and after each of
+    its rounds but the last, progress(stage, results) is called with the
+    ranking so far, candidates not reached yet scored with the upper bound
+    of their full score (cheap score plus ZSS_WEIGHT), so none of the
+    eventual top k drops out of it.
+    """
+    if stage_stats is None:
+        stage_stats = []
+    items = filtered_results[:cheap_candidates]
+    use_corpus = corpus is not None and corpus.has_trees
+
+    start = time.perf_counter()
+    if use_corpus:
+        target_const_ids = corpus.consts.lookup(get_const_decl_names_set(target_tree))
+        sources = None
+    else:
+        target_consts = get_const_decl_names_set(target_tree)
+        sources = {}
+    round_size = CHEAP_ROUND_SIZE if deadline is not None else max(1, len(items))
+    scored = []
+    done = 0
+    while done < len(items):
+        if done and expired(deadline):
+            break
+        round_items = items[done : done + round_size]
+        done += len(round_items)
+        if use_corpus:
+            round_scored = map_chunked(
+                _cheap_corpus_task,
+                [
+                    (corpus.ids[name], wl_score)
+                    for name, wl_score in round_items
+                    if name in corpus.ids
+                ],
+                shared=(corpus.directory, target_tree, target_const_ids),
+                kind="rerank_cheap_corpus",
+                desc="Cheap scores",
+            )
+        else:
+            const_names = {}
+            candidates = candidate_sources(round_items, candidate_exprs, const_names)
+            sources.update((name, source) for name, source, _ in candidates)
+            round_scored = map_chunked(
+                _cheap_task,
+                [
+                    (name, source, wl_score, const_names.get(name))
+                    for name, source, wl_score in candidates
+                ],
+                shared=(target_tree, target_consts),
+                kind="rerank_cheap",
+                desc="Cheap scores",
+            )
+        scored.extend(result for result in round_scored if result is not None)
+    _record_stage(
+        stage_stats, "cheap", len(items), len(scored), start, done < len(items)
+    )
+
+    if target_size > ZSS_MAX_TARGET_SIZE:
+        results = [(key, partial, wl_score) for key, _, wl_score, _, _, partial in scored]
+    else:
+        start = time.perf_counter()
+        ranked = sorted(scored, key=lambda x: x[5], reverse=True)[:zss_candidates]
+        if progress is not None:
+            progress("cheap", _named(_zss_bounds(ranked), corpus, use_corpus))
+        results = []
+        # k best similarities so far, the k-th at the root
+        best: list[float] = []
+        processed = 0
+        cut = False
+        while processed < len(ranked):
+            if len(best) >= k and ranked[processed][5] + ZSS_WEIGHT < best[0]:
+                break
+            if expired(deadline):
+                cut = True
+                break
+            round_items = ranked[processed : processed + ZSS_ROUND_SIZE]
+            processed += len(round_items)
+            if sources is None:
+                round_results = map_chunked(
+                    _zss_corpus_task,
+                    round_items,
+                    shared=(corpus.directory, target_tree, target_size),
+                    kind="rerank_zss_corpus",
+                    desc="ZSS scores",
+                )
+            else:
+                round_results = map_chunked(
+                    _zss_task,
+                    [(item, sources[item[0]]) for item in round_items],
+                    shared=(target_tree, target_size),
+                    kind="rerank_zss",
+                    desc="ZSS scores",
+                )
+            for result in filter(None, round_results):
+                results.append(result)
+                if len(best) < k:
+                    heapq.heappush(best, result[1])
+                elif result[1] > best[0]:
+                    heapq.heapreplace(best, result[1])
+            if progress is not None and processed < len(ranked):
+                progress(
+                    "zss",
+                    _named(results + _zss_bounds(ranked[processed:]), corpus, use_corpus),
+                )
+        if cut:
+            results.extend(
+                (key, partial, wl_score)
+                for key, _, wl_score, _, _, partial in ranked[processed:]
+            )
+        _record_stage(stage_stats, "zss", len(scored), processed, start, cut)
+
+    return _named(results, corpus, use_corpus)
+
+
 def calculate_overall_metrics(all_ranks):
     """Calculate overall evaluation metrics based on collected ranks."""
     k_values = [1, 5, 10]
@@ -185,6 +518,7 @@ def process_single_prop(target_name: str, target_expr: YourExpr, output_file: st
         node_ratio = 1.8
 
     # Load filtered theorems with WL scores
+    candidate_exprs = {}
     filtered_results, wl_stats = load_filtered_theorems(
         target_name=target_name,
         database_name="mathlib_filtered",
@@ -195,36 +529,30 @@ def process_single_prop(target_name: str, target_expr: YourExpr, output_file: st
         use_clustering=False,
         wl_iterations=3,  # 1,3,10,20,40,80
         debug=False,
+        candidate_exprs=candidate_exprs,
     )
     if wl_stats == False:
         return False
 
     simptree = simplify_forall_expr_iter(target_expr)
     precomputed_candidates = precompute_candidates(
-        filtered_results, your_expr_to_treenode(simptree)
+        filtered_results, your_expr_to_treenode(simptree), candidate_exprs
     )
 
     # Parallel computation of edit similarities
-    results = []
-
     target_tree = your_expr_to_treenode(simptree)
     # print(calculate_tree_depth(target_tree))
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-        future_to_name = {
-            executor.submit(
-                process_theorem, data, target_tree, target_node_count
-            ): data[0]
-            for data in precomputed_candidates
-        }
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_name),
-            total=len(future_to_name),
+    results = [
+        result
+        for result in map_chunked(
+            _process_theorem_task,
+            precomputed_candidates,
+            shared=(target_tree, target_node_count),
+            kind="process_theorem",
             desc=f"Processing {target_name}",
-            unit="thm",
-        ):
-            result = future.result()
-            if result is not None:
-                results.append(result)
+        )
+        if result is not None
+    ]
 
     results.sort(key=lambda x: x[1], reverse=True)
 
@@ -342,75 +670,208 @@ def fetch_theorem_details(conn, name: str) -> Tuple[Optional[str], Optional[int]
     except psycopg2.Error as e:
         print(f"Database error for theorem {name}: {e}")
         return None, None
-def process_single_prop_new(target_expr: YourExpr, k: int) -> list[tuple[str, float, str, int]]:
-    """Process a single proposition and return top k theorems with similarities."""
+# statement_str and node_count by theorem name; the corpus does not change
+# between queries, so entries never go stale until a reload
+_details_cache: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+_details_lock = threading.Lock()
+DETAILS_CACHE_SIZE = 20000
+
+
+def fetch_theorem_details_batch(
+    names: List[str],
+) -> dict[str, Tuple[Optional[str], Optional[int]]]:
+    """
+    statement_str and node_count for several theorems in one query, served
+    from the details cache where possible. Missing theorems map to (None, None).
+    """
+    details = {}
+    missing = []
+    with _details_lock:
+        for name in names:
+            if name in _details_cache:
+                _details_cache.move_to_end(name)
+                details[name] = _details_cache[name]
+            else:
+                missing.append(name)
+
+    if missing:
+        try:
+            with db_connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "SELECT name, statement_str, node_count FROM mathlib_filtered WHERE name = ANY(%s)",
+                    (missing,),
+                )
+                for name, statement_str, node_count in cur.fetchall():
+                    details[name] = (statement_str, node_count)
+        except psycopg2.Error as e:
+            print(f"Database error while fetching theorem details: {e}")
+        with _details_lock:
+            for name in missing:
+                if name in details:
+                    _details_cache[name] = details[name]
+            while len(_details_cache) > DETAILS_CACHE_SIZE:
+                _details_cache.popitem(last=False)
+
+    return {name: details.get(name, (None, None)) for name in names}
+
+
+def clear_details_cache():
+    with _details_lock:
+        _details_cache.clear()
+
+
+def top_k_with_details(
+    results: List[Tuple[str, float, float]], k: int, corpus=None
+) -> list[tuple[str, float, str, int]]:
+    """
+    The k best (name, similarity, wl_score) by similarity as (name,
+    similarity, statement_str, node_count), dropping theorems without details.
+    """
+    # Best k by similarity (descending), without sorting every candidate
+    results = heapq.nlargest(k, results, key=lambda x: x[1])
+
+    # Extract top k results (name, similarity)
+    top_k_results = []
+    if corpus is not None:
+        for name, similarity, _ in results:
+            statement_str, node_count = corpus.details(name)
+            if statement_str is not None and node_count is not None:
+                top_k_results.append((name, similarity, statement_str, node_count))
+            else:
+                print(f"Warning: Could not fetch details for theorem {name}")
+        return top_k_results
+
+    details = fetch_theorem_details_batch([name for name, _, _ in results])
+    for name, similarity, _ in results:
+        statement_str, node_count = details[name]
+        # Only include results with valid database entries
+        if statement_str is not None and node_count is not None:
+            top_k_results.append((name, similarity, statement_str, node_count))
+        else:
+            print(f"Warning: Could not fetch details for theorem {name}")
+
+    return top_k_results
+
+
+def process_single_prop_new(
+    target_expr: YourExpr,
+    k: int,
+    wl_index=None,
+    lsh_index=None,
+    wl_blend_alpha: float = 1.0,
+    corpus=None,
+    ivf_index=None,
+    n_probe: int | None = None,
+    node_ratio: float | None = None,
+    wl_candidates: int = 1500,
+    wl_iterations: int = 3,
+    use_clustering: bool = False,
+    cheap_candidates: int | None = None,
+    zss_candidates: int | None = None,
+    stage_stats: list | None = None,
+    deadline: float | None = None,
+    on_progress: Callable[[str, list], None] | None = None,
+    progress_k: int | None = None,
+) -> list[tuple[str, float, str, int]]:
+    """Process a single proposition and return top k theorems with similarities.
+
+    corpus (CorpusIndex), wl_index (WLInvertedIndex), lsh_index (WLLSHIndex)
+    and ivf_index (IVFIndex) are optional in-memory structures loaded at
+    startup; with the corpus index no database query is made, without any of
+    them the node count window is scanned from the database. For large node
+    windows, or with use_clustering, the ivf_index restricts retrieval to
+    the n_probe nearest clusters. Candidates are theorems within node_ratio
+    of the target's node count (1.2, or 1.8 for targets of 600 nodes or
+    more, if None), scored with wl_iterations WL iterations. wl_blend_alpha
+    weights the WL kernel against the collapse-match score during
+    retrieval; only values below 1 require candidate trees.
+
+    The wl_candidates best by WL score are reranked by rerank_cascade, with
+    cheap_candidates and zss_candidates bounding its stages; per-stage
+    timings and survivor counts are appended to stage_stats. Past deadline
+    (time.monotonic()), retrieval and reranking stop early and return the
+    best results found so far, with "partial" set on the stages cut short.
+
+    on_progress(stage, top_k), if given, receives the provisional top
+    progress_k (k if None) results in the returned format while the query
+    runs: the WL-only ranking once retrieval finishes ("wl", scored by WL
+    kernel), then the refined rankings of rerank_cascade ("cheap", "zss",
+    with upper bounds for candidates not fully scored yet).
+    """
+    if stage_stats is None:
+        stage_stats = []
 
     # Precompute target-related values
     target_tree = your_expr_to_treenode(target_expr)
     target_node_count = count_nodes(target_tree)
-    top_k = 1500  # Use provided k value
 
     # Adjust node ratio based on node count
-    node_ratio = 1.2
-    if target_node_count >= 600:
-        node_ratio = 1.8
+    if node_ratio is None:
+        node_ratio = 1.2
+        if target_node_count >= 600:
+            node_ratio = 1.8
 
     # Load filtered theorems with WL scores
+    start = time.perf_counter()
+    candidate_exprs = {}
     filtered_results, wl_stats = load_filtered_theorems(
         target_name="",  # No target name needed for ranking
         database_name="mathlib_filtered",
         target_expr=target_expr,
         node_ratio=node_ratio,
         batch_size=90000,
-        top_k=top_k,
-        use_clustering=False,
-        wl_iterations=3,
+        top_k=wl_candidates,
+        use_clustering=use_clustering,
+        wl_iterations=wl_iterations,
         debug=False,
+        wl_index=wl_index,
+        lsh_index=lsh_index,
+        wl_blend_alpha=wl_blend_alpha,
+        corpus=corpus,
+        candidate_exprs=candidate_exprs,
+        ivf_index=ivf_index,
+        n_probe=n_probe,
+        deadline=deadline,
     )
     if wl_stats == False:
         return []
-
-    # Simplify expression and precompute candidates
-    simptree = simplify_forall_expr_iter(target_expr)
-    precomputed_candidates = precompute_candidates(
-        filtered_results, your_expr_to_treenode(simptree)
+    _record_stage(
+        stage_stats,
+        "wl",
+        wl_stats.get("total_candidates", len(filtered_results)),
+        len(filtered_results),
+        start,
+        wl_stats.get("partial", False),
     )
+    progress = None
+    if on_progress is not None:
+        progress_k = progress_k or k
+        on_progress(
+            "wl",
+            top_k_with_details(
+                [(name, wl_score, wl_score) for name, wl_score in filtered_results],
+                progress_k,
+                corpus,
+            ),
+        )
 
-    # Parallel computation of edit similarities
-    results = []
-    target_tree = your_expr_to_treenode(simptree)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-        future_to_name = {
-            executor.submit(
-                process_theorem, data, target_tree, target_node_count
-            ): data[0]
-            for data in precomputed_candidates
-        }
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_name),
-            total=len(future_to_name),
-            desc="Processing theorems",
-            unit="thm",
-        ):
-            result = future.result()
-            if result is not None:
-                results.append(result)
-
-    # Sort results by similarity (descending)
-    results.sort(key=lambda x: x[1], reverse=True)
+        def progress(stage, results):
+            on_progress(stage, top_k_with_details(results, progress_k, corpus))
 
-    # Extract top k results (name, similarity)
-    top_k_results = []
-    conn = connect_to_db()
-    try:
-        for name, similarity, _ in results[:k]:
-            statement_str, node_count = fetch_theorem_details(conn, name)
-            # Only include results with valid database entries
-            if statement_str is not None and node_count is not None:
-                top_k_results.append((name, similarity, statement_str, node_count))
-            else:
-                print(f"Warning: Could not fetch details for theorem {name}")
-    finally:
-        conn.close()
-
-    return top_k_results
+    # Rerank against the simplified target
+    simptree = simplify_forall_expr_iter(target_expr)
+    target_tree = your_expr_to_treenode(simptree)
+    results = rerank_cascade(
+        filtered_results,
+        target_tree,
+        target_node_count,
+        k,
+        corpus=corpus,
+        candidate_exprs=candidate_exprs,
+        cheap_candidates=cheap_candidates,
+        zss_candidates=zss_candidates,
+        stage_stats=stage_stats,
+        deadline=deadline,
+        progress=progress,
+    )
+    return top_k_with_details(results, k, corpus)
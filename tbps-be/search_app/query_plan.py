@@ -0,0 +1,119 @@
+import os
+from dataclasses import asdict, dataclass
+
+# Retrieval and reranking of process_single_prop_new when a query sets nothing
+DEFAULT_WL_CANDIDATES = 1500
+DEFAULT_WL_ITERATIONS = 3
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """
+    Per-query options of process_single_prop_new: node_ratio (None picks it
+    from the target size), WL candidates retrieved for reranking, WL
+    iterations, clustered retrieval and the clusters it probes (n_probe,
+    None for the index default), and the candidates of the cheap and zss
+    rerank stages (None for all).
+    """
+
+    node_ratio: float | None = None
+    wl_candidates: int = DEFAULT_WL_CANDIDATES
+    wl_iterations: int = DEFAULT_WL_ITERATIONS
+    use_clustering: bool = False
+    n_probe: int | None = None
+    cheap_candidates: int | None = None
+    zss_candidates: int | None = None
+
+    def kwargs(self) -> dict:
+        """Keyword arguments of process_single_prop_new."""
+        return asdict(self)
+
+
+@dataclass(frozen=True)
+class QueryLimits:
+    """Server-side caps on what a single query may request."""
+
+    max_wl_candidates: int = 5000
+    max_zss_candidates: int = 2000
+    max_n_probe: int = 8192
+    # Only iteration counts with a corpus or index avoid a full database scan
+    wl_iterations: tuple[int, ...] = (DEFAULT_WL_ITERATIONS,)
+
+
+def default_query_limits() -> QueryLimits:
+    """
+    Caps from TBPS_MAX_WL_CANDIDATES, TBPS_MAX_ZSS_CANDIDATES,
+    TBPS_MAX_N_PROBE and TBPS_WL_ITERATIONS (comma-separated iteration counts
+    with stored encodings), else the QueryLimits defaults.
+    """
+    defaults = QueryLimits()
+    iterations = os.environ.get("TBPS_WL_ITERATIONS")
+    return QueryLimits(
+        max_wl_candidates=int(
+            os.environ.get("TBPS_MAX_WL_CANDIDATES", defaults.max_wl_candidates)
+        ),
+        max_zss_candidates=int(
+            os.environ.get("TBPS_MAX_ZSS_CANDIDATES", defaults.max_zss_candidates)
+        ),
+        max_n_probe=int(os.environ.get("TBPS_MAX_N_PROBE", defaults.max_n_probe)),
+        wl_iterations=(
+            tuple(int(k) for k in iterations.split(",") if k.strip())
+            if iterations
+            else defaults.wl_iterations
+        ),
+    )
+
+
+def query_plan(
+    limits: QueryLimits,
+    node_ratio: float | None = None,
+    wl_candidates: int | None = None,
+    wl_iterations: int | None = None,
+    use_clustering: bool | None = None,
+    n_probe: int | None = None,
+    cheap_candidates: int | None = None,
+    zss_candidates: int | None = None,
+) -> QueryPlan:
+    """
+    QueryPlan of a request, None standing for the default. Raises ValueError
+    for options beyond the server's limits; unset options are capped instead.
+    """
+    wl_candidates = wl_candidates or min(
+        DEFAULT_WL_CANDIDATES, limits.max_wl_candidates
+    )
+    if not wl_iterations:
+        wl_iterations = (
+            DEFAULT_WL_ITERATIONS
+            if DEFAULT_WL_ITERATIONS in limits.wl_iterations
+            else limits.wl_iterations[0]
+        )
+    if wl_candidates > limits.max_wl_candidates:
+        raise ValueError(
+            f"wl_candidates must be at most {limits.max_wl_candidates} on this server"
+        )
+    if wl_iterations not in limits.wl_iterations:
+        raise ValueError(
+            f"wl_iterations must be one of {list(limits.wl_iterations)} on this server"
+        )
+    if n_probe is not None and n_probe > limits.max_n_probe:
+        raise ValueError(f"n_probe must be at most {limits.max_n_probe} on this server")
+    if zss_candidates is not None and zss_candidates > limits.max_zss_candidates:
+        raise ValueError(
+            f"zss_candidates must be at most {limits.max_zss_candidates} on this server"
+        )
+    # Unbounded, the zss stage would take every cheap survivor
+    if (
+        zss_candidates is None
+        and min(wl_candidates, cheap_candidates or wl_candidates)
+        > limits.max_zss_candidates
+    ):
+        zss_candidates = limits.max_zss_candidates
+    return QueryPlan(
+        node_ratio=node_ratio,
+        wl_candidates=wl_candidates,
+        wl_iterations=wl_iterations,
+        use_clustering=bool(use_clustering),
+        n_probe=n_probe,
+        cheap_candidates=cheap_candidates,
+        zss_candidates=zss_candidates,
+    )
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+def default_result_cache_size() -> int:
+    """Cached queries, from TBPS_RESULT_CACHE_SIZE; 0 disables the cache."""
+    return int(os.environ.get("TBPS_RESULT_CACHE_SIZE", 2048))
+
+
+def default_result_cache_ttl() -> float:
+    """Seconds a cached result is served, from TBPS_RESULT_CACHE_TTL."""
+    return float(os.environ.get("TBPS_RESULT_CACHE_TTL", 3600))
+
+
+# Largest default cache depth: a deeper search prunes less of the zss stage
+MAX_DEFAULT_CACHE_DEPTH = 50
+
+
+def default_result_cache_depth() -> int | None:
+    """Results cached per query from TBPS_RESULT_CACHE_DEPTH, None if unset."""
+    configured = os.environ.get("TBPS_RESULT_CACHE_DEPTH")
+    return int(configured) if configured else None
+
+
+def result_cache_depth(k: int, configured: int | None = None) -> int:
+    """
+    Results searched for and cached for a request of k when the cache is on,
+    so later requests for any k up to it hit: configured if set, else 2k up
+    to MAX_DEFAULT_CACHE_DEPTH, and never fewer than k.
+    """
+    if configured is None:
+        configured = min(2 * k, MAX_DEFAULT_CACHE_DEPTH)
+    return max(k, configured)
+
+
+class TTLCache:
+    """
+    LRU cache whose entries also expire ttl seconds after they were stored.
+    Thread-safe, for handlers that search in several threads at once.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expiry time.monotonic(), value)
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+            }
@@ -0,0 +1,151 @@
+import argparse
+from typing import Optional
+
+from psycopg2.extras import execute_values
+from tqdm import tqdm
+
+from search_app.myexpr import deserialize_expr, simplify_forall_expr_iter
+from search_app.compute.zss_compute import (
+    TreeNode,
+    your_expr_to_treenode,
+    get_const_decl_names_set,
+)
+from search_app.compute.tree_codec import encode_tree_bytes, decode_tree_bytes
+from search_app.WL_embedding.db_utils import connect_to_db, fetch_theorems_batch
+from search_app.workers import get_pool
+
+# Columns written by store_simp_trees; simp_node_count already holds the size
+SIMP_TREE_COLUMNS = {
+    "simp_tree": "bytea",
+    "const_names": "text[]",
+}
+
+
+def candidate_tree(source) -> TreeNode:
+    """
+    Simplified candidate tree from a stored simp_tree (bytes) or, for rows
+    not yet preprocessed, from expr_cse_json.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return decode_tree_bytes(bytes(source))
+    return your_expr_to_treenode(simplify_forall_expr_iter(deserialize_expr(source)))
+
+
+def simp_tree_source(simp_tree, expr_json):
+    """The column to build a candidate from: simp_tree when it has been stored."""
+    return simp_tree if simp_tree is not None else expr_json
+
+
+_has_simp_tree: dict[str, bool] = {}
+
+
+def simp_tree_columns(
+    conn, table_name: str, alias: str = "d", with_const_names: bool = False
+) -> str:
+    """
+    SELECT list giving (simp_tree, expr_cse_json) for table_name, where
+    expr_cse_json is only sent for rows without a stored tree, followed by
+    const_names if with_const_names. Falls back to expr_cse_json alone (and
+    NULL const_names) while the ingest has not added the columns.
+    """
+    if table_name not in _has_simp_tree:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = %s AND column_name = 'simp_tree'
+            """,
+                (table_name,),
+            )
+            _has_simp_tree[table_name] = cur.fetchone() is not None
+    if _has_simp_tree[table_name]:
+        columns = (
+            f"{alias}.simp_tree, "
+            f"CASE WHEN {alias}.simp_tree IS NULL THEN {alias}.expr_cse_json END"
+        )
+        const_names = f"{alias}.const_names"
+    else:
+        columns = f"NULL::bytea, {alias}.expr_cse_json"
+        const_names = "NULL::text[]"
+    return f"{columns}, {const_names}" if with_const_names else columns
+
+
+def simp_tree_row(theorem: tuple) -> Optional[tuple]:
+    """(name, simp_tree, const_names) for a (name, expr_cse_json) row."""
+    name, expr_json = theorem
+    try:
+        tree = candidate_tree(expr_json)
+        return (
+            name,
+            encode_tree_bytes(tree),
+            sorted(get_const_decl_names_set(tree)),
+        )
+    except Exception as e:
+        print(f"Failed to simplify {name}: {str(e)[:100]}")
+        return None
+
+
+def ensure_simp_tree_columns(conn, table_name: str):
+    with conn.cursor() as cur:
+        for column, column_type in SIMP_TREE_COLUMNS.items():
+            cur.execute(
+                f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column} {column_type}"
+            )
+    conn.commit()
+
+
+def store_simp_trees(table_name: str = "mathlib_filtered", batch_size: int = 5000):
+    """
+    One-time ingest: store the forall-simplified tree of every theorem with
+    its constant names, so queries decode it instead of
+    deserializing and simplifying expr_cse_json again. Rerun after adding
+    theorems; it recomputes every row.
+    """
+    conn = connect_to_db()
+    if conn is None:
+        return
+    ensure_simp_tree_columns(conn, table_name)
+    executor = get_pool()
+
+    last_name = None
+    stored = 0
+    with tqdm(desc="Storing simplified trees") as pbar:
+        while True:
+            theorems = fetch_theorems_batch(conn, table_name, last_name, batch_size)
+            if not theorems:
+                break
+            last_name = theorems[-1][0]
+            rows = [
+                row
+                for row in executor.map(simp_tree_row, theorems, chunksize=64)
+                if row is not None
+            ]
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    f"""
+                    UPDATE {table_name} AS d
+                    SET simp_tree = v.simp_tree,
+                        const_names = v.const_names
+                    FROM (VALUES %s) AS v (name, simp_tree, const_names)
+                    WHERE d.name = v.name
+                """,
+                    rows,
+                    template="(%s, %s::bytea, %s::text[])",
+                )
+            conn.commit()
+            stored += len(rows)
+            pbar.update(len(theorems))
+
+    conn.close()
+    print(f"Stored {stored} simplified trees in {table_name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the simplified tree columns of the theorem table"
+    )
+    parser.add_argument("--table-name", default="mathlib_filtered")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+    store_simp_trees(args.table_name, args.batch_size)
@@ -0,0 +1,69 @@
+from search_app.canonical import canonical_key, canonicalize
+from search_app.cse import cse
+from search_app.myexpr import App, BVar, Const, FVar, ForallE, MVar, Sort
+
+NAT = Const("Nat", [])
+
+
+def apply(fn, *args):
+    for arg in args:
+        fn = App(fn, arg)
+    return fn
+
+
+def add(x, y):
+    hadd = Const("HAdd.hAdd", ["0", "0", "0"])
+    return apply(hadd, NAT, NAT, NAT, Const("instHAdd", ["0"]), x, y)
+
+
+def eq(x, y):
+    return apply(Const("Eq", ["1"]), NAT, x, y)
+
+
+def forall2(a, b, body):
+    return ForallE(a, NAT, ForallE(b, NAT, body, "default"), "default")
+
+
+def add_comm(a, b):
+    """∀ a b : Nat, a + b = b + a"""
+    return forall2(a, b, eq(add(BVar(1), BVar(0)), add(BVar(0), BVar(1))))
+
+
+def test_alpha_variants_share_a_key():
+    assert canonical_key(add_comm("a", "b")) == canonical_key(add_comm("x", "y"))
+
+
+def test_alpha_variants_share_a_key_after_cse():
+    assert canonical_key(cse(add_comm("a", "b"))) == canonical_key(cse(add_comm("x", "y")))
+
+
+def test_non_equivalent_bodies_do_not_collide():
+    # ∀ a b, a + b = a + b
+    other = forall2("a", "b", eq(add(BVar(1), BVar(0)), add(BVar(1), BVar(0))))
+    assert canonical_key(other) != canonical_key(add_comm("a", "b"))
+    assert canonical_key(cse(other)) != canonical_key(cse(add_comm("a", "b")))
+
+
+def test_binder_order_matters():
+    # ∀ a b, b + a = a + b is add_comm with the binders swapped, not renamed
+    swapped = forall2("a", "b", eq(add(BVar(0), BVar(1)), add(BVar(1), BVar(0))))
+    assert canonical_key(swapped) != canonical_key(add_comm("a", "b"))
+
+
+def test_free_variables_are_numbered_by_first_occurrence():
+    assert canonicalize(eq(FVar("_uniq.40"), FVar("_uniq.12"))) == eq(FVar("v0"), FVar("v1"))
+    assert canonical_key(eq(FVar("p"), FVar("q"))) != canonical_key(eq(FVar("p"), FVar("p")))
+
+
+def test_uniq_ids_are_renumbered():
+    assert canonicalize(Sort("?_uniq.71")) == Sort("?_uniq 0")
+    assert canonical_key(App(MVar("_uniq.71"), MVar("_uniq.3"))) == canonical_key(
+        App(MVar("_uniq.5"), MVar("_uniq.9"))
+    )
+    # The same metavariable twice is not two different ones
+    assert canonical_key(App(MVar("_uniq.5"), MVar("_uniq.5"))) != canonical_key(
+        App(MVar("_uniq.5"), MVar("_uniq.9"))
+    )
+    assert canonicalize(Const("List.nil", ["Lean.Name.mkNum `_uniq 71"])) == Const(
+        "List.nil", ["Lean.Name.mkNum `_uniq 0"]
+    )
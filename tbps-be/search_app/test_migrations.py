@@ -0,0 +1,72 @@
+import pytest
+
+from search_app import migrations
+from search_app.migrations import clear_search_view_cache, search_view_columns
+
+
+class FakeConnection:
+    """Answers the queries of search_view_columns, counting them."""
+
+    def __init__(self, state):
+        self.state = state
+        self.queries = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.queries += 1
+        if "to_regclass" in query:
+            self.rows = [(True,)]
+        elif "base_version" in query:
+            self.rows = [self.conn.state]
+        else:
+            self.rows = [("name",), ("simp_wl_encode_3",)]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    clear_search_view_cache()
+    yield
+    clear_search_view_cache()
+
+
+def test_state_is_read_once_per_interval(monkeypatch):
+    conn = FakeConnection((1, 1, "t1"))
+    assert search_view_columns(conn) == {"name", "simp_wl_encode_3"}
+    queries = conn.queries
+    for _ in range(10):
+        assert search_view_columns(conn) == {"name", "simp_wl_encode_3"}
+    assert conn.queries == queries
+
+    # A write makes the view stale; noticed once the interval has passed
+    conn.state = (2, 1, "t1")
+    monkeypatch.setattr(migrations, "SEARCH_VIEW_CHECK_SECONDS", 0.0)
+    assert search_view_columns(conn) == set()
+
+
+def test_clearing_reads_the_state_again():
+    conn = FakeConnection((2, 1, "t1"))
+    assert search_view_columns(conn) == set()
+    conn.state = (2, 2, "t2")
+    assert search_view_columns(conn) == set()
+    clear_search_view_cache()
+    assert search_view_columns(conn) == {"name", "simp_wl_encode_3"}
@@ -0,0 +1,74 @@
+import pytest
+
+from search_app.query_plan import (
+    DEFAULT_WL_CANDIDATES,
+    DEFAULT_WL_ITERATIONS,
+    QueryLimits,
+    QueryPlan,
+    default_query_limits,
+    query_plan,
+)
+
+
+def test_unset_options_take_the_defaults():
+    assert query_plan(QueryLimits()) == QueryPlan(
+        wl_candidates=DEFAULT_WL_CANDIDATES, wl_iterations=DEFAULT_WL_ITERATIONS
+    )
+
+
+def test_options_within_the_limits_are_kept():
+    plan = query_plan(
+        QueryLimits(),
+        node_ratio=1.5,
+        wl_candidates=3000,
+        use_clustering=True,
+        n_probe=64,
+        cheap_candidates=500,
+        zss_candidates=100,
+    )
+    assert plan.kwargs() == {
+        "node_ratio": 1.5,
+        "wl_candidates": 3000,
+        "wl_iterations": DEFAULT_WL_ITERATIONS,
+        "use_clustering": True,
+        "n_probe": 64,
+        "cheap_candidates": 500,
+        "zss_candidates": 100,
+    }
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"wl_candidates": 5001},
+        {"wl_iterations": 5},
+        {"n_probe": 8193},
+        {"zss_candidates": 2001},
+    ],
+)
+def test_options_beyond_the_limits_are_rejected(options):
+    with pytest.raises(ValueError):
+        query_plan(QueryLimits(), **options)
+
+
+def test_defaults_are_capped_by_the_limits():
+    limits = QueryLimits(max_wl_candidates=800, wl_iterations=(1,))
+    plan = query_plan(limits)
+    assert (plan.wl_candidates, plan.wl_iterations) == (800, 1)
+
+
+def test_unset_zss_candidates_is_capped():
+    limits = QueryLimits(max_zss_candidates=200)
+    assert query_plan(limits, wl_candidates=1000).zss_candidates == 200
+    assert query_plan(limits, wl_candidates=1000, cheap_candidates=150).zss_candidates is None
+    assert query_plan(limits, wl_candidates=150).zss_candidates is None
+
+
+def test_default_query_limits_from_the_environment(monkeypatch):
+    monkeypatch.setenv("TBPS_MAX_WL_CANDIDATES", "800")
+    monkeypatch.setenv("TBPS_WL_ITERATIONS", "1, 3,")
+    limits = default_query_limits()
+    assert limits.max_wl_candidates == 800
+    assert limits.wl_iterations == (1, 3)
+    assert limits.max_zss_candidates == QueryLimits().max_zss_candidates
+    assert query_plan(limits, wl_iterations=1).wl_iterations == 1
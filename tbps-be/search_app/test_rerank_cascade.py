@@ -0,0 +1,119 @@
+import heapq
+import random
+
+import pytest
+
+from search_app import process_single
+from search_app.compute.zss_compute import (
+    can_t1_collapse_match_t2_soft,
+    count_nodes,
+    your_expr_to_treenode,
+)
+from search_app.cse import cse
+from search_app.myexpr import (
+    App,
+    BVar,
+    Const,
+    ForallE,
+    Sort,
+    serialize_expr,
+    simplify_forall_expr_iter,
+)
+from search_app.process_single import process_theorem, rerank_cascade
+from search_app.simp_trees import candidate_tree
+from search_app.WL_embedding.wl_kernel import compute_wl_encoding, compute_wl_kernel
+from search_app.workers import init_pool, shutdown_pool
+
+CONSTS = ["Nat", "HAdd.hAdd", "Eq", "HMul.hMul", "List.length", "Set.union", "Not"]
+K = 5
+
+
+def random_expr(rng, depth, binders=0):
+    if depth == 0 or rng.random() < 0.2:
+        choice = rng.random()
+        if choice < 0.4 and binders:
+            return BVar(rng.randrange(binders))
+        if choice < 0.8:
+            return Const(rng.choice(CONSTS), [])
+        return Sort("u")
+    if rng.random() < 0.7:
+        return App(
+            random_expr(rng, depth - 1, binders), random_expr(rng, depth - 1, binders)
+        )
+    return ForallE(
+        f"x{binders}",
+        random_expr(rng, depth - 1, binders),
+        random_expr(rng, depth - 1, binders + 1),
+        "default",
+    )
+
+
+@pytest.fixture(scope="module")
+def search():
+    init_pool(2)
+    rng = random.Random(0)
+    target = your_expr_to_treenode(
+        simplify_forall_expr_iter(cse(random_expr(rng, 4)))
+    )
+    target_encoding, _ = compute_wl_encoding(target, max_h=3)
+    exprs, filtered_results = {}, []
+    for i in range(120):
+        expr_json = serialize_expr(cse(random_expr(rng, rng.randint(2, 5))))
+        encoding, _ = compute_wl_encoding(candidate_tree(expr_json), max_h=3)
+        exprs[f"thm{i}"] = expr_json
+        filtered_results.append(
+            (f"thm{i}", compute_wl_kernel(target_encoding, encoding))
+        )
+    filtered_results.sort(key=lambda x: x[1], reverse=True)
+    yield target, exprs, filtered_results
+    shutdown_pool()
+
+
+def exhaustive(target, exprs, filtered_results):
+    results = []
+    for name, wl_score in filtered_results:
+        tree = candidate_tree(exprs[name])
+        data = (
+            name,
+            tree,
+            count_nodes(tree),
+            wl_score,
+            can_t1_collapse_match_t2_soft(target, tree),
+        )
+        result = process_theorem(data, target, count_nodes(target))
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def top_k(results):
+    return [
+        (name, pytest.approx(similarity))
+        for name, similarity, _ in heapq.nlargest(K, results, key=lambda x: x[1])
+    ]
+
+
+def test_unlimited_cascade_matches_exhaustive_scoring(search):
+    target, exprs, filtered_results = search
+    results = rerank_cascade(
+        filtered_results, target, count_nodes(target), K, candidate_exprs=dict(exprs)
+    )
+    assert top_k(results) == top_k(exhaustive(target, exprs, filtered_results))
+
+
+def test_pruning_keeps_the_top_k(search, monkeypatch):
+    target, exprs, filtered_results = search
+    # Small rounds, so the zss stage stops well before the last candidate
+    monkeypatch.setattr(process_single, "ZSS_ROUND_SIZE", 4)
+    stage_stats = []
+    results = rerank_cascade(
+        filtered_results,
+        target,
+        count_nodes(target),
+        K,
+        candidate_exprs=dict(exprs),
+        stage_stats=stage_stats,
+    )
+    zss = next(stats for stats in stage_stats if stats["stage"] == "zss")
+    assert zss["survivors"] < zss["candidates"]
+    assert top_k(results) == top_k(exhaustive(target, exprs, filtered_results))
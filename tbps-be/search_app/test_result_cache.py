@@ -0,0 +1,26 @@
+from search_app.result_cache import (
+    MAX_DEFAULT_CACHE_DEPTH,
+    default_result_cache_depth,
+    result_cache_depth,
+)
+
+
+def test_default_depth_is_twice_k_up_to_the_cap():
+    assert result_cache_depth(5) == 10
+    assert result_cache_depth(20) == 40
+    assert result_cache_depth(40) == MAX_DEFAULT_CACHE_DEPTH
+    # Never fewer results than requested
+    assert result_cache_depth(80) == 80
+
+
+def test_configured_depth_overrides_the_default():
+    assert result_cache_depth(5, 30) == 30
+    assert result_cache_depth(50, 30) == 50
+    assert result_cache_depth(20, 0) == 20
+
+
+def test_depth_from_the_environment(monkeypatch):
+    monkeypatch.delenv("TBPS_RESULT_CACHE_DEPTH", raising=False)
+    assert default_result_cache_depth() is None
+    monkeypatch.setenv("TBPS_RESULT_CACHE_DEPTH", "100")
+    assert default_result_cache_depth() == 100
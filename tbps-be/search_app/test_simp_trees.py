@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from search_app.compute.tree_codec import decode_tree_bytes, encode_tree_bytes
+from search_app.compute.zss_compute import (
+    get_const_decl_names_set,
+    your_expr_to_treenode,
+)
+from search_app.myexpr import (
+    App,
+    BVar,
+    Const,
+    FVar,
+    ForallE,
+    Lam,
+    LetE,
+    Lit,
+    MData,
+    MVar,
+    Proj,
+    Sort,
+    deserialize_expr,
+    serialize_expr,
+    simplify_forall_expr_iter,
+)
+from search_app.simp_trees import candidate_tree, simp_tree_row
+
+
+def random_expr(rng, depth, binders=0):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(
+            [
+                lambda: BVar(rng.randrange(binders)) if binders else Sort("u"),
+                lambda: FVar(f"_uniq.{rng.randrange(5)}"),
+                lambda: MVar(f"?m{rng.randrange(5)}"),
+                lambda: Sort(rng.choice(["u", "0", "max u v"])),
+                lambda: Const(f"C{rng.randrange(400)}.ℝ", rng.choice([[], ["u"]])),
+                lambda: Lit(str(rng.randrange(100))),
+            ]
+        )()
+    nested = lambda: random_expr(rng, depth - 1, binders)  # noqa: E731
+    under = lambda: random_expr(rng, depth - 1, binders + 1)  # noqa: E731
+    return rng.choice(
+        [
+            lambda: App(nested(), nested()),
+            lambda: Lam(f"x{binders}", nested(), under(), "default"),
+            lambda: ForallE(f"x{binders}", nested(), under(), "implicit"),
+            lambda: LetE(f"y{binders}", nested(), nested(), under(), False),
+            lambda: MData("{}", nested()),
+            lambda: Proj("Prod", rng.randrange(2), nested()),
+        ]
+    )()
+
+
+def expressions(count=60):
+    rng = random.Random(0)
+    return [serialize_expr(random_expr(rng, rng.randint(1, 8))) for _ in range(count)]
+
+
+@pytest.mark.parametrize("expr_json", expressions())
+def test_stored_tree_round_trips(expr_json):
+    tree = your_expr_to_treenode(simplify_forall_expr_iter(deserialize_expr(expr_json)))
+    assert decode_tree_bytes(encode_tree_bytes(tree)) == tree
+    assert candidate_tree(encode_tree_bytes(tree)) == tree
+
+
+@pytest.mark.parametrize("expr_json", expressions())
+def test_ingested_row_matches_the_expression(expr_json):
+    tree = your_expr_to_treenode(simplify_forall_expr_iter(deserialize_expr(expr_json)))
+    name, simp_tree, const_names = simp_tree_row(("thm", expr_json))
+    assert name == "thm"
+    assert decode_tree_bytes(simp_tree) == tree
+    assert set(const_names) == get_const_decl_names_set(tree)
+    assert const_names == sorted(const_names)
+
+
+def test_wide_vocabulary_round_trips():
+    # More distinct labels than one-byte label ids can hold
+    level = [Const(f"C{i}", []) for i in range(600)]
+    while len(level) > 1:
+        level = [App(*level[i : i + 2]) for i in range(0, len(level) - 1, 2)] + (
+            level[-1:] if len(level) % 2 else []
+        )
+    tree = your_expr_to_treenode(level[0])
+    assert decode_tree_bytes(encode_tree_bytes(tree)) == tree
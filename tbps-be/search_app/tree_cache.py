@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from search_app.compute.zss_compute import TreeNode, count_nodes
+
+
+def default_max_nodes() -> int:
+    """Per-process bound on cached tree nodes, from TBPS_TREE_CACHE_NODES."""
+    return int(os.environ.get("TBPS_TREE_CACHE_NODES", 500000))
+
+
+class CachedTree:
+    """A simplified candidate tree and its node count."""
+
+    __slots__ = ("tree", "size")
+
+    def __init__(self, tree: TreeNode, size: int):
+        self.tree = tree
+        self.size = size
+
+
+# hits, misses, evictions; handed to every worker process by the pool
+# initializer, so all of them add to the same counters. Not a fork-context
+# lock, which could not be sent to workers from a fork server
+_HITS, _MISSES, _EVICTIONS = range(3)
+_counters = multiprocessing.get_context("spawn").Array("q", 3)
+
+
+class TreeCache:
+    """
+    LRU cache of candidate trees keyed by theorem name, bounded by the total
+    node count of the cached trees. Each process has its own; retrieval and
+    reranking tasks running in the same worker share it across queries.
+    Cached trees are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_nodes: int):
+        self.max_nodes = max_nodes
+        self.entries: OrderedDict[str, CachedTree] = OrderedDict()
+        self.nodes = 0
+
+    def get(
+        self, name: str, build: Callable[[], Optional[TreeNode]]
+    ) -> Optional[CachedTree]:
+        """The cached entry for name, calling build() on a miss."""
+        entry = self.entries.get(name)
+        if entry is not None:
+            self.entries.move_to_end(name)
+            _add(_HITS, 1)
+            return entry
+        _add(_MISSES, 1)
+        tree = build()
+        if tree is None:
+            return None
+        entry = CachedTree(tree, count_nodes(tree))
+        if entry.size <= self.max_nodes:
+            self.entries[name] = entry
+            self.nodes += entry.size
+            self._evict()
+        return entry
+
+    def _evict(self):
+        while self.nodes > self.max_nodes:
+            _, entry = self.entries.popitem(last=False)
+            self.nodes -= entry.size
+            _add(_EVICTIONS, 1)
+
+    def clear(self):
+        self.entries.clear()
+        self.nodes = 0
+
+
+def shared_counters():
+    return _counters
+
+
+def use_shared_counters(counters):
+    """Count into the server's counters (in a worker process)."""
+    global _counters
+    _counters = counters
+
+
+def _add(counter: int, value: int):
+    with _counters.get_lock():
+        _counters[counter] += value
+
+
+_cache: Optional[TreeCache] = None
+
+
+def get_tree_cache() -> TreeCache:
+    """This process's tree cache."""
+    global _cache
+    if _cache is None:
+        _cache = TreeCache(default_max_nodes())
+    return _cache
+
+
+def cached_tree(
+    name: str, build: Callable[[], Optional[TreeNode]]
+) -> Optional[CachedTree]:
+    return get_tree_cache().get(name, build)
+
+
+def tree_cache_stats() -> dict:
+    """Hit rate of the tree caches, summed over all processes."""
+    with _counters.get_lock():
+        hits, misses, evictions = _counters[:]
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        "evictions": evictions,
+        "max_nodes_per_process": default_max_nodes(),
+    }
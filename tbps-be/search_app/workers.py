@@ -0,0 +1,271 @@
+import atexit
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from search_app.tree_cache import shared_counters, use_shared_counters
+
+_pool: ProcessPoolExecutor | None = None
+_pool_size = 0
+# map_chunked calls running on each pool, so that a replaced pool is shut
+# down only once the calls holding it have collected their results
+_pool_users: dict[ProcessPoolExecutor, int] = {}
+_pool_changed = threading.Condition()
+
+# Corpus index visible to worker processes, set by the pool initializer
+_corpus = None
+
+# Measured seconds per item for each task kind, used to size chunks
+_item_seconds: dict[str, float] = {}
+# Target wall time of one chunk: long enough to amortize IPC, short enough
+# to keep the workers balanced
+CHUNK_SECONDS = 0.05
+CHUNKS_PER_WORKER = 4
+
+# Shared payloads already unpickled in this worker process, by content hash
+_shared_cache: OrderedDict = OrderedDict()
+_SHARED_CACHE_SIZE = 4
+
+# Shared payloads written for the workers, by content hash: [file path,
+# map_chunked calls using it]. Chunks carry only the key and path, so each
+# worker reads a payload once instead of receiving it with every chunk
+_published: OrderedDict[str, list] = OrderedDict()
+_published_lock = threading.Lock()
+_PUBLISHED_SIZE = 16
+_shared_dir: str | None = None
+
+
+def default_pool_size() -> int:
+    """Worker count from TBPS_WORKERS, else the CPUs available to this process."""
+    configured = os.environ.get("TBPS_WORKERS")
+    if configured:
+        return max(1, int(configured))
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+def _init_worker(corpus, tree_cache_counters):
+    global _corpus
+    _corpus = corpus
+    use_shared_counters(tree_cache_counters)
+    # Import the scoring modules up front rather than on the first task
+    import search_app.compute.zss_compute  # noqa: F401
+    import search_app.myexpr  # noqa: F401
+    import search_app.WL_embedding.wl_kernel  # noqa: F401
+
+
+def _warm_up() -> int:
+    return os.getpid()
+
+
+def worker_corpus():
+    """The corpus index the pool was started with (inside a worker), or None."""
+    return _corpus
+
+
+def _mp_context(replacing: bool):
+    # Only the first pool is forked: it starts before the server runs any
+    # threads. A replacement is started from a thread of the running server,
+    # where forking could copy locks held by other threads, so its workers
+    # come from a fork server and open the saved corpus by location
+    methods = multiprocessing.get_all_start_methods()
+    if not replacing and "fork" in methods:
+        return multiprocessing.get_context("fork")
+    if replacing and "forkserver" in methods:
+        return multiprocessing.get_context("forkserver")
+    return None
+
+
+def init_pool(max_workers: int | None = None, corpus=None) -> ProcessPoolExecutor:
+    """
+    (Re)start the shared worker pool. The first pool is forked where the
+    platform allows it, so the corpus index is inherited copy-on-write rather
+    than pickled into every worker. All workers are started and initialized
+    before this returns; the previous pool is shut down once the map_chunked
+    calls still using it have finished.
+    """
+    global _pool, _pool_size
+    max_workers = max_workers or default_pool_size()
+    pool = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=_mp_context(replacing=_pool is not None),
+        initializer=_init_worker,
+        initargs=(corpus, shared_counters()),
+    )
+    for future in [pool.submit(_warm_up) for _ in range(max_workers)]:
+        future.result()
+
+    with _pool_changed:
+        previous, _pool, _pool_size = _pool, pool, max_workers
+        if previous is not None:
+            _pool_changed.wait_for(lambda: not _pool_users.get(previous))
+            _pool_users.pop(previous, None)
+    if previous is not None:
+        previous.shutdown(wait=True)
+    logging.info(f"Started worker pool with {max_workers} processes")
+    return pool
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """The shared worker pool, started with default settings on first use."""
+    with _pool_changed:
+        if _pool is None:
+            init_pool()
+        return _pool
+
+
+def _acquire_pool() -> ProcessPoolExecutor:
+    with _pool_changed:
+        pool = get_pool()
+        _pool_users[pool] = _pool_users.get(pool, 0) + 1
+        return pool
+
+
+def _release_pool(pool: ProcessPoolExecutor):
+    with _pool_changed:
+        _pool_users[pool] -= 1
+        _pool_changed.notify_all()
+
+
+def pool_size() -> int:
+    return _pool_size
+
+
+def shutdown_pool():
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool, _pool_size = None, 0
+
+
+def _shared_directory() -> str:
+    global _shared_dir
+    if _shared_dir is None:
+        # Memory-backed where available
+        root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        _shared_dir = tempfile.mkdtemp(prefix="tbps-shared-", dir=root)
+        atexit.register(shutil.rmtree, _shared_dir, ignore_errors=True)
+    return _shared_dir
+
+
+def _publish(shared) -> tuple[str, str]:
+    """Key and file of the pickled shared payload, written on first use."""
+    payload = pickle.dumps(shared, protocol=pickle.HIGHEST_PROTOCOL)
+    key = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    with _published_lock:
+        entry = _published.get(key)
+        if entry is None:
+            path = os.path.join(_shared_directory(), key)
+            with open(path, "wb") as f:
+                f.write(payload)
+            entry = _published[key] = [path, 0]
+        _published.move_to_end(key)
+        entry[1] += 1
+        return key, entry[0]
+
+
+def _release(key: str):
+    with _published_lock:
+        _published[key][1] -= 1
+        # Beyond _PUBLISHED_SIZE, remove the oldest payloads no call is using
+        for old_key in list(_published):
+            if len(_published) <= _PUBLISHED_SIZE:
+                break
+            path, users = _published[old_key]
+            if not users:
+                del _published[old_key]
+                os.remove(path)
+
+
+def _worker_shared(key: str, path: str):
+    if key in _shared_cache:
+        _shared_cache.move_to_end(key)
+    else:
+        with open(path, "rb") as f:
+            _shared_cache[key] = pickle.load(f)
+        while len(_shared_cache) > _SHARED_CACHE_SIZE:
+            _shared_cache.popitem(last=False)
+    return _shared_cache[key]
+
+
+def _run_chunk(fn, key: str, path: str, items: list):
+    shared = _worker_shared(key, path)
+    start = time.perf_counter()
+    results = [fn(item, shared) for item in items]
+    return results, time.perf_counter() - start
+
+
+def chunk_size(kind: str, n_items: int) -> int:
+    """
+    Items per task: enough to fill CHUNK_SECONDS at the measured per-item cost
+    of this kind, but no more than leaves CHUNKS_PER_WORKER chunks per worker.
+    """
+    workers = pool_size() or default_pool_size()
+    balanced = max(1, math.ceil(n_items / (workers * CHUNKS_PER_WORKER)))
+    per_item = _item_seconds.get(kind)
+    if not per_item:
+        return balanced
+    return max(1, min(balanced, int(CHUNK_SECONDS / per_item)))
+
+
+def _record_cost(kind: str, per_item: float):
+    previous = _item_seconds.get(kind)
+    _item_seconds[kind] = (
+        per_item if previous is None else 0.7 * previous + 0.3 * per_item
+    )
+
+
+def map_chunked(
+    fn, items, shared=None, kind: str | None = None, desc: str | None = None
+) -> list:
+    """
+    Apply fn(item, shared) to every item on the shared pool, returning results
+    in item order. Items are sent in chunks sized from the measured cost of
+    previous calls of the same kind. shared (e.g. the target tree) is pickled
+    once here into a file named by its content hash, and chunks carry only
+    that key: each worker reads it once and keeps the last few, so the
+    rounds of a query that share the same state send it to a worker once.
+    """
+    items = list(items)
+    if not items:
+        return []
+    kind = kind or fn.__qualname__
+    key, path = _publish(shared)
+    try:
+        size = chunk_size(kind, len(items))
+        chunks = [items[i : i + size] for i in range(0, len(items), size)]
+
+        pool = _acquire_pool()
+        try:
+            futures = [
+                pool.submit(_run_chunk, fn, key, path, chunk) for chunk in chunks
+            ]
+            results = []
+            busy_seconds = 0.0
+            with tqdm(total=len(items), desc=desc, disable=desc is None) as pbar:
+                for future, chunk in zip(futures, chunks):
+                    chunk_results, elapsed = future.result()
+                    results.extend(chunk_results)
+                    busy_seconds += elapsed
+                    pbar.update(len(chunk))
+        finally:
+            _release_pool(pool)
+    finally:
+        _release(key)
+    _record_cost(kind, busy_seconds / len(items))
+    return results
+
+
+atexit.register(shutdown_pool)
@@ -1,9 +1,9 @@
 import json
 import psycopg2
-from process_single import process_single_prop
-from myexpr import deserialize_expr
-from WL.db_utils import DB_CONFIG
-from cse import cse
+from search_app.process_single import process_single_prop
+from search_app.myexpr import deserialize_expr
+from search_app.WL_embedding.db_utils import DB_CONFIG
+from search_app.cse import cse
 
 
 def load_apply_steps_from_pgsql_minimal(db_config: dict):
@@ -0,0 +1,44 @@
+import { API_URLS, ServerType } from "@/lib/api";
+
+// Forwards the backend's NDJSON stream to the browser as it arrives, so the
+// browser only talks to this app; server actions cannot stream partial
+// results back.
+export const dynamic = "force-dynamic";
+
+export async function POST(request: Request) {
+  const serverType = new URL(request.url).searchParams.get("server") ?? "mock";
+  if (!Object.hasOwn(API_URLS, serverType)) {
+    return Response.json(
+      { detail: `Unknown server type: ${serverType}` },
+      { status: 400 },
+    );
+  }
+
+  const baseUrl = API_URLS[serverType as ServerType];
+  let response: Response;
+  try {
+    response = await fetch(`${baseUrl}/find-similar-theorems/stream`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: await request.text(),
+      // Stops the search on the backend when the browser goes away
+      signal: request.signal,
+      cache: "no-store",
+    });
+  } catch (error) {
+    return Response.json(
+      { detail: `Search server unavailable: ${String(error)}` },
+      { status: 502 },
+    );
+  }
+
+  return new Response(response.body, {
+    status: response.status,
+    headers: {
+      "Content-Type":
+        response.headers.get("Content-Type") ?? "application/x-ndjson",
+    },
+  });
+}
@@ -47,8 +47,8 @@ import {
   TheoremResult,
   EXAMPLE_EXPRESSIONS,
   SimilarTheoremsResponse,
+  streamSimilarTheorems,
 } from "@/lib/api";
-import { findSimilarTheorems } from "@/lib/actions";
 
 // Form validation schema
 const searchSchema = z.object({
@@ -75,6 +75,8 @@ export function TheoremSearch({ serverType }: TheoremSearchProps) {
   const [results, setResults] = useState<SimilarTheoremsResponse | null>(null);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState<string | null>(null);
+  // Stage of the ranking shown while results are still being refined
+  const [refining, setRefining] = useState<string | null>(null);
 
   const form = useForm<SearchFormData>({
     resolver: zodResolver(searchSchema),
@@ -89,20 +91,32 @@ export function TheoremSearch({ serverType }: TheoremSearchProps) {
     setLoading(true);
     setError(null);
     setResults(null);
+    setRefining(null);
 
     try {
-      const response = await findSimilarTheorems(
+      const response = await streamSimilarTheorems(
         {
           expression: data.expression,
           k: data.k,
           node_ratio: data.node_ratio || undefined,
         },
         serverType,
+        (update) => {
+          setResults({
+            success: true,
+            results: update.results,
+            total_processed: update.results.length,
+            expression_parsed: update.expression_parsed,
+            partial: update.partial,
+          });
+          setRefining(update.provisional ? update.stage : null);
+        },
       );
       setResults(response);
     } catch (err) {
       setError(err instanceof Error ? err.message : "Unknown error");
     } finally {
+      setRefining(null);
       setLoading(false);
     }
   };
@@ -285,7 +299,7 @@ export function TheoremSearch({ serverType }: TheoremSearchProps) {
       </Card>
 
       {/* Loading Progress */}
-      {loading && (
+      {loading && !results && (
         <Card>
           <CardContent className="p-6">
             <div className="space-y-3">
@@ -321,6 +335,18 @@ export function TheoremSearch({ serverType }: TheoremSearchProps) {
               <CardTitle className="flex items-center gap-2">
                 <FileText className="w-5 h-5" />
                 Search Results ({results.results.length})
+                {refining && (
+                  <Badge variant="outline" className="text-xs font-normal">
+                    <div className="animate-spin rounded-full h-3 w-3 border-b-2 border-slate-500 mr-1" />
+                    Refining ({refining === "wl" ? "WL ranking" : refining})
+                  </Badge>
+                )}
+                {results.partial && !refining && (
+                  <Badge variant="outline" className="text-xs font-normal">
+                    <Clock className="w-3 h-3 mr-1" />
+                    Time budget reached
+                  </Badge>
+                )}
               </CardTitle>
               <div className="flex gap-2">
                 <DropdownMenu>
@@ -380,7 +406,20 @@ export function TheoremSearch({ serverType }: TheoremSearchProps) {
                         <div className="space-y-2">
                           <div className="flex items-center gap-4 text-sm">
                             <div className="flex items-center gap-2">
-                              <span className="text-slate-500">Score:</span>
+                              <span
+                                className="text-slate-500"
+                                title={
+                                  refining
+                                    ? "Provisional: may change until refining finishes"
+                                    : undefined
+                                }
+                              >
+                                {refining === "wl"
+                                  ? "WL score:"
+                                  : refining
+                                    ? "Score (at most):"
+                                    : "Score:"}
+                              </span>
                               <Badge variant="outline" className="font-mono">
                                 {(result.similarity_score * 100).toFixed(1)}%
                               </Badge>
@@ -1,35 +1,6 @@
 "use server";
 
-import {
-  SimilarTheoremsRequest,
-  SimilarTheoremsResponse,
-  HealthResponse,
-  ServerType,
-  API_URLS,
-} from "./api";
-
-export async function findSimilarTheorems(
-  request: SimilarTheoremsRequest,
-  serverType: ServerType = "mock",
-): Promise<SimilarTheoremsResponse> {
-  const baseUrl = API_URLS[serverType];
-  const response = await fetch(`${baseUrl}/find-similar-theorems`, {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/json",
-    },
-    body: JSON.stringify(request),
-  });
-
-  if (!response.ok) {
-    const errorData = await response
-      .json()
-      .catch(() => ({ detail: "Unknown error" }));
-    throw new Error(errorData.detail || `HTTP ${response.status}`);
-  }
-
-  return response.json();
-}
+import { HealthResponse, ServerType, API_URLS } from "./api";
 
 export async function checkHealth(
   serverType: ServerType = "mock",
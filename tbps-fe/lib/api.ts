@@ -10,6 +10,14 @@ export interface SimilarTheoremsRequest {
   expression: string;
   k?: number;
   node_ratio?: number;
+  time_budget_ms?: number;
+  // Query-plan options, capped by the server
+  wl_candidates?: number;
+  wl_iterations?: number;
+  use_clustering?: boolean;
+  n_probe?: number;
+  cheap_candidates?: number;
+  zss_candidates?: number;
 }
 
 export interface SimilarTheoremsResponse {
@@ -17,6 +25,20 @@ export interface SimilarTheoremsResponse {
   results: TheoremResult[];
   total_processed: number;
   expression_parsed: string;
+  partial?: boolean;
+}
+
+// One line of the /find-similar-theorems/stream response
+export interface SimilarTheoremsUpdate {
+  stage: "wl" | "cheap" | "zss" | "done" | "error";
+  final: boolean;
+  results: TheoremResult[];
+  expression_parsed: string;
+  partial: boolean;
+  // Scores of a ranking still being refined: WL kernel values for "wl",
+  // upper bounds for theorems not fully scored yet for "cheap" and "zss"
+  provisional: boolean;
+  detail?: string | null;
 }
 
 export interface HealthResponse {
@@ -108,6 +130,64 @@ export class TheoremSearchAPI {
   }
 }
 
+// Streams the ranking as it is refined, calling onUpdate for each update;
+// resolves with the final results. Runs in the browser, through the
+// app/api/find-similar-theorems/stream route that proxies the backend.
+export async function streamSimilarTheorems(
+  request: SimilarTheoremsRequest,
+  serverType: ServerType,
+  onUpdate: (update: SimilarTheoremsUpdate) => void,
+  signal?: AbortSignal,
+): Promise<SimilarTheoremsResponse> {
+  const response = await fetch(
+    `/api/find-similar-theorems/stream?server=${serverType}`,
+    {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify(request),
+      signal,
+    },
+  );
+
+  if (!response.ok || !response.body) {
+    const errorData = await response
+      .json()
+      .catch(() => ({ detail: "Unknown error" }));
+    throw new Error(errorData.detail || `HTTP ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { done, value } = await reader.read();
+    buffer += decoder.decode(value, { stream: !done });
+    const lines = buffer.split("\n");
+    buffer = done ? "" : (lines.pop() ?? "");
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const update: SimilarTheoremsUpdate = JSON.parse(line);
+      if (update.stage === "error") {
+        throw new Error(update.detail || "Unknown error");
+      }
+      onUpdate(update);
+      if (update.final) {
+        return {
+          success: true,
+          results: update.results,
+          total_processed: update.results.length,
+          expression_parsed: update.expression_parsed,
+          partial: update.partial,
+        };
+      }
+    }
+    if (done) break;
+  }
+  throw new Error("Stream ended before the final results");
+}
+
 // Default API instance
 export const apiClient = new TheoremSearchAPI();
 